@@ -0,0 +1,482 @@
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from werkzeug.utils import import_string
+from shiftuser import exceptions as x
+
+"""
+Cache
+Caching used by shiftuser to skip repeated work on hot paths, like decoding
+the same bearer token on every API request. All caches implement the same
+backend interface: an in-process LRU cache, or a local SQLite file that
+worker processes on a host can share. Backend is picked in config.
+"""
+
+
+class CacheBackend(ABC):
+    """
+    Cache backend
+    Interface every cache backend implements. Entries have a time to live,
+    a ttl of None means cache default and 0 means never expire. Backends
+    missing any of the methods fail to instantiate.
+    """
+    max_size = None
+    ttl = None
+
+    @abstractmethod
+    def get(self, key, default=None):
+        """ Get value or default if missing or expired """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        """ Put value to cache """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def delete(self, key):
+        """ Remove entry if present """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def incr(self, key, delta=1, ttl=None):
+        """ Atomically increment integer value, starting from zero """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def clear(self):
+        """ Remove all entries """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def stats(self):
+        """ Get a dict of cache counters """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class TTLCache(CacheBackend):
+    """
+    TTL cache
+    A thread-safe in-process LRU cache where every entry also has a time to
+    live. Once the cache is full, least recently used entries are evicted.
+    Keeps hit, miss, eviction and expiration stats.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        """
+        Initialize cache
+        :param max_size: int, max number of entries
+        :param ttl: int or None, default entry lifetime in seconds (None or
+            0 to never expire)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Get
+        Returns cached value or default if missing or expired.
+        :param key: str, cache key
+        :param default: value to return on miss
+        :return: cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Set
+        Puts value to cache, evicting least recently used entries if full.
+        :param key: str, cache key
+        :param value: value to cache
+        :param ttl: int or None, lifetime in seconds (cache default if None,
+            0 to never expire)
+        :return: None
+        """
+        with self._lock:
+            self.store(key, value, ttl)
+
+    def store(self, key, value, ttl=None):
+        """
+        Store
+        Puts value to cache and evicts least recently used entries if full.
+        Call with lock held.
+        :param key: str, cache key
+        :param value: value to cache
+        :param ttl: int or None, lifetime in seconds
+        :return: None
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        """
+        Delete
+        Removes entry from cache if present.
+        :param key: str, cache key
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key, delta=1, ttl=None):
+        """
+        Increment
+        Increments integer value, which starts from zero if missing or
+        expired. Lifetime is set when entry is created and kept on updates.
+        :param key: str, cache key
+        :param delta: int, increment
+        :param ttl: int or None, lifetime of a new entry in seconds
+        :return: int, new value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    value += delta
+                    self._entries[key] = (value, expires)
+                    self._entries.move_to_end(key)
+                    return value
+
+            self.store(key, delta, ttl)
+            return delta
+
+    def clear(self):
+        """ Remove all entries """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Get stats
+        Returns a snapshot of cache counters.
+        :return: dict
+        """
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                max_size=self.max_size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+            )
+
+
+class SQLiteCache(CacheBackend):
+    """
+    SQLite cache
+    A cache in a local SQLite file that every worker process on a host can
+    share. Entries are kept in a namespace, so that several caches can use
+    one file. Once the cache is full, oldest entries are evicted. Integers
+    are stored as is, other values are pickled, so the file must not be
+    writable by anyone else. Size limit is enforced every few writes
+    rather than on every write.
+    """
+
+    def __init__(self, path, namespace='default', max_size=1024, ttl=None):
+        """
+        Initialize cache
+        :param path: str, path to database file
+        :param namespace: str, namespace of this cache in the file
+        :param max_size: int, max number of entries
+        :param ttl: int or None, default entry lifetime in seconds (None or
+            0 to never expire)
+        """
+        self.path = path
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.sets = 0
+        self.prune_every = max(1, min(64, max_size // 8))
+
+    @property
+    def db(self):
+        """
+        Get connection
+        Connects on first use in every thread and process, as sqlite
+        connections can not be shared between them.
+        :return: sqlite3.Connection
+        """
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.db = self.connect()
+            local.pid = os.getpid()
+        return local.db
+
+    def connect(self):
+        """
+        Connect
+        Opens or creates cache file and its table.
+        :return: sqlite3.Connection
+        """
+        if not os.path.exists(self.path):
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS shiftuser_cache ('
+            'namespace TEXT NOT NULL, '
+            'key TEXT NOT NULL, '
+            'value, '
+            'expires REAL, '
+            'created REAL NOT NULL, '
+            'PRIMARY KEY (namespace, key))'
+        )
+        db.execute(
+            'CREATE INDEX IF NOT EXISTS ix_shiftuser_cache_created '
+            'ON shiftuser_cache (namespace, created)'
+        )
+        return db
+
+    def count(self, name, value=1):
+        """ Increment a stats counter """
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def expires(self, ttl):
+        """ Get expiration timestamp for a ttl """
+        ttl = ttl if ttl is not None else self.ttl
+        return time.time() + ttl if ttl else None
+
+    def get(self, key, default=None):
+        """
+        Get
+        Returns cached value or default if missing or expired.
+        :param key: str, cache key
+        :param default: value to return on miss
+        :return: cached value or default
+        """
+        row = self.db.execute(
+            'SELECT value, expires FROM shiftuser_cache '
+            'WHERE namespace = ? AND key = ?',
+            (self.namespace, str(key))
+        ).fetchone()
+
+        if row is None:
+            self.count('misses')
+            return default
+
+        value, expires = row
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            self.count('expirations')
+            self.count('misses')
+            return default
+
+        self.count('hits')
+        if isinstance(value, bytes):
+            value = pickle.loads(value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Set
+        Puts value to cache, evicting oldest entries if full.
+        :param key: str, cache key
+        :param value: value to cache
+        :param ttl: int or None, lifetime in seconds (cache default if None,
+            0 to never expire)
+        :return: None
+        """
+        if type(value) is not int:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        self.db.execute(
+            'INSERT OR REPLACE INTO shiftuser_cache '
+            '(namespace, key, value, expires, created) VALUES (?, ?, ?, ?, ?)',
+            (self.namespace, str(key), value, self.expires(ttl), time.time())
+        )
+
+        self.count('sets')
+        if self.sets % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        """
+        Prune
+        Removes expired entries, then oldest ones above max size.
+        :return: None
+        """
+        db = self.db
+        cursor = db.execute(
+            'DELETE FROM shiftuser_cache WHERE namespace = ? AND expires <= ?',
+            (self.namespace, time.time())
+        )
+        self.count('expirations', cursor.rowcount)
+
+        size = len(self)
+        if size <= self.max_size:
+            return
+
+        cursor = db.execute(
+            'DELETE FROM shiftuser_cache WHERE namespace = ? AND key IN ('
+            'SELECT key FROM shiftuser_cache WHERE namespace = ? '
+            'ORDER BY created LIMIT ?)',
+            (self.namespace, self.namespace, size - self.max_size)
+        )
+        self.count('evictions', cursor.rowcount)
+
+    def delete(self, key):
+        """
+        Delete
+        Removes entry from cache if present.
+        :param key: str, cache key
+        :return: None
+        """
+        self.db.execute(
+            'DELETE FROM shiftuser_cache WHERE namespace = ? AND key = ?',
+            (self.namespace, str(key))
+        )
+
+    def incr(self, key, delta=1, ttl=None):
+        """
+        Increment
+        Atomically increments integer value across processes. Value starts
+        from zero if missing or expired. Lifetime is set when entry is
+        created and kept on updates.
+        :param key: str, cache key
+        :param delta: int, increment
+        :param ttl: int or None, lifetime of a new entry in seconds
+        :return: int, new value
+        """
+        db = self.db
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT value, expires FROM shiftuser_cache '
+                'WHERE namespace = ? AND key = ?',
+                (self.namespace, str(key))
+            ).fetchone()
+
+            if row and type(row[0]) is int and (not row[1] or row[1] > now):
+                value, expires = row[0] + delta, row[1]
+            else:
+                value, expires = delta, self.expires(ttl)
+
+            db.execute(
+                'INSERT OR REPLACE INTO shiftuser_cache '
+                '(namespace, key, value, expires, created) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (self.namespace, str(key), value, expires, now)
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+        return value
+
+    def clear(self):
+        """ Remove all entries in namespace """
+        self.db.execute(
+            'DELETE FROM shiftuser_cache WHERE namespace = ?',
+            (self.namespace,)
+        )
+
+    def stats(self):
+        """
+        Get stats
+        Returns a snapshot of cache counters of this process.
+        :return: dict
+        """
+        return dict(
+            size=len(self),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
+
+    def __len__(self):
+        row = self.db.execute(
+            'SELECT COUNT(*) FROM shiftuser_cache WHERE namespace = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (self.namespace, time.time())
+        ).fetchone()
+        return row[0]
+
+
+def create_cache(backend=None, namespace='default', max_size=1024, ttl=None,
+                 path=None):
+    """
+    Create cache
+    Instantiates cache backend by name, or an importable string of custom
+    backend class that accepts the same keyword arguments.
+
+    :param backend: str or None, 'memory' (default), 'sqlite' or a class name
+    :param namespace: str, what is cached, to keep caches in shared storage
+        apart
+    :param max_size: int, max number of entries
+    :param ttl: int or None, default entry lifetime in seconds
+    :param path: str or None, path to cache file for file-based backends
+    :return: shiftuser.cache.CacheBackend
+    """
+    if not backend or backend == 'memory':
+        return TTLCache(max_size=max_size, ttl=ttl)
+
+    if backend == 'sqlite':
+        if not path:
+            msg = 'SQLite cache backend requires USER_CACHE_PATH'
+            raise x.ConfigurationException(msg)
+        return SQLiteCache(path, namespace=namespace, max_size=max_size, ttl=ttl)
+
+    try:
+        backend_class = import_string(backend)
+    except ImportError as e:
+        msg = 'Failed to import cache backend [{}]: {}'
+        raise x.ConfigurationException(msg.format(backend, str(e)))
+
+    return backend_class(
+        namespace=namespace,
+        max_size=max_size,
+        ttl=ttl,
+        path=path
+    )
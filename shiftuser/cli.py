@@ -244,3 +244,82 @@ def remove_role(*_, role_handle=None, user_id=None):
         click.echo(green(msg))
         return
 
+
+@user_cli.command(name='hash-benchmark')
+@click.option('--target', type=float, default=100, help='Target verification time, ms')
+@click.option('--samples', type=int, default=3, help='Measurements per setting')
+@click.option('--write', type=click.Path(), default=None, help='Write PASSLIB_ROUNDS to config file, keeping other settings')
+def hash_benchmark(*_, target=100, samples=3, write=None):
+    """ Calibrate password hashing cost """
+    from shiftuser.util.hash_benchmark import benchmark, write_setting
+    click.echo(green('\nBenchmarking password hashing:'))
+    click.echo(green('-' * 40))
+
+    with get_app().app_context():
+        from flask import current_app
+        schemes = current_app.config.get('PASSLIB_SCHEMES') or []
+
+    recommended = dict()
+    for scheme in schemes:
+        click.echo(yellow(scheme + ':'))
+        rounds, results = benchmark(scheme, target_ms=target, samples=samples)
+        for result in results:
+            click.echo('* rounds {}: hash {:.1f}ms, verify {:.1f}ms'.format(
+                result['rounds'] if result['rounds'] is not None else '-',
+                result['hash_ms'],
+                result['verify_ms']
+            ))
+        if rounds is not None:
+            recommended[scheme] = rounds
+        click.echo('')
+
+    setting = 'PASSLIB_ROUNDS = {}'.format(recommended)
+    click.echo(green('Recommended for {}ms target:'.format(target)))
+    click.echo(setting + '\n')
+
+    if write:
+        write_setting(write, recommended)
+        click.echo(green('Written to {}\n'.format(write)))
+
+
+@user_cli.command(name='legacy-hashes')
+def legacy_hashes():
+    """ Count password hashes needing an upgrade """
+    click.echo(green('\nCounting legacy password hashes:'))
+    click.echo(green('-' * 40))
+    with get_app().app_context():
+        count = user_service.count_legacy_hashes()
+
+    msg = '{} hashes will be upgraded on next successful login\n'
+    click.echo(msg.format(count))
+
+
+@user_cli.command(name='mint-tokens')
+@click.option('--output', type=click.File('w'), required=True, help='File to write tokens to')
+@click.option('--user_id', type=int, multiple=True, help='User id, can be repeated')
+@click.option('--all-users', is_flag=True, default=False, help='Mint tokens for all users')
+@click.option('--device', type=str, default=None, help='Device name')
+@click.option('--chunk', type=int, default=1000, help='Users per batch')
+def mint_tokens(*_, output, user_id=(), all_users=False, device=None, chunk=1000):
+    """ Mint bearer tokens in bulk, writes user_id,token lines """
+    click.echo(green('\nMinting tokens:'))
+    click.echo(green('-' * 40))
+
+    with get_app().app_context():
+        from boiler.feature.orm import db
+        user_ids = list(user_id)
+        if all_users:
+            query = db.session.query(User.id).order_by(User.id)
+            user_ids = [row.id for row in query]
+
+        count = 0
+        pairs = user_service.get_tokens(
+            user_ids,
+            device=device,
+            chunk_size=chunk
+        )
+        for id, token in pairs:
+            output.write('{},{}\n'.format(id, token))
+            count += 1
+
+    click.echo('{} tokens written to {}\n'.format(count, output.name))
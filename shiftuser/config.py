@@ -12,13 +12,34 @@ class UserConfig:
     # passwords
     PASSLIB_ALGO = 'bcrypt'
     PASSLIB_SCHEMES = ['bcrypt', 'md5_crypt']
+    PASSLIB_ROUNDS = None # dict of scheme rounds, see hash-benchmark command
+    USER_HASHING_THREADS = None # None hashes on request thread
+    USER_LOGIN_CONCURRENCY = None # None does not limit
+    USER_LOGIN_QUEUE_SIZE = 0
+    USER_LOGIN_QUEUE_TIMEOUT = None # seconds
 
     # jwt
     USER_JWT_SECRET = os.environ.get('APP_USER_JWT_SECRET')
     USER_JWT_ALGO = 'HS256'
+    USER_JWT_KEYS = None # dict of key id: algorithm, private_key, public_key
+    USER_JWT_KEY_ID = None # id of the key to sign with
     USER_JWT_LIFETIME_SECONDS = 60 * 60 * 24 * 1 # days
+    USER_JWT_ACCESS_LIFETIME_SECONDS = 60 * 5 # minutes
+    USER_JWT_REFRESH_LIFETIME_SECONDS = 60 * 60 * 24 * 30 # days
     USER_JWT_IMPLEMENTATION = None # string module name
     USER_JWT_LOADER_IMPLEMENTATION = None # string module name
+    USER_CACHE_BACKEND = 'memory' # memory, sqlite or importable class
+    USER_CACHE_PATH = None # cache file for sqlite backend
+    USER_JWT_CACHE_SIZE = None # None disables decoded token cache
+    USER_JWT_CACHE_TTL = 60 # seconds
+    USER_JWT_STATELESS = False
+    USER_JWT_VERSIONS_REFRESH_SECONDS = 5
+    USER_SESSION_CACHE_SIZE = None # None disables user snapshot cache
+    USER_SESSION_CACHE_TTL = 60 # seconds
+    USER_LIGHTWEIGHT_USER = False # load AuthenticatedUser, not User entity
+    USER_REVOCATION_FILE = None # path, None disables revocation store
+    USER_REVOCATION_CAPACITY = 65536 # slots
+    USER_ROLES_REFRESH_SECONDS = 30 # None to reload on local changes only
 
     USER_PUBLIC_PROFILES = False
     USER_ACCOUNTS_REQUIRE_CONFIRMATION = True
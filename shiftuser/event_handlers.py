@@ -88,8 +88,31 @@ def password_changed_event(user):
     # doggy.increment('user.password_changed')
 
 
+def invalidate_token_cache(user):
+    """ Drop cached bearer tokens of a user that was saved or deleted """
+    from shiftuser.services import user_service
+    user_service.invalidate_token_cache(user.id)
+
+
+def invalidate_user_cache(user, **kwargs):
+    """ Drop cached snapshot of a user that was saved, deleted or got roles """
+    from shiftuser.services import user_service
+    user_service.invalidate_user_cache(user.id)
+
+
+def invalidate_principal_needs(user):
+    """ Drop precomputed principal needs of a deleted user """
+    from shiftuser.util.principal import needs_cache
+    needs_cache.delete(user)
+
+
 events.user_save_event.connect(user_save_event)
+events.user_save_event.connect(invalidate_token_cache)
+events.user_save_event.connect(invalidate_user_cache)
 events.user_delete_event.connect(user_delete_event)
+events.user_delete_event.connect(invalidate_token_cache)
+events.user_delete_event.connect(invalidate_user_cache)
+events.user_delete_event.connect(invalidate_principal_needs)
 events.login_event.connect(login_event)
 events.login_failed_nonexistent_event.connect(login_nonexistent_event)
 events.login_failed_event.connect(login_failed_event)
@@ -115,5 +138,23 @@ def user_lost_role_event(user, role):
     msg = 'User ({}){} lost a role [{}]'
     current_app.logger.info(msg.format(user.id, user.email, role.handle))
 
+
+def invalidate_role_caches(role):
+    """ Drop all cached user snapshots, needs, hierarchy and permissions """
+    from shiftuser.services import user_service
+    from shiftuser.util.principal import needs_cache
+    from shiftuser.models import role_hierarchy, permission_registry
+    user_service.invalidate_user_cache()
+    user_service.invalidate_token_cache()
+    needs_cache.clear()
+    role_hierarchy.invalidate()
+    permission_registry.invalidate()
+
+
 events.user_got_role_event.connect(user_got_role_event)
+events.user_got_role_event.connect(invalidate_user_cache)
 events.user_lost_role_event.connect(user_lost_role_event)
+events.user_lost_role_event.connect(invalidate_user_cache)
+events.role_saved_event.connect(invalidate_role_caches)
+events.role_created_event.connect(invalidate_role_caches)
+events.role_deleted_event.connect(invalidate_role_caches)
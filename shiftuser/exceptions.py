@@ -25,6 +25,16 @@ class AccountLocked(UserException, RuntimeError):
         super().__init__(*args)
 
 
+class LoginOverloaded(UserException, RuntimeError):
+    """ Raised when too many password verifications are already running """
+    pass
+
+
+class RevocationStoreFull(UserException, RuntimeError):
+    """ Raised when there is no free slot left in token revocation store """
+    pass
+
+
 class EmailNotConfirmed(UserException, RuntimeError):
     """ Raised when logging in into an unconfirmed account """
     def __init__(self, *args, email=None):
@@ -3,7 +3,6 @@ from flask import session, current_app, abort
 from jinja2 import ChoiceLoader, FileSystemLoader
 from flask_login import current_user
 from flask_principal import identity_loaded
-from flask_principal import Identity
 from flask_principal import AnonymousIdentity
 import logging
 
@@ -11,6 +10,7 @@ from shiftuser import exceptions as x
 from shiftuser.session_interface import SessionInterface
 from shiftuser.services import login_manager, principal
 from shiftuser.services import user_service
+from shiftuser.util.principal import LazyNeeds, UserIdentity
 
 
 def user_feature(app):
@@ -20,9 +20,11 @@ def user_feature(app):
     flask principal and oauth integration
     """
 
-    # check we have jwt secret configures
-    if not app.config.get('USER_JWT_SECRET', None):
-        raise x.JwtSecretMissing('Please set USER_JWT_SECRET in config')
+    # check we have jwt secret or keys configured
+    jwt_secret = app.config.get('USER_JWT_SECRET', None)
+    if not jwt_secret and not app.config.get('USER_JWT_KEYS', None):
+        msg = 'Please set USER_JWT_SECRET or USER_JWT_KEYS in config'
+        raise x.JwtSecretMissing(msg)
 
     # set path to default user templates
     if not isinstance(app.jinja_loader, ChoiceLoader):
@@ -43,7 +45,9 @@ def user_feature(app):
 
     @login_manager.user_loader
     def load_user(id):
-        return user_service.get(id)
+        if user_service.lightweight_user:
+            return user_service.load_authenticated_user(id)
+        return user_service.load_user(id)
 
     # init principal
     principal.init_app(app)
@@ -51,7 +55,7 @@ def user_feature(app):
     @principal.identity_loader
     def load_identity():
         if current_user.is_authenticated:
-            return Identity(current_user.id)
+            return UserIdentity(current_user.id)
         session.pop('identity.name', None)
         session.pop('identity.auth_type', None)
         return AnonymousIdentity()
@@ -62,9 +66,13 @@ def user_feature(app):
         if not current_user.is_authenticated:
             return
 
-        # add needs provided by the user
-        for need in current_user.provide_principal_needs():
-            identity.provides.add(need)
+        # needs provided by the user resolve on first permission check
+        identity.provides = LazyNeeds(
+            current_user.provide_principal_needs,
+            identity.provides
+        )
+        if not isinstance(identity, UserIdentity):
+            identity.permission_mask = current_user.permission_mask
 
 
 def enable_request_loader():
@@ -83,6 +91,8 @@ def enable_request_loader():
             try:
                 token = auth[7:]
                 user = user_service.get_user_by_token(token)
+                if user_service.lightweight_user:
+                    user = user_service.authenticated_user(user)
             except x.UserException as exception:
                 msg = 'JWT token login failed for [{ip}] with message: [{msg}]'
                 msg = msg.format(
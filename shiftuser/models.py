@@ -1,11 +1,18 @@
 import datetime, jwt
-from hashlib import md5
+from hashlib import md5, sha256
+from sqlalchemy import inspect
 from sqlalchemy.ext.hybrid import hybrid_property
-from flask_principal import UserNeed, RoleNeed
+from sqlalchemy.orm import aliased, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from flask_principal import UserNeed
 from shiftuser import exceptions as x
 from shiftschema.schema import Schema
 from shiftschema import validators, filters
 from shiftuser import validators as user_validators
+from shiftuser.util.passlib import get_context
+from shiftuser.util.principal import needs_cache
+from shiftuser.util.hierarchy import RoleHierarchy
+from shiftuser.util.permissions import PermissionRegistry
 from boiler.feature.orm import db
 
 # association table
@@ -15,6 +22,41 @@ UserRoles = db.Table('user_roles',
 )
 
 
+def take_snapshot(entity, exclude=()):
+    """
+    Take snapshot
+    Returns a plain dict of entity column values.
+    :param entity: db.Model, entity
+    :param exclude: iterable, column attributes to leave out
+    :return: dict
+    """
+    mapper = inspect(type(entity))
+    keys = [attr.key for attr in mapper.column_attrs if attr.key not in exclude]
+    return {key: getattr(entity, key) for key in keys}
+
+
+def restore_snapshot(cls, snapshot, relationships=None):
+    """
+    Restore snapshot
+    Turns column values back into a persistent entity in current session
+    without querying the database. Columns that are not in the snapshot
+    load on first access.
+
+    :param cls: type, entity class
+    :param snapshot: dict, column values
+    :param relationships: dict or None, already restored related entities
+    :return: db.Model
+    """
+    entity = inspect(cls).class_manager.new_instance()
+    for key, value in snapshot.items():
+        set_committed_value(entity, key, value)
+    for key, value in (relationships or dict()).items():
+        set_committed_value(entity, key, value)
+
+    make_transient_to_detached(entity)
+    return db.session.merge(entity, load=False)
+
+
 # -----------------------------------------------------------------------------
 # Role
 # -----------------------------------------------------------------------------
@@ -38,6 +80,9 @@ class RoleSchema(Schema):
         self.description.add_filter(filters.Strip())
         self.description.add_validator(validators.Length(max=256))
 
+        self.add_property('parent')
+        self.parent.add_validator(user_validators.RoleParent())
+
 
 class Role(db.Model):
     _handle = db.Column('handle', db.String(128), nullable=False, unique=True)
@@ -46,6 +91,26 @@ class Role(db.Model):
     title = db.Column(db.String(256))
     description = db.Column(db.String(256))
 
+    # hierarchy
+    parent_id = db.Column(
+        db.Integer,
+        db.ForeignKey('role.id', ondelete='SET NULL'),
+        index=True
+    )
+    parent = db.relationship(
+        'Role',
+        remote_side=[id],
+        backref=db.backref('children', lazy='select')
+    )
+
+    # permissions
+    _permissions = db.relationship(
+        'RolePermission',
+        lazy='select',
+        back_populates='role',
+        cascade='all, delete-orphan'
+    )
+
     def __init__(self, *args, **kwargs):
         if 'id' in kwargs:del kwargs['id']
         super().__init__(*args, **kwargs)
@@ -80,6 +145,104 @@ class Role(db.Model):
         """ Users accessor """
         return tuple(self._users)
 
+    @property
+    def permissions(self):
+        """ Names of permissions granted to role """
+        return tuple(p.permission for p in self._permissions)
+
+    @property
+    def permission_mask(self):
+        """
+        Permission mask
+        Returns mask of permissions granted to role and roles it extends,
+        as of the last save.
+        :return: int
+        """
+        handles = role_hierarchy.implied([self.handle])
+        return permission_registry.roles_mask(handles)
+
+    def grant(self, permission):
+        """ Grant permission to role """
+        if permission not in self.permissions:
+            self._permissions.append(RolePermission(permission=permission))
+
+    def revoke(self, permission):
+        """ Revoke permission from role """
+        for granted in self._permissions:
+            if granted.permission == permission:
+                self._permissions.remove(granted)
+                break
+
+    def snapshot(self):
+        """
+        Snapshot
+        Returns a plain dict of role column values to cache along with users.
+        :return: dict
+        """
+        return take_snapshot(self)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        From snapshot
+        Restores role entity from a snapshot without querying the database.
+        :param snapshot: dict, result of Role.snapshot()
+        :return: shiftuser.models.Role
+        """
+        return restore_snapshot(cls, snapshot)
+
+
+def load_role_hierarchy():
+    """
+    Load role hierarchy
+    Returns handles of roles that extend a parent, along with parent handle.
+    :return: list of tuples (handle, parent_handle)
+    """
+    parent = aliased(Role)
+    query = db.session.query(Role._handle, parent._handle)
+    return query.join(parent, Role.parent_id == parent.id).all()
+
+
+role_hierarchy = RoleHierarchy(loader=load_role_hierarchy)
+
+
+class RolePermission(db.Model):
+    """
+    Role permission
+    A permission granted to a role, by name.
+    """
+    __tablename__ = 'role_permissions'
+    __table_args__ = (
+        db.UniqueConstraint('role_id', 'permission'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    role_id = db.Column(
+        db.Integer,
+        db.ForeignKey('role.id', ondelete='CASCADE'),
+        nullable=False
+    )
+    permission = db.Column(db.String(128), nullable=False)
+    role = db.relationship('Role', back_populates='_permissions')
+
+    def __repr__(self):
+        """ Printable representation of role permission """
+        u = '<RolePermission role_id="{}" permission="{}">'
+        return u.format(self.role_id, self.permission)
+
+
+def load_role_permissions():
+    """
+    Load role permissions
+    Returns permissions granted to roles along with role handle.
+    :return: list of tuples (handle, permission)
+    """
+    query = db.session.query(Role._handle, RolePermission.permission)
+    return query.join(RolePermission, Role._permissions).all()
+
+
+permission_registry = PermissionRegistry(loader=load_role_permissions)
+
 
 # -----------------------------------------------------------------------------
 # User
@@ -124,6 +287,13 @@ class User(db.Model):
     email_link_expires_in = 24     # hours
     password_link_expires_in = 24  # hours
 
+    # columns never put into snapshots
+    snapshot_exclude = ('_password', 'password_link', 'email_link')
+
+    # lock account for this many minutes after this many failed logins
+    failed_login_limit = 10
+    failed_login_lock_minutes = 30
+
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     created = db.Column(db.DateTime)
 
@@ -144,9 +314,21 @@ class User(db.Model):
     password_link_expires = db.Column(db.DateTime)
 
     # token
-    _token = db.Column('token', db.Text())
+    token_version = db.Column(
+        db.Integer(),
+        default=0,
+        server_default='0',
+        nullable=False
+    )
+    token_version_changed = db.Column(db.DateTime, index=True)
 
     # roles
+    roles_version = db.Column(
+        db.Integer(),
+        default=0,
+        server_default='0',
+        nullable=False
+    )
     _roles = db.relationship(
         'Role',
         secondary=UserRoles,
@@ -154,6 +336,14 @@ class User(db.Model):
         back_populates='_users'
     )
 
+    # tokens
+    _tokens = db.relationship(
+        'UserToken',
+        lazy='dynamic',
+        back_populates='user',
+        cascade='all, delete-orphan'
+    )
+
     # -------------------------------------------------------------------------
     # Public API
     # -------------------------------------------------------------------------
@@ -167,6 +357,8 @@ class User(db.Model):
         self.created = datetime.datetime.utcnow()
         self.email_confirmed = False
         self.failed_logins = 0
+        self.token_version = 0
+        self.roles_version = 0
 
     def __repr__(self):
         """ Printable representation of user """
@@ -203,6 +395,41 @@ class User(db.Model):
 
         return user
 
+    def snapshot(self, roles=False):
+        """
+        Snapshot
+        Returns a plain dict of user column values that can be cached
+        between requests and turned back into an entity with from_snapshot.
+        Secrets (password hash and links) are left out, these load from the
+        database if accessed on restored entity.
+
+        :param roles: bool, whether to include roles
+        :return: dict
+        """
+        snapshot = take_snapshot(self, exclude=self.snapshot_exclude)
+        if roles:
+            snapshot['roles'] = [role.snapshot() for role in self._roles]
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        From snapshot
+        Restores user entity from a snapshot and puts it into current
+        session without querying the database. Roles are restored if they
+        are part of the snapshot, otherwise they lazy-load if accessed.
+
+        :param snapshot: dict, result of User.snapshot()
+        :return: shiftuser.models.User
+        """
+        snapshot = dict(snapshot)
+        relationships = dict()
+        roles = snapshot.pop('roles', None)
+        if roles is not None:
+            relationships['_roles'] = [Role.from_snapshot(r) for r in roles]
+
+        return restore_snapshot(cls, snapshot, relationships)
+
     def generate_hash(self, length=30):
         """ Generate random string of given length """
         import random, string
@@ -243,13 +470,12 @@ class User(db.Model):
     def provide_principal_needs(self):
         """
         Provide principal needs
-        Returns a list of principal needs this user satisfies to be added
-        to principal identity upon login. These are later used to check for
-        active permissions the user has.
-        :return: list
+        Returns principal needs this user satisfies to be added to principal
+        identity upon login. These are later used to check for active
+        permissions the user has. Needs are computed once per roles version.
+        :return: frozenset
         """
-        needs = [RoleNeed(role.handle) for role in self.roles]
-        return needs
+        return needs_cache.get(self)
 
     # -------------------------------------------------------------------------
     # Login counter
@@ -270,8 +496,10 @@ class User(db.Model):
         else:
             return False
 
-    def lock_account(self, minutes=30):
+    def lock_account(self, minutes=None):
         """ Lock user account for a period """
+        if minutes is None:
+            minutes = self.failed_login_lock_minutes
         period = datetime.timedelta(minutes=minutes)
         self.locked_until = datetime.datetime.utcnow() + period
 
@@ -287,7 +515,7 @@ class User(db.Model):
             self.failed_logins += 1
         else:
             self.reset_login_counter()
-            self.lock_account(30)
+            self.lock_account()
 
     def reset_login_counter(self):
         """ Reset login counter """
@@ -295,7 +523,7 @@ class User(db.Model):
 
     def failed_login_limit_reached(self):
         """ A boolean method to check for failed login limit being reached"""
-        login_limit = 10
+        login_limit = self.failed_login_limit
         if self.failed_logins and self.failed_logins >= login_limit:
             return True
         else:
@@ -386,18 +614,40 @@ class User(db.Model):
     @password.setter
     def password(self, password):
         """ Encode a string and set as password """
-        from shiftuser.util.passlib import passlib_context
         password = str(password)
-        encrypted = passlib_context.encrypt(password)
+        encrypted = get_context().encrypt(password)
         self._password = encrypted
 
     def verify_password(self, password):
-        """ Verify a given string for being valid password """
+        """
+        Verify a given string for being valid password
+        Legacy hashes (deprecated scheme or too few rounds) are replaced
+        with a fresh hash on successful verification. The new hash is not
+        persisted here, that happens on next save.
+        """
         if self.password is None:
             return False
 
-        from shiftuser.util.passlib import passlib_context
-        return passlib_context.verify(str(password), self.password)
+        verified, new_hash = get_context().verify_and_update(
+            str(password),
+            self.password
+        )
+        if verified and new_hash:
+            self.upgrade_password_hash(new_hash)
+        return verified
+
+    def set_password_hash(self, hash):
+        """ Set precomputed password hash (e.g. hashed in bulk) """
+        self._password = hash
+
+    def upgrade_password_hash(self, new_hash):
+        """ Replace legacy password hash with an up to date one """
+        self.set_password_hash(new_hash)
+        self._password_upgraded = True
+
+    def pop_password_upgrade(self):
+        """ Check and forget if password hash was upgraded since last save """
+        return self.__dict__.pop('_password_upgraded', False)
 
     def generate_password_link(self):
         """ Generates a link to reset password """
@@ -429,34 +679,201 @@ class User(db.Model):
             raise x.UserException(err)
 
         self._roles.append(role)
+        self.bump_roles_version()
 
     def remove_role(self, role):
         """ Remove role from user """
         if role in self._roles:
             self._roles.remove(role)
+            self.bump_roles_version()
+
+    def bump_roles_version(self):
+        """
+        Bump roles version
+        Saved users get their roles version incremented in SQL on flush, so
+        that concurrent role changes from several processes each get a
+        distinct version. Until then roles version is pending.
+        :return: None
+        """
+        if inspect(self).has_identity:
+            self.roles_version = User.roles_version + 1
+        else:
+            self.roles_version = (self.roles_version or 0) + 1
+        self._role_handles = None
+
+    @property
+    def roles_version_pending(self):
+        """ Check if roles version bump is yet to be flushed """
+        return not isinstance(self.roles_version, int)
 
     def has_role(self, role_or_handle):
         """ Checks if user has role """
         if not isinstance(role_or_handle, str):
-            return role_or_handle in self.roles
+            role_or_handle = role_or_handle.handle
+        return role_or_handle in self.role_handles
+
+    def has_any_role(self, *roles_or_handles):
+        """ Checks if user has at least one of the roles """
+        handles = self.role_handles
+        for role in roles_or_handles:
+            handle = role if isinstance(role, str) else role.handle
+            if handle in handles:
+                return True
+        return False
 
-        has_role = False
-        for role in self.roles:
-            if role.handle == role_or_handle:
-                has_role = True
-                break
+    def has_all_roles(self, *roles_or_handles):
+        """ Checks if user has every one of the roles """
+        handles = self.role_handles
+        for role in roles_or_handles:
+            handle = role if isinstance(role, str) else role.handle
+            if handle not in handles:
+                return False
+        return True
+
+    @property
+    def role_handles(self):
+        """
+        Role handles
+        Returns a set of handles of user roles, including default role and
+        roles these imply through role hierarchy. It is built once and kept
+        until user roles or role hierarchy change.
+        :return: frozenset
+        """
+        if self.roles_version_pending:
+            return role_hierarchy.implied(role.handle for role in self.roles)
 
-        return has_role
+        version = (self.roles_version, role_hierarchy.version)
+        cached = self.__dict__.get('_role_handles')
+        if cached is None or cached[0] != version:
+            handles = role_hierarchy.implied(role.handle for role in self.roles)
+            cached = (version, handles)
+            self._role_handles = cached
+        return cached[1]
+
+    @property
+    def permission_mask(self):
+        """
+        Permission mask
+        Returns mask of all permissions granted to user roles. It is kept
+        until user roles or roles themselves change.
+        :return: int
+        """
+        if self.roles_version_pending:
+            return permission_registry.roles_mask(self.role_handles)
+
+        version = (self.roles_version, permission_registry.version)
+        cached = self.__dict__.get('_permission_mask')
+        if cached is None or cached[0] != version:
+            mask = permission_registry.roles_mask(self.role_handles)
+            cached = (version, mask)
+            self._permission_mask = cached
+        return cached[1]
+
+    def can(self, permission):
+        """
+        Can?
+        Checks if user has a permission through any of the roles.
+        :param permission: str, permission name
+        :return: bool
+        """
+        return permission_registry.allows(self.permission_mask, permission)
 
     @property
     def roles(self):
         """ Roles accessor """
-        roles = list(self._roles)
-        default_role = Role(
+        return tuple(self._roles) + (default_role(),)
+
+
+_default_role = None
+
+
+def default_role():
+    """
+    Default role
+    Returns the role every registered user has. It is never persisted, so
+    a single instance is shared by all users.
+    :return: shiftuser.models.Role
+    """
+    global _default_role
+    if _default_role is None:
+        _default_role = Role(
             handle='user',
             title='User role',
             description='All registered users get this role by default'
         )
+    return _default_role
+
+
+# -----------------------------------------------------------------------------
+# User token
+# -----------------------------------------------------------------------------
+
+class UserToken(db.Model):
+    """
+    User token
+    Represents an issued JWT token or a refresh token. A user can have many
+    of these, one per device they logged in from. Tokens themselves are not
+    stored, only their fixed-length digest, which is what incoming tokens
+    are looked up by.
+    """
+    __tablename__ = 'user_token'
+
+    KIND_ACCESS = 'access'
+    KIND_REFRESH = 'refresh'
+
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    kind = db.Column(db.String(16), nullable=False, default=KIND_ACCESS)
+    token_hash = db.Column(db.String(64), nullable=False, unique=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('user.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True
+    )
+    created = db.Column(db.DateTime)
+    expires = db.Column(db.DateTime, index=True)
+
+    # device
+    device = db.Column(db.String(128))
+    user_agent = db.Column(db.String(256))
+    ip = db.Column(db.String(45))
+
+    user = db.relationship('User', back_populates='_tokens')
+
+    __table_args__ = (
+        db.Index('ix_user_token_user_device', 'user_id', 'device'),
+    )
+
+    def __init__(self, *args, token=None, **kwargs):
+        """ Instantiate with a token to store digest of """
+        if 'id' in kwargs:
+            del kwargs['id']
+
+        super().__init__(*args, **kwargs)
+        self.created = datetime.datetime.utcnow()
+        if token is not None:
+            self.token_hash = self.hash(token)
+
+    def __repr__(self):
+        """ Printable representation of token """
+        u = '<UserToken id="{}" user_id="{}" device="{}">'
+        return u.format(self.id, self.user_id, self.device)
+
+    @staticmethod
+    def hash(token):
+        """
+        Hash token
+        Returns fixed-length digest of a token that is used to store and
+        look up tokens.
+        :param token: str, token
+        :return: str
+        """
+        return sha256(token.encode('utf-8')).hexdigest()
+
+    def is_expired(self, now=None):
+        """ Check if token expired """
+        if not self.expires:
+            return False
 
-        roles.append(default_role)
-        return tuple(roles)
+        now = now or datetime.datetime.utcnow()
+        return self.expires <= now
@@ -27,9 +27,10 @@ class RoleService(AbstractService):
         events.role_saved_event.send(role)
         return role
 
-    def create(self, handle, title=None, description=None):
-        """ Create a role """
+    def create(self, handle, title=None, description=None, parent=None):
+        """ Create a role, optionally extending a parent role """
         role = Role(handle=handle, title=title, description=description)
+        role.parent = parent
         schema = RoleSchema()
         valid = schema.process(role)
         if not valid:
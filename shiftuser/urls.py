@@ -35,6 +35,10 @@ user_urls['/user/recover-password/sent/'] = route('shiftuser.views.RecoverPasswo
 user_urls['/user/recover-password/expired/'] = route('shiftuser.views.RecoverPasswordExpired', 'user.recover.password.expired')
 user_urls['/user/recover-password/<link>/'] = route('shiftuser.views.RecoverPassword', 'user.recover.password.link', ['GET', 'POST'])
 
+# api tokens
+user_urls['/api/token/refresh/'] = route('shiftuser.views.RefreshToken', 'user.api.token.refresh', ['POST'])
+user_urls['/.well-known/jwks.json'] = route('shiftuser.views.Jwks', 'user.api.jwks')
+
 
 # profile
 user_urls['/me/'] = route('shiftuser.views_profile.Me', 'user.me')
@@ -1,21 +1,40 @@
+import time
 import datetime
+import hashlib
+import secrets
+import threading
+import uuid
 import jwt
 from werkzeug.utils import import_string
+from sqlalchemy.orm import joinedload
 from flask import current_app
 from flask import render_template
 from flask import has_request_context
+from flask import g
+from flask import request
 from flask import current_app
 from flask_mail import Message
 from flask_principal import identity_changed
-from flask_principal import Identity
 from flask_principal import AnonymousIdentity
+from shiftschema.result import Error
 
 from boiler.feature.orm import db
 from boiler.feature.mail import mail
 from boiler.abstract.abstract_service import AbstractService
-from shiftuser.models import User, RegisterSchema, UpdateSchema
+from shiftuser.models import User, UserToken, RegisterSchema, UpdateSchema
+from shiftuser.models import permission_registry, role_hierarchy
 from shiftuser import events, exceptions as x
 from shiftuser import event_handlers # required to connect handlers
+from shiftuser.validators import UniqueEmail
+from shiftuser.util.passlib import get_context
+from shiftuser.util.hashing import HashingPool, hash_passwords
+from shiftuser.util.limiter import ConcurrencyLimiter
+from shiftuser.util.token_versions import TokenVersions
+from shiftuser.util.keyring import Keyring
+from shiftuser.util.revocation import RevocationStore
+from shiftuser.util.principal import AuthenticatedUser, UserIdentity
+from shiftuser.util.principal import needs_cache
+from shiftuser.cache import create_cache
 
 
 class UserService(AbstractService):
@@ -41,7 +60,25 @@ class UserService(AbstractService):
         self.jwt_secret = None
         self.jwt_algo = 'HS256'
         self.jwt_lifetime = 60 * 60 * 24 * 1 # days
+        self.jwt_access_lifetime = 60 * 5 # minutes
+        self.jwt_refresh_lifetime = 60 * 60 * 24 * 30 # days
         self.jwt_implementation = None
+        self.jwt_loader_implementation = None
+        self.keyring = Keyring()
+        self.token_implementation = None
+        self.token_loader = None
+        self.jwt_stateless = False
+        self.token_cache = None
+        self.user_cache = None
+        self.lightweight_user = False
+        self.token_versions = TokenVersions(loader=self.load_token_versions)
+        self.revocations = None
+
+        self.hashing_pool = HashingPool()
+        self.password_limiter = ConcurrencyLimiter()
+        self._legacy_hashes = None # unknown until counted
+        self.upgraded_hashes = 0
+        self._hash_stats_lock = threading.Lock()
 
         # initialise from flask app
         if app: self.init(app)
@@ -65,11 +102,84 @@ class UserService(AbstractService):
         self.jwt_secret = cfg.get('USER_JWT_SECRET')
         self.jwt_algo = cfg.get('USER_JWT_ALGO')
         self.jwt_lifetime = cfg.get('USER_JWT_LIFETIME_SECONDS')
+        self.jwt_access_lifetime = cfg.get('USER_JWT_ACCESS_LIFETIME_SECONDS')
+        self.jwt_refresh_lifetime = cfg.get(
+            'USER_JWT_REFRESH_LIFETIME_SECONDS'
+        )
+
+        # parse keys once
+        jwt_keys = cfg.get('USER_JWT_KEYS')
+        if self.jwt_secret or jwt_keys:
+            self.keyring.init(
+                secret=self.jwt_secret,
+                algorithm=self.jwt_algo,
+                keys=jwt_keys,
+                key_id=cfg.get('USER_JWT_KEY_ID')
+            )
+
         self.jwt_implementation = cfg.get('USER_JWT_IMPLEMENTATION')
         self.jwt_loader_implementation = cfg.get(
             'USER_JWT_LOADER_IMPLEMENTATION'
         )
 
+        # resolve custom implementations once
+        self.token_implementation = self.resolve_implementation(
+            self.jwt_implementation,
+            'JWT implementation'
+        )
+        self.token_loader = self.resolve_implementation(
+            self.jwt_loader_implementation,
+            'JWT user loader implementation'
+        )
+
+        self.jwt_stateless = cfg.get('USER_JWT_STATELESS')
+        self.token_versions.init(
+            loader=self.load_token_versions,
+            refresh_interval=cfg.get('USER_JWT_VERSIONS_REFRESH_SECONDS')
+        )
+
+        self.revocations = None
+        revocation_file = cfg.get('USER_REVOCATION_FILE')
+        if revocation_file:
+            self.revocations = RevocationStore(
+                revocation_file,
+                capacity=cfg.get('USER_REVOCATION_CAPACITY')
+            )
+
+        self.token_cache = None
+        token_cache_size = cfg.get('USER_JWT_CACHE_SIZE')
+        if token_cache_size:
+            self.token_cache = create_cache(
+                cfg.get('USER_CACHE_BACKEND'),
+                namespace='token',
+                max_size=token_cache_size,
+                ttl=cfg.get('USER_JWT_CACHE_TTL'),
+                path=cfg.get('USER_CACHE_PATH')
+            )
+
+        self.user_cache = None
+        user_cache_size = cfg.get('USER_SESSION_CACHE_SIZE')
+        if user_cache_size:
+            self.user_cache = create_cache(
+                cfg.get('USER_CACHE_BACKEND'),
+                namespace='user',
+                max_size=user_cache_size,
+                ttl=cfg.get('USER_SESSION_CACHE_TTL'),
+                path=cfg.get('USER_CACHE_PATH')
+            )
+
+        self.lightweight_user = cfg.get('USER_LIGHTWEIGHT_USER')
+        roles_refresh = cfg.get('USER_ROLES_REFRESH_SECONDS')
+        role_hierarchy.refresh_interval = roles_refresh
+        permission_registry.refresh_interval = roles_refresh
+
+        self.hashing_pool.init(cfg.get('USER_HASHING_THREADS'))
+        self.password_limiter.init(
+            limit=cfg.get('USER_LOGIN_CONCURRENCY'),
+            queue_size=cfg.get('USER_LOGIN_QUEUE_SIZE'),
+            timeout=cfg.get('USER_LOGIN_QUEUE_TIMEOUT'),
+        )
+
     def save(self, user, commit=True):
         """ Persist user and emit event """
         self.is_instance(user)
@@ -82,6 +192,7 @@ class UserService(AbstractService):
         db.session.add(user)
         if commit:
             db.session.commit()
+            self.count_upgraded_hash(user)
 
         events.user_save_event.send(user)
         return user
@@ -91,23 +202,179 @@ class UserService(AbstractService):
         events.user_delete_event.send(user)
         return super().delete(user, commit)
 
+    def load_user(self, id):
+        """
+        Load user
+        Used by login manager to load user from session. Loads user along
+        with roles in a single query, as roles are needed to provide
+        principal needs on every request. Within a request the result is
+        memoized in flask.g, so repeated loads are free. If user cache is
+        enabled, snapshots of loaded users with their roles are cached
+        between requests and served without querying the database.
+
+        :param id: int or str, user id
+        :return: shiftuser.models.User or None
+        """
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None
+
+        memo = None
+        if has_request_context():
+            memo = g.setdefault('shiftuser_users', dict())
+            if id in memo:
+                return memo[id]
+
+        user = None
+        if self.user_cache is not None:
+            snapshot = self.user_cache.get(self.user_cache_key(id))
+            if snapshot is not None:
+                user = User.from_snapshot(snapshot)
+
+        if user is None:
+            query = User.query.options(joinedload(User._roles))
+            user = query.filter(User.id == id).first()
+            if user and self.user_cache is not None:
+                snapshot = user.snapshot(roles=True)
+                self.user_cache.set(self.user_cache_key(id), snapshot)
+
+        if memo is not None:
+            memo[id] = user
+
+        return user
+
+    def load_authenticated_user(self, id):
+        """
+        Load authenticated user
+        Used by login manager instead of load_user in lightweight user mode.
+        Returns a compact authenticated user object, memoized per request.
+        If user cache is enabled, its values are cached between requests,
+        so that loading it needs neither a query nor a user entity. The
+        entity itself is only loaded if a view asks for it. Needs and
+        permission mask are not cached, as cache may be shared with other
+        processes, and are resolved from roles instead.
+
+        :param id: int or str, user id
+        :return: shiftuser.util.principal.AuthenticatedUser or None
+        """
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None
+
+        memo = None
+        if has_request_context():
+            memo = g.setdefault('shiftuser_authenticated', dict())
+            if id in memo:
+                return memo[id]
+
+        user = None
+        values = None
+        if self.user_cache is not None:
+            values = self.user_cache.get(self.authenticated_cache_key(id))
+        if values is not None:
+            email, roles, locked_until = values
+            user = AuthenticatedUser(
+                id=id,
+                email=email,
+                roles=roles,
+                needs=needs_cache.for_roles(roles),
+                permission_mask=permission_registry.roles_mask(roles),
+                locked_until=locked_until,
+                loader=self.load_user
+            )
+        else:
+            entity = self.load_user(id)
+            if entity:
+                user = self.authenticated_user(entity)
+            if user and self.user_cache is not None:
+                values = (user.email, user.roles, user.locked_until)
+                self.user_cache.set(self.authenticated_cache_key(id), values)
+
+        if memo is not None:
+            memo[id] = user
+
+        return user
+
+    def authenticated_user(self, user):
+        """
+        Authenticated user
+        Turns user entity into authenticated user object.
+        :param user: shiftuser.models.User
+        :return: shiftuser.util.principal.AuthenticatedUser
+        """
+        return AuthenticatedUser.from_user(user, loader=self.load_user)
+
+    def user_cache_key(self, user_id):
+        """ Get user cache key """
+        return 'user:{}'.format(user_id)
+
+    def authenticated_cache_key(self, user_id):
+        """ Get authenticated user cache key """
+        return 'authenticated:{}'.format(user_id)
+
+    def invalidate_user_cache(self, user_id=None):
+        """
+        Invalidate user cache
+        Drops cached snapshot of a user, or of all users if no id given
+        (e.g. when a role changes).
+        :param user_id: int or None
+        :return: None
+        """
+        if self.user_cache is None:
+            return
+
+        if user_id is None:
+            self.user_cache.clear()
+        else:
+            self.user_cache.delete(self.user_cache_key(user_id))
+            self.user_cache.delete(self.authenticated_cache_key(user_id))
+
     # -------------------------------------------------------------------------
     # Login and logout
     # -------------------------------------------------------------------------
 
     def login(self, email=None, password=None, remember=False):
         """ Authenticate user and emit event. """
-        from flask_login import login_user
         user = self.first(email=email)
         if user is None:
             events.login_failed_nonexistent_event.send()
             return False
 
         # verify password first
-        verified = user.verify_password(password)
+        verified = self.verify_password(user, password)
+        return self.complete_login(user, verified, remember)
+
+    async def login_async(self, email=None, password=None, remember=False):
+        """
+        Login async
+        Same as login, but awaits password verification on hashing pool
+        instead of blocking. Use this from async views.
+        """
+        user = self.first(email=email)
+        if user is None:
+            events.login_failed_nonexistent_event.send()
+            return False
+
+        # verify password first
+        verified = await self.verify_password_async(user, password)
+        return self.complete_login(user, verified, remember)
+
+    def complete_login(self, user, verified, remember=False):
+        """
+        Complete login
+        Finishes login after password verification: counts failed attempts,
+        checks account locks and email confirmation, then logs user in.
+
+        :param user: shiftuser.models.User
+        :param verified: bool, password verification result
+        :param remember: bool, remember user
+        :return: bool
+        """
+        from flask_login import login_user
         if not verified:
-            user.increment_failed_logins()
-            self.save(user)
+            self.record_failed_login(user)
             events.login_failed_event.send(user)
             return False
 
@@ -128,11 +395,49 @@ class UserService(AbstractService):
 
         # notify principal
         app = current_app._get_current_object()
-        identity_changed.send(app, identity=Identity(user.id))
+        identity_changed.send(app, identity=UserIdentity(user.id))
 
         # and return
         return True
 
+    def record_failed_login(self, user):
+        """
+        Record failed login
+        Counts a failed login and locks account on reaching the limit with
+        a single conditional update in the database, so that concurrent
+        attempts are all counted. This works the same as
+        User.increment_failed_logins, but without read-modify-write. Counter
+        and lock on the entity get reloaded on next access.
+
+        :param user: shiftuser.models.User
+        :return: None
+        """
+        table = User.__table__
+        failed_logins = table.c.failed_logins
+        limit_reached = failed_logins >= User.failed_login_limit
+        lock_period = datetime.timedelta(minutes=User.failed_login_lock_minutes)
+        locked_until = datetime.datetime.utcnow() + lock_period
+
+        # lock goes first, as some databases apply assignments in order
+        statement = table.update(preserve_parameter_order=True).where(
+            table.c.id == user.id
+        ).values([
+            (table.c.locked_until, db.case(
+                [(limit_reached, locked_until)],
+                else_=table.c.locked_until
+            )),
+            (failed_logins, db.case(
+                [(limit_reached, 0)],
+                else_=db.func.coalesce(failed_logins, 0) + 1
+            )),
+        ])
+
+        db.session.execute(statement)
+        db.session.commit()
+        if user in db.session:
+            db.session.expire(user, ['failed_logins', 'locked_until'])
+        events.user_save_event.send(user)
+
     def force_login(self, user):
         """ Force login a user without credentials """
         from flask_login import login_user
@@ -153,7 +458,7 @@ class UserService(AbstractService):
 
         # notify principal
         app = current_app._get_current_object()
-        identity_changed.send(app, identity=Identity(user.id))
+        identity_changed.send(app, identity=UserIdentity(user.id))
 
         # and return
         return True
@@ -175,6 +480,158 @@ class UserService(AbstractService):
 
         return True
 
+    # -------------------------------------------------------------------------
+    # Password hashing
+    # -------------------------------------------------------------------------
+
+    def hash_password(self, password):
+        """
+        Hash password
+        Hashes password on hashing pool if one is configured.
+        :param password: str, password to hash
+        :return: str, password hash
+        """
+        return self.hashing_pool.run(get_context().hash, str(password))
+
+    def hash_passwords_bulk(self, passwords, workers=None):
+        """
+        Hash passwords in bulk
+        Spreads hashing of many passwords across a process pool sized to the
+        machine. Use this for migrations, seeding and tests rather than
+        hashing one user at a time.
+
+        :param passwords: list, passwords to hash
+        :param workers: int or None, number of processes (cpu count default)
+        :return: list, password hashes in input order
+        """
+        cfg = current_app.config
+        settings = dict(
+            PASSLIB_ALGO=cfg.get('PASSLIB_ALGO'),
+            PASSLIB_SCHEMES=cfg.get('PASSLIB_SCHEMES'),
+            PASSLIB_ROUNDS=cfg.get('PASSLIB_ROUNDS'),
+        )
+        return hash_passwords(passwords, settings, workers)
+
+    def verify_password(self, user, password):
+        """
+        Verify password
+        Verifies password against user's password hash on hashing pool if
+        one is configured. The hash is read here, on the calling thread, so
+        that pool threads never touch the ORM entity. Concurrent
+        verifications are admitted through password limiter.
+
+        :param user: shiftuser.models.User
+        :param password: str, password to verify
+        :return: bool
+        :raises: shiftuser.exceptions.LoginOverloaded
+        """
+        if user.password is None:
+            return False
+
+        with self.password_limiter.slot():
+            verified, new_hash = self.hashing_pool.run(
+                get_context().verify_and_update,
+                str(password),
+                user.password
+            )
+
+        return self.upgrade_password_hash(user, verified, new_hash)
+
+    async def verify_password_async(self, user, password):
+        """
+        Verify password async
+        Awaitable version of password verification that runs off the
+        event loop.
+
+        :param user: shiftuser.models.User
+        :param password: str, password to verify
+        :return: bool
+        :raises: shiftuser.exceptions.LoginOverloaded
+        """
+        if user.password is None:
+            return False
+
+        async with self.password_limiter.slot_async():
+            verified, new_hash = await self.hashing_pool.run_async(
+                get_context().verify_and_update,
+                str(password),
+                user.password
+            )
+
+        return self.upgrade_password_hash(user, verified, new_hash)
+
+    def upgrade_password_hash(self, user, verified, new_hash):
+        """
+        Upgrade password hash
+        Puts a fresh hash produced during verification in place of a legacy
+        one (deprecated scheme or outdated cost). This is not persisted
+        here: login saves the user anyway, so the new hash rides on that
+        write without a second hash computation or an extra query. It only
+        gets counted once saved.
+
+        :param user: shiftuser.models.User
+        :param verified: bool, verification result
+        :param new_hash: str or None, replacement hash
+        :return: bool, verification result
+        """
+        if verified and new_hash:
+            user.upgrade_password_hash(new_hash)
+        return verified
+
+    def count_upgraded_hash(self, user):
+        """
+        Count upgraded hash
+        Updates hash upgrade counters if user was saved with an upgraded
+        password hash.
+        :param user: shiftuser.models.User
+        :return: None
+        """
+        if not user.pop_password_upgrade():
+            return
+
+        with self._hash_stats_lock:
+            self.upgraded_hashes += 1
+            if self._legacy_hashes:
+                self._legacy_hashes -= 1
+
+    def count_legacy_hashes(self):
+        """
+        Count legacy hashes
+        Scans stored password hashes and counts the ones still needing an
+        upgrade. The result is kept in legacy_hashes and decremented as
+        hashes get upgraded on login.
+
+        :return: int
+        """
+        context = get_context()
+        query = db.session.query(User._password)
+        query = query.filter(User._password.isnot(None))
+
+        count = 0
+        for hash, in query.yield_per(1000):
+            try:
+                legacy = context.needs_update(hash)
+            except ValueError:
+                legacy = True  # unknown hash format
+            if legacy:
+                count += 1
+
+        with self._hash_stats_lock:
+            self._legacy_hashes = count
+        return count
+
+    @property
+    def legacy_hashes(self):
+        """
+        Legacy hashes
+        Returns number of stored hashes still needing an upgrade. These
+        are counted on first access and tracked as they get upgraded.
+        :return: int
+        """
+        if self._legacy_hashes is None:
+            self.count_legacy_hashes()
+        return self._legacy_hashes
+
     # -------------------------------------------------------------------------
     # JWT tokens
     # -------------------------------------------------------------------------
@@ -183,28 +640,262 @@ class UserService(AbstractService):
         """
         Decode token
         A shorthand method to decode JWT token. Will return the payload as a
-        dictionary
+        dictionary. Verification key is selected from keyring by kid header.
         :return: str, token
         :return: dict
         """
-        return jwt.decode(
-            token,
-            self.jwt_secret,
-            algorithms=[self.jwt_algo]
+        return self.keyring.decode(token)
+
+    def encode_token(self, user, expires=None, token_type=None):
+        """
+        Encode token
+        Creates a new signed token for the user. The token will contain
+        user_id, expiration date and a unique jti. In stateless mode it also
+        gets user's current token version.
+
+        :param user: shiftuser.models.User
+        :param expires: datetime or None, defaults to now plus jwt lifetime
+        :param token_type: str or None, put into type claim if given
+        :return: str, token
+        """
+        return self.encode_user_token(
+            user.id,
+            token_version=user.token_version,
+            expires=expires,
+            token_type=token_type
         )
 
-    def revoke_user_token(self, user_id):
+    def encode_user_token(
+        self,
+        user_id,
+        token_version=None,
+        expires=None,
+        token_type=None):
+        """
+        Encode user token
+        Same as encode_token, but takes user id and token version, so that
+        tokens can be issued without loading user entity.
+
+        :param user_id: int, user id
+        :param token_version: int or None, user token version
+        :param expires: datetime or None, defaults to now plus jwt lifetime
+        :param token_type: str or None, put into type claim if given
+        :return: str, token
+        """
+        if expires is None:
+            from_now = datetime.timedelta(seconds=self.jwt_lifetime)
+            expires = datetime.datetime.utcnow() + from_now
+
+        issued = datetime.datetime.utcnow()
+        not_before = datetime.datetime.utcnow()
+        data = dict(
+            exp=expires,
+            nbf=not_before,
+            iat=issued,
+            jti=uuid.uuid4().hex,
+            user_id=user_id
+        )
+        if token_type:
+            data['type'] = token_type
+        if self.jwt_stateless:
+            data['token_version'] = token_version or 0
+
+        return self.keyring.encode(data)
+
+    def revoke_user_token(self, user_id, device=None):
         """
         Revoke user token
-        Erases user token on file forcing them to re-login and obtain a new one.
+        Deletes user tokens on file forcing them to re-login and obtain a new
+        one. Revokes tokens from all devices, unless a device is given. In
+        stateless mode bumps user token version instead, which revokes all
+        tokens issued so far. If revocation store is configured, the revoked
+        version goes there too, so that other workers on the host see it
+        before their token versions map gets refreshed.
+
         :param user_id: int
+        :param device: str or None, revoke only tokens of this device
         :return:
         """
-        user = self.get(user_id)
-        user._token = None
-        self.save(user)
+        if self.jwt_stateless:
+            # store first, so that a full store fails before anything commits
+            revoked_version = self.get_token_version(user_id)
+            if self.revocations is not None:
+                self.revocations.add(
+                    self.version_revocation_key(user_id, revoked_version),
+                    time.time() + self.max_token_lifetime()
+                )
+
+            User.query.filter(User.id == user_id).update(
+                {
+                    User.token_version: User.token_version + 1,
+                    User.token_version_changed: db.func.now(),
+                },
+                synchronize_session=False
+            )
+            db.session.commit()
+            self.invalidate_token_cache(user_id)
+            self.token_versions.refresh()
+            return
+
+        query = UserToken.query.filter(UserToken.user_id == user_id)
+        if device is not None:
+            query = query.filter(UserToken.device == device)
+
+        query.delete(synchronize_session=False)
+        db.session.commit()
+        self.invalidate_token_cache(user_id)
+
+    def revoke_token(self, token):
+        """
+        Revoke token
+        Revokes a single token. Tokens on file are deleted. Tokens that are
+        not on file (stateless and access tokens) are put to revocation
+        store by jti until they expire, which requires the store to be
+        configured.
+
+        :param token: str, token to revoke
+        :return: None
+        :raises: shiftuser.exceptions.ConfigurationException
+        """
+        try:
+            data = self.decode_token(token)
+        except jwt.exceptions.DecodeError as e:
+            raise x.JwtDecodeError(str(e))
+        except jwt.ExpiredSignatureError:
+            return  # nothing to revoke
+
+        access = data.get('type') == UserToken.KIND_ACCESS
+        if self.revocations is None and (self.jwt_stateless or access):
+            msg = 'Revoking tokens that are not on file requires '
+            msg += 'USER_REVOCATION_FILE'
+            raise x.ConfigurationException(msg)
+
+        if self.revocations is not None and data.get('jti'):
+            self.revocations.add(
+                self.jti_revocation_key(data['jti']),
+                data['exp']
+            )
+
+        UserToken.query.filter(
+            UserToken.token_hash == UserToken.hash(token)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        self.invalidate_token_cache(data['user_id'])
 
-    def get_token(self, user_id):
+    def jti_revocation_key(self, jti):
+        """ Get revocation store key for a token id """
+        return 'jti:{}'.format(jti)
+
+    def version_revocation_key(self, user_id, version):
+        """ Get revocation store key for user token version """
+        return 'user:{}:{}'.format(user_id, version)
+
+    def max_token_lifetime(self):
+        """ Get lifetime of the longest living JWT tokens issued """
+        return max(self.jwt_lifetime, self.jwt_access_lifetime)
+
+    def is_token_revoked(self, claims):
+        """
+        Is token revoked?
+        Checks decoded token against revocation store. Returns False if
+        revocation store is not configured.
+
+        :param claims: dict, decoded token
+        :return: bool
+        """
+        if self.revocations is None:
+            return False
+
+        jti = claims.get('jti')
+        if jti and self.revocations.is_revoked(self.jti_revocation_key(jti)):
+            return True
+
+        version = claims.get('token_version')
+        if version is not None:
+            key = self.version_revocation_key(claims['user_id'], version)
+            return self.revocations.is_revoked(key)
+
+        return False
+
+    def prune_expired_tokens(self, user_id=None):
+        """
+        Prune expired tokens
+        Deletes expired tokens on file, either for all users or just one.
+        :param user_id: int or None
+        :return: int, number of deleted tokens
+        """
+        now = datetime.datetime.utcnow()
+        query = UserToken.query.filter(UserToken.expires <= now)
+        if user_id is not None:
+            query = query.filter(UserToken.user_id == user_id)
+
+        deleted = query.delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+    def get_token_version(self, user_id):
+        """
+        Get token version
+        Reads user token version without loading user entity.
+        :param user_id: int, user id
+        :return: int or None if no such user
+        """
+        query = db.session.query(User.token_version)
+        return query.filter(User.id == user_id).scalar()
+
+    def load_token_versions(self, since=None):
+        """
+        Load token versions
+        Loader for in-memory token versions map. Returns versions of users
+        that ever had tokens revoked, or only the ones changed since a given
+        time.
+
+        :param since: datetime or None, last seen change
+        :return: list of tuples (user_id, version, changed)
+        """
+        query = db.session.query(
+            User.id,
+            User.token_version,
+            User.token_version_changed
+        )
+        if since is None:
+            query = query.filter(User.token_version > 0)
+        else:
+            query = query.filter(User.token_version_changed >= since)
+
+        return query.all()
+
+    def resolve_implementation(self, implementation, name):
+        """
+        Resolve implementation
+        Imports custom implementation from an importable string and checks
+        that it is callable. Used at init, so that misconfiguration fails
+        at startup rather than on first request.
+
+        :param implementation: str, callable or None
+        :param name: str, implementation name for error messages
+        :return: callable or None
+        """
+        if not implementation:
+            return None
+
+        if callable(implementation):
+            return implementation
+
+        try:
+            resolved = import_string(implementation)
+        except ImportError:
+            msg = 'Failed to import custom {}. '
+            msg += 'Check that configured module exists [{}]'
+            raise x.ConfigurationException(msg.format(name, implementation))
+
+        if not callable(resolved):
+            msg = 'Custom {} must be callable [{}]'
+            raise x.ConfigurationException(msg.format(name, implementation))
+
+        return resolved
+
+    def get_token(self, user_id, device=None):
         """
         Get user token
         Checks if a custom token implementation is registered and uses that.
@@ -212,20 +903,14 @@ class UserService(AbstractService):
         token on success.
 
         :param user_id: int, user id
+        :param device: str or None, device name (default implementation only)
         :return: str
         """
-        if not self.jwt_implementation:
-            return self.default_token_implementation(user_id)
-
-        try:
-            implementation = import_string(self.jwt_implementation)
-        except ImportError:
-            msg = 'Failed to import custom JWT implementation. '
-            msg += 'Check that configured module exists [{}]'
-            raise x.ConfigurationException(msg.format(self.jwt_implementation))
+        if not self.token_implementation:
+            return self.default_token_implementation(user_id, device=device)
 
         # return custom token
-        return implementation(user_id)
+        return self.token_implementation(user_id)
 
     def get_user_by_token(self, token):
         """
@@ -238,22 +923,13 @@ class UserService(AbstractService):
         :param token: str, user token
         :return: shiftuser.models.User
         """
-        if not self.jwt_loader_implementation:
+        if not self.token_loader:
             return self.default_token_user_loader(token)
 
-        try:
-            implementation = import_string(self.jwt_loader_implementation)
-        except ImportError:
-            msg = 'Failed to import custom JWT user loader implementation. '
-            msg += 'Check that configured module exists [{}]'
-            raise x.ConfigurationException(
-                msg.format(self.jwt_loader_implementation)
-            )
-
         # return user from custom loader
-        return implementation(token)
+        return self.token_loader(token)
 
-    def default_token_implementation(self, user_id):
+    def default_token_implementation(self, user_id, device=None):
         """
         Default JWT token implementation
         This is used by default for generating user tokens if custom
@@ -261,60 +937,341 @@ class UserService(AbstractService):
         expiration date. If you need more information added to the token,
         register your custom implementation.
 
-        It will load a user to see if token is already on file. If it is, the
-        existing token will be checked for expiration and returned if valid.
-        Otherwise a new token will be generated and persisted. This can be used
-        to perform token revocation.
+        Every call issues a new token and puts its digest on file along with
+        device metadata, so a user can be logged in from several devices at
+        once. A new token for a named device replaces the one that device
+        had before. Deleting tokens on file revokes them. In stateless mode
+        nothing is persisted.
+
+        Issuing doesn't load or save the user: token goes on file with a
+        single INSERT that only succeeds if the user exists, and expiration
+        is kept in an indexed column, so tokens never need to be decoded to
+        find the expired ones.
 
         :param user_id: int, user id
+        :param device: str or None, device name
         :return: string
         """
+        from_now = datetime.timedelta(seconds=self.jwt_lifetime)
+        expires = datetime.datetime.utcnow() + from_now
+
+        # stateless tokens are not stored
+        if self.jwt_stateless:
+            version = self.get_token_version(user_id)
+            if version is None:
+                msg = 'No user with such id [{}]'
+                raise x.JwtNoUser(msg.format(user_id))
+
+            return self.encode_user_token(user_id, version, expires)
+
+        token = self.encode_user_token(user_id, expires=expires)
+        stored = self.store_token(
+            user_id,
+            token,
+            UserToken.KIND_ACCESS,
+            expires,
+            device
+        )
+        if not stored:
+            msg = 'No user with such id [{}]'
+            raise x.JwtNoUser(msg.format(user_id))
+
+        return token
+
+    def store_token(self, user_id, token, kind, expires, device=None):
+        """
+        Store token
+        Puts digest of an issued token on file along with device metadata
+        taken from current request, if any. Drops user's expired tokens and
+        the token of the same kind the device had before. Token is inserted
+        from a select on user table, so nothing gets stored for a user that
+        doesn't exist.
+
+        :param user_id: int, user id
+        :param token: str, issued token
+        :param kind: str, token kind
+        :param expires: datetime, token expiration
+        :param device: str or None, device name
+        :return: bool, whether token was stored
+        """
+        now = datetime.datetime.utcnow()
+        stale = UserToken.query.filter(UserToken.user_id == user_id)
+        if device is not None:
+            stale = stale.filter(db.or_(
+                db.and_(UserToken.device == device, UserToken.kind == kind),
+                UserToken.expires <= now
+            ))
+        else:
+            stale = stale.filter(UserToken.expires <= now)
+        stale.delete(synchronize_session=False)
+
+        user_agent = None
+        ip = None
+        if has_request_context():
+            user_agent = request.headers.get('User-Agent')
+            user_agent = user_agent[:256] if user_agent else None
+            ip = request.remote_addr
+
+        values = dict(
+            token_hash=UserToken.hash(token),
+            kind=kind,
+            created=now,
+            expires=expires,
+            device=device,
+            user_agent=user_agent,
+            ip=ip,
+        )
+        table = UserToken.__table__
+        columns = [User.id.label('user_id')]
+        for name, value in values.items():
+            column = db.literal(value, type_=table.c[name].type)
+            columns.append(column.label(name))
+
+        select = db.select(columns).where(User.id == user_id)
+        insert = table.insert().from_select(
+            ['user_id'] + list(values.keys()),
+            select
+        )
+        result = db.session.execute(insert)
+        db.session.commit()
+        return result.rowcount > 0
+
+    def get_tokens(self, user_ids, device=None, chunk_size=1000):
+        """
+        Get tokens
+        Mints tokens for many users at once, e.g. for service accounts or
+        load tests. Users are loaded in chunks with one query per chunk,
+        tokens of a chunk are put on file with a single executemany insert,
+        and (user_id, token) pairs are streamed back as soon as a chunk is
+        committed. Ids of users that don't exist are skipped. If a custom
+        token implementation is configured, it is called for every user.
+
+        :param user_ids: iterable, user ids
+        :param device: str or None, device name (replaces device tokens)
+        :param chunk_size: int, users per query and insert
+        :return: generator of (user_id, token) tuples
+        """
+        user_ids = list(user_ids)
+        if self.token_implementation:
+            for user_id in user_ids:
+                yield user_id, self.token_implementation(user_id)
+            return
+
+        table = UserToken.__table__
+        for offset in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[offset:offset + chunk_size]
+            users = db.session.query(User.id, User.token_version)
+            users = users.filter(User.id.in_(chunk)).all()
+            versions = dict(users)
+
+            now = datetime.datetime.utcnow()
+            from_now = datetime.timedelta(seconds=self.jwt_lifetime)
+            expires = now + from_now
+            tokens = []
+            for user_id in chunk:
+                if user_id not in versions:
+                    continue
+                token = self.encode_user_token(
+                    user_id,
+                    token_version=versions[user_id],
+                    expires=expires
+                )
+                tokens.append((user_id, token))
+
+            if tokens and not self.jwt_stateless:
+                if device is not None:
+                    UserToken.query.filter(
+                        UserToken.user_id.in_(versions.keys()),
+                        UserToken.device == device,
+                        UserToken.kind == UserToken.KIND_ACCESS
+                    ).delete(synchronize_session=False)
+
+                rows = [dict(
+                    token_hash=UserToken.hash(token),
+                    kind=UserToken.KIND_ACCESS,
+                    user_id=user_id,
+                    created=now,
+                    expires=expires,
+                    device=device,
+                ) for user_id, token in tokens]
+                db.session.execute(table.insert(), rows)
+                db.session.commit()
+
+            for pair in tokens:
+                yield pair
+
+    def issue_token_pair(self, user_id, device=None):
+        """
+        Issue token pair
+        Issues a short-lived access token along with a refresh token. Access
+        tokens are not stored and are validated by signature alone, so using
+        them needs no token lookup. Refresh tokens are opaque random strings
+        stored as digests, and are exchanged for a new pair once access token
+        expires.
+
+        :param user_id: int, user id
+        :param device: str or None, device name
+        :return: dict
+        """
         user = self.get(user_id)
         if not user:
             msg = 'No user with such id [{}]'
             raise x.JwtNoUser(msg.format(user_id))
 
-        # return token if exists and valid
-        if user._token:
-            try:
-                self.decode_token(user._token)
-                return user._token
-            except jwt.exceptions.ExpiredSignatureError:
-                pass
+        return self.create_token_pair(user, device)
 
-        from_now = datetime.timedelta(seconds=self.jwt_lifetime)
-        expires = datetime.datetime.utcnow() + from_now
-        issued = datetime.datetime.utcnow()
-        not_before = datetime.datetime.utcnow()
-        data = dict(
-            exp=expires,
-            nbf=not_before,
-            iat=issued,
-            user_id=user_id
+    def create_token_pair(self, user, device=None):
+        """
+        Create token pair
+        Encodes access token and puts a new refresh token on file.
+        :param user: shiftuser.models.User
+        :param device: str or None, device name
+        :return: dict
+        """
+        now = datetime.datetime.utcnow()
+        access_expires = now + datetime.timedelta(
+            seconds=self.jwt_access_lifetime
+        )
+        refresh_expires = now + datetime.timedelta(
+            seconds=self.jwt_refresh_lifetime
+        )
+
+        access_token = self.encode_token(
+            user,
+            expires=access_expires,
+            token_type=UserToken.KIND_ACCESS
+        )
+        refresh_token = secrets.token_urlsafe(32)
+        self.store_token(
+            user.id,
+            refresh_token,
+            UserToken.KIND_REFRESH,
+            refresh_expires,
+            device
+        )
+
+        return dict(
+            access_token=access_token,
+            refresh_token=refresh_token,
+            token_type='Bearer',
+            expires_in=self.jwt_access_lifetime,
         )
-        token = jwt.encode(data, self.jwt_secret, algorithm=self.jwt_algo)
-        user._token = token
-        self.save(user)
-        return token
+
+    def refresh_token_pair(self, refresh_token):
+        """
+        Refresh token pair
+        Exchanges a refresh token for a new token pair. The refresh token is
+        rotated: it gets deleted and can not be used again. If two requests
+        race to use the same refresh token, only one of them succeeds.
+
+        :param refresh_token: str, refresh token
+        :return: dict
+        """
+        user_token = UserToken.query.filter(
+            UserToken.token_hash == UserToken.hash(refresh_token),
+            UserToken.kind == UserToken.KIND_REFRESH
+        ).first()
+        if not user_token:
+            msg = 'The refresh token does not match our records'
+            raise x.JwtTokenMismatch(msg)
+
+        if user_token.is_expired():
+            raise x.JwtExpired('Refresh token expired')
+
+        # rotate, only one concurrent request gets to delete the token
+        user = user_token.user
+        device = user_token.device
+        rotated = UserToken.query.filter(
+            UserToken.id == user_token.id
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        if not rotated:
+            msg = 'The refresh token does not match our records'
+            raise x.JwtTokenMismatch(msg)
+
+        if user.is_locked():
+            msg = 'This account is locked'
+            raise x.AccountLocked(msg, locked_until=user.locked_until)
+
+        if self.require_confirmation and not user.email_confirmed:
+            msg = 'Please confirm your email address [{}]'
+            raise x.EmailNotConfirmed(
+                msg.format(user.email_secure),
+                email=user.email
+            )
+
+        return self.create_token_pair(user, device)
 
     def default_token_user_loader(self, token):
         """
         Default token user loader
         Accepts a token and decodes it checking signature and expiration. Then
-        loads user by id from the token to see if account is not locked. If
-        all is good, returns user record, otherwise throws an exception.
+        loads user by token digest on file to see if token was not revoked
+        and account is not locked. If all is good, returns user record,
+        otherwise throws an exception. Short-lived access tokens are not on
+        file and are only checked for signature and expiration.
+
+        If token cache is enabled, decoded claims and user snapshot are
+        cached, so that repeated requests with the same token skip both
+        decoding and the user query. Tokens on file are still checked to be
+        on file with a single indexed lookup, so that revoking them in
+        another process takes effect at once. In stateless mode there's no
+        token on file to look up, instead token version claim is checked
+        against in-memory map of current versions. Together with the cache
+        this makes repeated requests free of database round trips.
 
         :param token: str, token string
         :return: shiftuser.models.User
         """
-        try:
-            data = self.decode_token(token)
-        except jwt.exceptions.DecodeError as e:
-            raise x.JwtDecodeError(str(e))
-        except jwt.ExpiredSignatureError as e:
-            raise x.JwtExpired(str(e))
+        cached = self.get_cached_token(token)
+        if cached:
+            data = cached['claims']
+        else:
+            try:
+                data = self.decode_token(token)
+            except jwt.exceptions.DecodeError as e:
+                raise x.JwtDecodeError(str(e))
+            except jwt.ExpiredSignatureError as e:
+                raise x.JwtExpired(str(e))
+
+        # revoked on this host
+        if self.is_token_revoked(data):
+            raise x.JwtTokenMismatch('The token was revoked')
+
+        # stateless tokens are revoked by bumping user token version
+        if self.jwt_stateless:
+            version = self.token_versions.get(data['user_id'])
+            if data.get('token_version') != version:
+                raise x.JwtTokenMismatch('The token was revoked')
+
+        # access tokens are validated by signature alone
+        access = data.get('type') == UserToken.KIND_ACCESS
+
+        if cached and not (self.jwt_stateless or access):
+            # tokens on file can be revoked by other processes
+            query = db.session.query(UserToken.id).filter(
+                UserToken.token_hash == UserToken.hash(token),
+                UserToken.user_id == data['user_id']
+            )
+            if not db.session.query(query.exists()).scalar():
+                msg = 'The token does not match our records'
+                raise x.JwtTokenMismatch(msg)
+
+        if cached:
+            user = User.from_snapshot(cached['user'])
+        elif self.jwt_stateless or access:
+            user = self.load_user(data['user_id'])
+        else:
+            # load user by token on file, single indexed lookup
+            query = User.query.options(joinedload(User._roles))
+            user = query.join(User._tokens).filter(
+                UserToken.token_hash == UserToken.hash(token),
+                User.id == data['user_id']
+            ).first()
+            if not user and self.get(data['user_id']):
+                msg = 'The token does not match our records'
+                raise x.JwtTokenMismatch(msg)
 
-        user = self.get(data['user_id'])
         if not user:
             msg = 'No user with such id [{}]'
             raise x.JwtNoUser(msg.format(data['user_id']))
@@ -330,13 +1287,92 @@ class UserService(AbstractService):
                 email=user.email
             )
 
-        # test token matches the one on file
-        if not token == user._token:
-            raise x.JwtTokenMismatch('The token does not match our records')
-
         # return on success
+        if not cached:
+            self.cache_token(token, data, user)
         return user
 
+    # -------------------------------------------------------------------------
+    # JWT token cache
+    # -------------------------------------------------------------------------
+
+    def token_cache_key(self, token):
+        """ Get cache key for a token (a digest, not the token itself) """
+        digest = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        return 'jwt:' + digest
+
+    def get_cached_token(self, token):
+        """
+        Get cached token
+        Returns cached claims and user snapshot for a token, or None if not
+        cached or if user tokens were invalidated since it got cached.
+
+        :param token: str, token string
+        :return: dict or None
+        """
+        if self.token_cache is None:
+            return None
+
+        cached = self.token_cache.get(self.token_cache_key(token))
+        if not cached:
+            return None
+
+        user_key = 'jwt-user:{}'.format(cached['claims']['user_id'])
+        if self.token_cache.get(user_key) != cached['version']:
+            return None
+
+        return cached
+
+    def cache_token(self, token, claims, user):
+        """
+        Cache token
+        Puts decoded claims and user snapshot to token cache. Entry will not
+        outlive token expiration. Each user has a version key in the cache,
+        and entries are only valid while it matches, so that all tokens of
+        a user can be invalidated at once.
+
+        :param token: str, token string
+        :param claims: dict, decoded token
+        :param user: shiftuser.models.User
+        :return: None
+        """
+        if self.token_cache is None:
+            return
+
+        ttl = self.token_cache.ttl or None
+        if 'exp' in claims:
+            expires_in = claims['exp'] - time.time()
+            ttl = expires_in if ttl is None else min(ttl, expires_in)
+        if ttl is not None and ttl <= 0:
+            return
+
+        user_key = 'jwt-user:{}'.format(user.id)
+        version = self.token_cache.get(user_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            self.token_cache.set(user_key, version, ttl=0)
+
+        self.token_cache.set(
+            self.token_cache_key(token),
+            dict(claims=claims, user=user.snapshot(roles=True), version=version),
+            ttl=ttl
+        )
+
+    def invalidate_token_cache(self, user_id=None):
+        """
+        Invalidate token cache
+        Drops all cached tokens of a user, or of all users if no id given.
+        :param user_id: int or None
+        :return: None
+        """
+        if self.token_cache is None:
+            return
+
+        if user_id is None:
+            self.token_cache.clear()
+        else:
+            self.token_cache.delete('jwt-user:{}'.format(user_id))
+
     # -------------------------------------------------------------------------
     # Register and confirm
     # -------------------------------------------------------------------------
@@ -344,20 +1380,26 @@ class UserService(AbstractService):
     def register(self, user_data, base_confirm_url='', send_welcome=True):
         """
         Register user
-        Accepts user data, validates it and performs registration. Will send
-        a welcome message with a confirmation link on success.
+        Accepts user data, validates it and performs registration. Password
+        is hashed on hashing pool, only once data is valid. Will send a
+        welcome message with a confirmation link on success.
 
         :param user_data: dic, populate user with data
         :param send_welcome: bool, whether to send welcome or skip it (testing)
         :param base_confirm_url: str, base confirmation link url
         :return: shiftuser.models.User
         """
+        user_data = dict(user_data)
+        password = user_data.pop('password', None)
         user = self.__model__(**user_data)
         schema = RegisterSchema()
         valid = schema.process(user)
         if not valid:
             return valid
 
+        if password is not None:
+            user.set_password_hash(self.hash_password(password))
+
         db.session.add(user)
         db.session.commit()
         if not user.id:
@@ -370,6 +1412,48 @@ class UserService(AbstractService):
         events.register_event.send(user)
         return user
 
+    def create_users_bulk(self, users_data, workers=None):
+        """
+        Create users in bulk
+        Creates users from a list of data dicts, hashing their passwords in
+        bulk on a process pool. All users are validated first, including
+        emails repeated within the batch, and nothing is hashed or persisted
+        unless all of them are valid. Does not send welcome messages.
+
+        :param users_data: list, dicts of user data
+        :param workers: int or None, number of hashing processes
+        :return: list of shiftuser.models.User or validation result
+        """
+        users_data = [dict(data) for data in users_data]
+        passwords = [data.pop('password', None) for data in users_data]
+
+        users = []
+        emails = set()
+        for data in users_data:
+            user = self.__model__(**data)
+            valid = RegisterSchema().process(user)
+            if valid and user.email in emails:
+                valid.add_errors('email', Error(UniqueEmail.error))
+            if not valid:
+                return valid
+            emails.add(user.email)
+            users.append(user)
+
+        hashes = iter(self.hash_passwords_bulk(
+            [password for password in passwords if password is not None],
+            workers=workers
+        ))
+        for user, password in zip(users, passwords):
+            if password is not None:
+                user.set_password_hash(next(hashes))
+
+        db.session.add_all(users)
+        db.session.commit()
+        for user in users:
+            events.user_save_event.send(user)
+
+        return users
+
     def send_welcome_message(self, user, base_url, **kwargs):
         """ Send welcome mail with email confirmation link """
         if not self.require_confirmation and not self.welcome_message:
@@ -528,12 +1612,11 @@ class UserService(AbstractService):
         self.send_password_change_message(user, base_url)
 
     def change_password(self, user, new_password):
-        """ Change user password and logout """
+        """ Change user password on hashing pool and logout """
         from shiftuser.models import UpdateSchema
         from flask_login import logout_user
 
         schema = UpdateSchema()
-        user.password = new_password
         user.password_link=None
         user.password_link_expires=None
         valid = schema.validate(user)
@@ -541,6 +1624,8 @@ class UserService(AbstractService):
         if not valid:
             return valid
 
+        user.set_password_hash(self.hash_password(new_password))
+
         db.session.add(user)
         db.session.commit()
 
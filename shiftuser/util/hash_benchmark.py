@@ -0,0 +1,135 @@
+import time
+from statistics import median
+from passlib.registry import get_crypt_handler
+
+"""
+Hash benchmark
+Measures password hashing and verification times for passlib schemes at
+different cost settings on current host and recommends the number of rounds
+that fits into a given latency budget. The result is meant to be used as
+PASSLIB_ROUNDS config setting.
+"""
+
+sample_password = 'correct horse battery staple'
+
+
+def has_rounds(scheme):
+    """
+    Has rounds?
+    Checks whether scheme has a configurable cost (rounds) setting.
+    :param scheme: str, passlib scheme name
+    :return: bool
+    """
+    return 'rounds' in get_crypt_handler(scheme).setting_kwds
+
+
+def measure(scheme, rounds=None, samples=3):
+    """
+    Measure
+    Times hashing and verification for a scheme at given rounds. Returns
+    median times in milliseconds.
+
+    :param scheme: str, passlib scheme name
+    :param rounds: int or None, cost setting (None for scheme default)
+    :param samples: int, number of times to measure
+    :return: dict
+    """
+    handler = get_crypt_handler(scheme)
+    if rounds is not None:
+        handler = handler.using(rounds=rounds)
+
+    hash_times = []
+    verify_times = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hash = handler.hash(sample_password)
+        hash_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        handler.verify(sample_password, hash)
+        verify_times.append(time.perf_counter() - start)
+
+    return dict(
+        scheme=scheme,
+        rounds=rounds,
+        hash_ms=median(hash_times) * 1000,
+        verify_ms=median(verify_times) * 1000,
+    )
+
+
+def benchmark(scheme, target_ms=100, samples=3):
+    """
+    Benchmark
+    Measures scheme at several cost settings and picks the highest number
+    of rounds that verifies within target time. Logarithmic cost schemes
+    (bcrypt) are measured step by step, linear cost schemes are measured at
+    fractions of default rounds and extrapolated. Schemes without a cost
+    setting (md5_crypt) are measured once and get no recommendation.
+
+    :param scheme: str, passlib scheme name
+    :param target_ms: float, latency budget in milliseconds
+    :param samples: int, number of times to measure each setting
+    :return: tuple, (recommended rounds or None, list of measurements)
+    """
+    if not has_rounds(scheme):
+        return None, [measure(scheme, samples=samples)]
+
+    handler = get_crypt_handler(scheme)
+    min_rounds = handler.min_rounds
+    max_rounds = handler.max_rounds
+
+    # logarithmic: each step doubles the cost, stop once over budget
+    if handler.rounds_cost == 'log2':
+        results = []
+        recommended = min_rounds
+        for rounds in range(min_rounds, max_rounds + 1):
+            result = measure(scheme, rounds, samples)
+            results.append(result)
+            if result['verify_ms'] > target_ms:
+                break
+            recommended = rounds
+        return recommended, results
+
+    # linear: measure fractions of default and extrapolate
+    results = []
+    default = handler.default_rounds
+    for fraction in (0.25, 0.5, 1):
+        rounds = max(min_rounds, int(default * fraction))
+        results.append(measure(scheme, rounds, samples))
+
+    per_round = results[-1]['verify_ms'] / results[-1]['rounds']
+    recommended = int(target_ms / per_round) if per_round else max_rounds
+    recommended = min(max(recommended, min_rounds), max_rounds)
+    results.append(measure(scheme, recommended, samples))
+    return recommended, results
+
+
+def write_setting(path, rounds):
+    """
+    Write setting
+    Writes PASSLIB_ROUNDS setting into a config file. An existing setting
+    line gets replaced, otherwise it is appended. Other lines are kept.
+
+    :param path: str, path to config file
+    :param rounds: dict, rounds per scheme
+    :return: str, written setting line
+    """
+    setting = 'PASSLIB_ROUNDS = {}'.format(rounds)
+    try:
+        with open(path) as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+
+    replaced = False
+    for index, line in enumerate(lines):
+        if line.split('=', 1)[0].strip() == 'PASSLIB_ROUNDS':
+            lines[index] = setting
+            replaced = True
+    if not replaced:
+        lines.append(setting)
+
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+    return setting
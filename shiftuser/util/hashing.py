@@ -0,0 +1,168 @@
+import os
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from shiftuser.util.passlib import build_context
+
+"""
+Hashing pool
+Password hashing and verification is deliberately slow and CPU-bound. Running
+it on the request thread blocks a worker for the whole duration of the hash.
+This module provides a bounded thread pool to offload that work to, which
+both caps the number of hashes computed at once and gives async views
+something to await. The bcrypt backend releases the GIL while hashing, so
+the pool threads do run in parallel.
+
+For bulk operations (migrations, seeding) there is also a process pool based
+helper that spreads hashing of many passwords across all cores.
+"""
+
+# crypt context of a bulk hashing worker process
+worker_context = None
+
+
+class HashingPool:
+    """
+    Hashing pool
+    A lazily started, bounded thread pool for password hashing. When pool
+    size is not set, the work is performed inline on the calling thread
+    (sync calls) or on the default loop executor (async calls).
+
+    Submitted callables must not touch ORM entities or the session, as
+    those are not shared between threads. Read whatever you need in the
+    calling thread and pass plain values in.
+    """
+
+    thread_name_prefix = 'shiftuser-hashing'
+
+    def __init__(self, size=None):
+        """
+        Initialize pool
+        :param size: int or None, number of threads (None runs inline)
+        """
+        self.size = size
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def init(self, size=None):
+        """
+        Initialize pool
+        Resize the pool. Any running executor is shut down and a new one
+        will be started on first use.
+
+        :param size: int or None, number of threads (None runs inline)
+        :return: None
+        """
+        self.shutdown(wait=False)
+        self.size = size
+
+    @property
+    def executor(self):
+        """
+        Get executor
+        Starts executor on first use, so that pools created before a fork
+        (e.g. gunicorn with preloading) don't carry dead threads over.
+        :return: concurrent.futures.ThreadPoolExecutor or None
+        """
+        if not self.size:
+            return None
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.size,
+                        thread_name_prefix=self.thread_name_prefix
+                    )
+
+        return self._executor
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Run
+        Run callable on the pool and block until it completes. Runs inline
+        if pool size is not configured.
+
+        :param fn: callable
+        :return: result of the callable
+        """
+        executor = self.executor
+        if executor is None:
+            return fn(*args, **kwargs)
+
+        return executor.submit(fn, *args, **kwargs).result()
+
+    async def run_async(self, fn, *args, **kwargs):
+        """
+        Run async
+        Run callable on the pool and await its result without blocking
+        the event loop.
+
+        :param fn: callable
+        :return: result of the callable
+        """
+        loop = asyncio.get_running_loop()
+        call = partial(fn, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    def shutdown(self, wait=True):
+        """
+        Shutdown
+        Stops pool threads if the pool was started.
+        :param wait: bool, whether to wait for pending work
+        :return: None
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+def init_worker(settings):
+    """
+    Init worker
+    Builds crypt context in a bulk hashing worker process. Workers have no
+    app, so the context is built from passlib settings passed in.
+
+    :param settings: dict, PASSLIB_* config settings
+    :return: None
+    """
+    global worker_context
+    worker_context = build_context(settings)
+
+
+def hash_in_worker(password):
+    """ Hash password with worker crypt context """
+    return worker_context.hash(password)
+
+
+def hash_passwords(passwords, settings, workers=None):
+    """
+    Hash passwords
+    Hashes a list of passwords on a process pool sized to the machine and
+    returns the hashes in input order. With a single worker (or a single
+    password) hashing happens in current process without spawning any.
+
+    :param passwords: list, passwords to hash
+    :param settings: dict, PASSLIB_* config settings
+    :param workers: int or None, number of processes (defaults to cpu count)
+    :return: list, password hashes
+    """
+    passwords = [str(password) for password in passwords]
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, len(passwords))
+    if workers <= 1:
+        context = build_context(settings)
+        return [context.hash(password) for password in passwords]
+
+    chunksize = max(1, len(passwords) // (workers * 4))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(settings,)
+    ) as executor:
+        hashes = executor.map(hash_in_worker, passwords, chunksize=chunksize)
+        return list(hashes)
@@ -0,0 +1,112 @@
+import time
+import threading
+
+"""
+Role hierarchy
+Roles can extend a parent role, getting everything the parent grants, e.g.
+admin extending editor has editor implied. Instead of walking parent links
+on every role check, transitive closure of the hierarchy is computed once
+and kept in memory, so that resolving implied roles is a dict lookup per
+role. It gets rebuilt on first use after roles change in this process, and
+every refresh interval to pick up changes made by other processes.
+"""
+
+
+class RoleHierarchy:
+    """
+    Role hierarchy
+    Maps every role handle to a set of handles it implies, itself included.
+    Roles without a parent are not in the map and imply only themselves.
+    """
+
+    def __init__(self, loader=None, refresh_interval=None):
+        """
+        Initialize hierarchy
+        :param loader: callable, returns an iterable of tuples
+            (handle, parent_handle)
+        :param refresh_interval: int, seconds between reloads, None to only
+            reload after invalidation
+        """
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.closure = dict()
+        self.version = 0
+        self._stale = True
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """
+        Invalidate
+        Marks hierarchy as changed, so that it gets rebuilt on next use.
+        :return: None
+        """
+        with self._lock:
+            self._stale = True
+            self.version += 1
+
+    def build(self, edges):
+        """
+        Build
+        Computes transitive closure from role to parent links. A cycle stops
+        the walk rather than looping forever.
+        :param edges: iterable of tuples (handle, parent_handle)
+        :return: dict
+        """
+        parents = dict(edges)
+        closure = dict()
+        for handle in parents:
+            implied = [handle]
+            parent = parents.get(handle)
+            while parent is not None and parent not in implied:
+                implied.append(parent)
+                parent = parents.get(parent)
+            closure[handle] = frozenset(implied)
+
+        return closure
+
+    def is_stale(self):
+        """ Check if roles changed or refresh interval passed """
+        if self._stale:
+            return True
+        if self.refresh_interval is None:
+            return False
+        return time.monotonic() - self._refreshed_at >= self.refresh_interval
+
+    def refresh_if_stale(self):
+        """
+        Refresh if stale
+        Reloads hierarchy if roles changed since it was last built or
+        refresh interval passed. A reload that finds hierarchy changed by
+        another process bumps the version.
+        :return: None
+        """
+        if not self.is_stale():
+            return
+
+        with self._lock:
+            if not self.is_stale():
+                return
+            closure = self.build(self.loader())
+            if not self._stale and closure != self.closure:
+                self.version += 1
+            self.closure = closure
+            self._stale = False
+            self._refreshed_at = time.monotonic()
+
+    def implied(self, handles):
+        """
+        Implied
+        Resolves role handles into a set of these and all roles they imply.
+        :param handles: iterable of str, role handles
+        :return: frozenset
+        """
+        self.refresh_if_stale()
+        closure = self.closure
+        if not closure:
+            return frozenset(handles)
+
+        implied = set()
+        for handle in handles:
+            implied.update(closure.get(handle, (handle,)))
+        return frozenset(implied)
@@ -0,0 +1,233 @@
+import json
+import jwt
+from jwt.algorithms import get_default_algorithms, has_crypto
+from shiftuser import exceptions as x
+
+"""
+Keyring
+JWT signing and verification keys, parsed once into key objects when the
+keyring is configured rather than on every encode and decode. Keys are
+identified by key id that goes into token kid header, so that during key
+rotation tokens signed with the old key keep verifying while new tokens get
+signed with the new one. With asymmetric algorithms (RS256, ES256, EdDSA)
+public keys can be published as JWKS so that other services can verify
+tokens on their own.
+"""
+
+
+class Key:
+    """
+    Key
+    A prepared JWT key. Signing key is absent for verify-only keys, e.g.
+    a retired key kept around until tokens signed with it expire.
+    """
+
+    def __init__(self, kid, algorithm, signing_key=None, verifying_key=None):
+        """
+        Initialize key
+        :param kid: str or None, key id
+        :param algorithm: str, JWT algorithm
+        :param signing_key: prepared signing key or None
+        :param verifying_key: prepared verifying key
+        """
+        self.kid = kid
+        self.algorithm = algorithm
+        self.signing_key = signing_key
+        self.verifying_key = verifying_key
+
+    def __repr__(self):
+        """ Printable representation of key """
+        u = '<Key kid="{}" algorithm="{}" signing="{}">'
+        return u.format(self.kid, self.algorithm, bool(self.signing_key))
+
+    @property
+    def is_symmetric(self):
+        """ Check if this is a shared secret key """
+        return self.signing_key is not None \
+            and self.signing_key is self.verifying_key
+
+
+def prepare_key(kid, algorithm, private_key=None, public_key=None, secret=None):
+    """
+    Prepare key
+    Parses key material for an algorithm into a key object. Shared secret
+    algorithms take a secret, asymmetric ones take PEM encoded private and/or
+    public keys. Public key is derived from private key if not given.
+
+    :param kid: str or None, key id
+    :param algorithm: str, JWT algorithm
+    :param private_key: str or bytes, PEM private key
+    :param public_key: str or bytes, PEM public key
+    :param secret: str or bytes, shared secret
+    :return: shiftuser.util.keyring.Key
+    """
+    algorithms = get_default_algorithms()
+    if algorithm not in algorithms:
+        msg = 'Unsupported JWT algorithm [{}] for key [{}]'
+        if not has_crypto:
+            msg += '. Asymmetric algorithms require cryptography package'
+        raise x.ConfigurationException(msg.format(algorithm, kid))
+
+    handler = algorithms[algorithm]
+    try:
+        if secret is not None:
+            prepared = handler.prepare_key(secret)
+            return Key(kid, algorithm, prepared, prepared)
+
+        signing_key = None
+        verifying_key = None
+        if private_key:
+            signing_key = handler.prepare_key(private_key)
+        if public_key:
+            verifying_key = handler.prepare_key(public_key)
+    except (jwt.exceptions.InvalidKeyError, ValueError, TypeError) as e:
+        msg = 'Failed to load JWT key [{}]: {}'
+        raise x.ConfigurationException(msg.format(kid, str(e)))
+
+    if verifying_key is None and signing_key is not None:
+        verifying_key = signing_key.public_key()
+    if verifying_key is None:
+        msg = 'JWT key [{}] needs a private or public key'
+        raise x.ConfigurationException(msg.format(kid))
+
+    return Key(kid, algorithm, signing_key, verifying_key)
+
+
+class Keyring:
+    """
+    Keyring
+    Holds prepared keys by key id and knows which one to sign with. A shared
+    secret, if configured, is kept under no key id: tokens without a kid
+    header verify with it.
+    """
+
+    def __init__(self):
+        """ Initialize keyring """
+        self.keys = dict()
+        self.current = None
+
+    def init(self, secret=None, algorithm='HS256', keys=None, key_id=None):
+        """
+        Initialize keyring
+        Parses configured keys, dropping previously loaded ones.
+
+        :param secret: str or None, shared secret
+        :param algorithm: str, default algorithm
+        :param keys: dict or None, key id to dict of algorithm, private_key,
+            public_key
+        :param key_id: str or None, id of the key to sign with
+        :return: None
+        """
+        self.keys = dict()
+        self.current = None
+        if secret:
+            self.add(None, algorithm, secret=secret)
+
+        for kid, options in (keys or dict()).items():
+            self.add(
+                kid,
+                options.get('algorithm', algorithm),
+                private_key=options.get('private_key'),
+                public_key=options.get('public_key'),
+            )
+
+        self.use(key_id)
+
+    def add(self, kid, algorithm, private_key=None, public_key=None, secret=None):
+        """
+        Add key
+        Parses and adds a key to keyring.
+        :param kid: str or None, key id
+        :param algorithm: str, JWT algorithm
+        :param private_key: str or bytes, PEM private key
+        :param public_key: str or bytes, PEM public key
+        :param secret: str or bytes, shared secret
+        :return: shiftuser.util.keyring.Key
+        """
+        key = prepare_key(kid, algorithm, private_key, public_key, secret)
+        self.keys[kid] = key
+        return key
+
+    def use(self, kid):
+        """
+        Use key
+        Sets key to sign new tokens with.
+        :param kid: str or None, key id
+        :return: None
+        """
+        key = self.keys.get(kid)
+        if not key or key.signing_key is None:
+            msg = 'No JWT signing key with id [{}]'
+            raise x.ConfigurationException(msg.format(kid))
+
+        self.current = key
+
+    def get(self, kid):
+        """
+        Get key
+        Returns verification key by id from token header.
+        :param kid: str or None, key id
+        :return: shiftuser.util.keyring.Key
+        """
+        key = self.keys.get(kid)
+        if not key:
+            msg = 'Unknown JWT key id [{}]'
+            raise jwt.exceptions.DecodeError(msg.format(kid))
+
+        return key
+
+    def encode(self, payload):
+        """
+        Encode
+        Signs payload with current key, putting its id into kid header.
+        :param payload: dict, token claims
+        :return: str, token
+        """
+        key = self.current
+        headers = dict(kid=key.kid) if key.kid is not None else None
+        return jwt.encode(
+            payload,
+            key.signing_key,
+            algorithm=key.algorithm,
+            headers=headers
+        )
+
+    def decode(self, token):
+        """
+        Decode
+        Verifies token with a key selected by kid header. Only algorithm of
+        that key is accepted. Malformed headers fail as decode errors.
+        :param token: str, token
+        :return: dict, token claims
+        """
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.exceptions.InvalidTokenError as e:
+            raise jwt.exceptions.DecodeError(str(e))
+
+        key = self.get(header.get('kid'))
+        return jwt.decode(
+            token,
+            key.verifying_key,
+            algorithms=[key.algorithm]
+        )
+
+    def jwks(self):
+        """
+        Get JWKS
+        Returns public keys as a JSON Web Key Set. Shared secrets are never
+        included.
+        :return: dict
+        """
+        algorithms = get_default_algorithms()
+        keys = []
+        for kid, key in self.keys.items():
+            if key.is_symmetric:
+                continue
+
+            handler = algorithms[key.algorithm]
+            jwk = json.loads(handler.to_jwk(key.verifying_key))
+            jwk.update(kid=kid, alg=key.algorithm, use='sig')
+            keys.append(jwk)
+
+        return dict(keys=keys)
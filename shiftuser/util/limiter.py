@@ -0,0 +1,222 @@
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from shiftuser import exceptions as x
+
+"""
+Concurrency limiter
+Admission control for expensive operations like password verification. A
+limited number of operations may run at once, a limited number may wait for
+a free slot and everything above that is rejected straight away. This keeps
+a burst of login attempts from tying up every CPU core and every worker.
+"""
+
+
+class ConcurrencyLimiter:
+    """
+    Concurrency limiter
+    A per-process limiter with a bounded wait queue. When limit is not set
+    nothing is limited, but counters are still maintained. Threads wait on
+    a semaphore, async tasks wait on a future of their own loop that gets
+    a released slot handed over, so they never block a thread.
+    """
+
+    def __init__(self, limit=None, queue_size=0, timeout=None):
+        """
+        Initialize limiter
+        :param limit: int or None, max concurrent operations
+        :param queue_size: int, max operations waiting for a slot
+        :param timeout: float or None, max seconds to wait for a slot
+        """
+        self._lock = threading.Lock()
+        self.init(limit, queue_size, timeout)
+
+    def init(self, limit=None, queue_size=0, timeout=None):
+        """
+        Initialize limiter
+        Reconfigures limiter and resets counters. Do this at startup rather
+        than when operations are in flight.
+
+        :param limit: int or None, max concurrent operations
+        :param queue_size: int, max operations waiting for a slot
+        :param timeout: float or None, max seconds to wait for a slot
+        :return: None
+        """
+        with self._lock:
+            self.limit = limit
+            self.queue_size = queue_size or 0
+            self.timeout = timeout
+            self._slots = threading.Semaphore(limit) if limit else None
+            self._async_waiters = deque()
+            self.in_flight = 0
+            self.waiting = 0
+            self.rejected = 0
+
+    def stats(self):
+        """
+        Get stats
+        Returns a snapshot of limiter counters.
+        :return: dict
+        """
+        with self._lock:
+            return dict(
+                limit=self.limit,
+                queue_size=self.queue_size,
+                in_flight=self.in_flight,
+                waiting=self.waiting,
+                rejected=self.rejected,
+            )
+
+    def reject(self, reason):
+        """
+        Reject
+        Counts rejection and raises.
+        :param reason: str, rejection message
+        :raises: shiftuser.exceptions.LoginOverloaded
+        """
+        with self._lock:
+            self.rejected += 1
+        raise x.LoginOverloaded(reason)
+
+    def admit(self):
+        """
+        Admit
+        Non-blocking part of acquiring a slot. Takes a free slot if there
+        is one, otherwise joins the wait queue or gets rejected when the
+        queue is full.
+
+        :return: bool, whether the slot was acquired (False means wait)
+        :raises: shiftuser.exceptions.LoginOverloaded
+        """
+        if self._slots is None or self._slots.acquire(blocking=False):
+            with self._lock:
+                self.in_flight += 1
+            return True
+
+        with self._lock:
+            queue_full = self.waiting >= self.queue_size
+            if not queue_full:
+                self.waiting += 1
+
+        if queue_full:
+            self.reject('Too many concurrent operations, queue is full')
+        return False
+
+    def wait(self):
+        """
+        Wait
+        Blocking part of acquiring a slot, performed after being admitted
+        to the wait queue.
+
+        :return: None
+        :raises: shiftuser.exceptions.LoginOverloaded
+        """
+        try:
+            acquired = self._slots.acquire(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+        if not acquired:
+            self.reject('Timed out waiting for a free slot')
+
+        with self._lock:
+            self.in_flight += 1
+
+    def release(self):
+        """ Release a previously acquired slot """
+        with self._lock:
+            self.in_flight -= 1
+            self.free_slot()
+
+    def free_slot(self):
+        """
+        Free slot
+        Hands a freed slot over to the first async waiter that is still
+        waiting, or returns it to the semaphore. Call with lock held.
+        :return: None
+        """
+        if self._slots is None:
+            return
+
+        while self._async_waiters:
+            loop, future = self._async_waiters.popleft()
+            if not future.done():
+                loop.call_soon_threadsafe(self.hand_over, future)
+                return
+
+        self._slots.release()
+
+    def hand_over(self, future):
+        """
+        Hand over
+        Gives a freed slot to an async waiter on its loop. If the waiter
+        gave up in the meantime, the slot is freed again.
+        :param future: asyncio.Future, waiter
+        :return: None
+        """
+        with self._lock:
+            if future.done():
+                self.free_slot()
+                return
+            self.in_flight += 1
+        future.set_result(True)
+
+    async def wait_async(self):
+        """
+        Wait async
+        Async part of acquiring a slot, performed after being admitted to
+        the wait queue. Waiter that is cancelled or times out never keeps
+        the slot.
+
+        :return: None
+        :raises: shiftuser.exceptions.LoginOverloaded
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            with self._lock:
+                if self._slots.acquire(blocking=False):
+                    self.in_flight += 1
+                    return
+                self._async_waiters.append((future.get_loop(), future))
+
+            try:
+                await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.reject('Timed out waiting for a free slot')
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    @contextmanager
+    def slot(self):
+        """
+        Slot
+        Context manager to run an operation within a slot, waiting for it
+        on the current thread if needed.
+        """
+        if not self.admit():
+            self.wait()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self):
+        """
+        Slot async
+        Async context manager to run an operation within a slot. Waiting
+        for the slot does not block the event loop or any thread.
+        """
+        if not self.admit():
+            await self.wait_async()
+        try:
+            yield self
+        finally:
+            self.release()
@@ -1,4 +1,6 @@
+import threading
 from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
 from flask import current_app
 
 """
@@ -13,14 +15,83 @@ the case, you can install it with homebrew:
 @see https://stackoverflow.com/questions/22875270/error-installing-bcrypt-with-pip-on-os-x-cant-find-ffi-h-libffi-is-installed/25854749#25854749
 """
 
-# get app config (bootstrapped application required)
-try:
-    default = current_app.config.get('PASSLIB_ALGO')
-    schemes = current_app.config.get('PASSLIB_SCHEMES')
-except RuntimeError as e:
-    raise RuntimeError('Unable to get config: ' + str(e))
-
-passlib_context = CryptContext(
-    schemes=schemes,
-    default=default,
-)
+_lock = threading.Lock()
+
+
+def build_context(config):
+    """
+    Build context
+    Creates passlib crypt context from app config. Every scheme but the
+    default one (PASSLIB_ALGO) is deprecated, and the default number of
+    rounds is also the minimum, so that legacy hashes get reported as
+    needing an update (see verify and update on login). Rounds default to
+    passlib defaults, unless set per scheme in PASSLIB_ROUNDS (see user
+    hash-benchmark command).
+
+    :param config: dict, app config
+    :return: passlib.context.CryptContext
+    """
+    schemes = config.get('PASSLIB_SCHEMES')
+    rounds = config.get('PASSLIB_ROUNDS') or dict()
+    settings = dict()
+    for scheme in schemes:
+        handler = get_crypt_handler(scheme)
+        if 'rounds' not in handler.setting_kwds:
+            continue
+        value = rounds.get(scheme, handler.default_rounds)
+        settings['{}__default_rounds'.format(scheme)] = value
+        settings['{}__min_rounds'.format(scheme)] = value
+
+    return CryptContext(
+        schemes=schemes,
+        default=config.get('PASSLIB_ALGO'),
+        deprecated='auto',
+        **settings
+    )
+
+
+def get_context(app=None):
+    """
+    Get context
+    Returns crypt context for the app, building it on first use and caching
+    it on app extension state. This way nothing is built at import time,
+    and several apps in one process get a context each, built from their
+    own config. Defaults to current app.
+
+    :param app: flask.Flask or None
+    :return: passlib.context.CryptContext
+    """
+    if app is None:
+        app = current_app._get_current_object()
+
+    state = app.extensions.setdefault('shiftuser', dict())
+    context = state.get('passlib_context')
+    if context is not None:
+        return context
+
+    with _lock:
+        context = state.get('passlib_context')
+        if context is None:
+            context = build_context(app.config)
+            state['passlib_context'] = context
+
+    return context
+
+
+def prebuild_context(app):
+    """
+    Prebuild context
+    Builds crypt context for the app upfront, e.g. in gunicorn master
+    process before forking workers, so that workers inherit it.
+
+    :param app: flask.Flask
+    :return: passlib.context.CryptContext
+    """
+    return get_context(app)
+
+
+def __getattr__(name):
+    """ Keep passlib_context importable, resolved for current app """
+    if name == 'passlib_context':
+        return get_context()
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
@@ -0,0 +1,154 @@
+import time
+import threading
+
+"""
+Permissions
+Permissions are granted to roles by name, but checking a name against every
+role of a user on every check is slow where permissions are checked per row.
+Instead every permission gets a bit in the registry, every role gets an
+integer mask of its permissions and a user mask is these OR'ed together.
+Checking a permission is then a single bitwise AND. Bits are assigned in
+process memory and are never persisted, so they only need to be stable
+within a process.
+"""
+
+
+class PermissionRegistry:
+    """
+    Permission registry
+    Assigns bits to permission names and keeps masks of permissions granted
+    to every role. Role masks are loaded once and rebuilt on first use after
+    roles change in this process, and every refresh interval to pick up
+    changes made by other processes. Masks of sets of roles are memoized,
+    so users with the same roles share them.
+    """
+
+    def __init__(self, loader=None, refresh_interval=None):
+        """
+        Initialize registry
+        :param loader: callable, returns an iterable of tuples
+            (role_handle, permission)
+        :param refresh_interval: int, seconds between reloads, None to only
+            reload after invalidation
+        """
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.flags = dict()
+        self.role_masks = dict()
+        self.version = 0
+        self._masks = dict()
+        self._stale = True
+        self._refreshed_at = None
+        self._lock = threading.RLock()
+
+    def register(self, name):
+        """
+        Register
+        Assigns next free bit to a permission, unless it already has one.
+        :param name: str, permission name
+        :return: int, permission flag
+        """
+        flag = self.flags.get(name)
+        if flag is None:
+            with self._lock:
+                flag = self.flags.get(name)
+                if flag is None:
+                    flag = 1 << len(self.flags)
+                    self.flags[name] = flag
+        return flag
+
+    def mask(self, names):
+        """
+        Mask
+        Returns a mask of permissions, registering ones not seen before.
+        :param names: iterable of str, permission names
+        :return: int
+        """
+        mask = 0
+        for name in names:
+            mask |= self.register(name)
+        return mask
+
+    def names(self, mask):
+        """
+        Names
+        Returns names of permissions set in a mask.
+        :param mask: int, permissions mask
+        :return: list
+        """
+        return [name for name, flag in self.flags.items() if mask & flag]
+
+    def allows(self, mask, name):
+        """
+        Allows
+        Checks if permission is set in a mask. Permissions never granted to
+        any role are not registered and are never allowed.
+        :param mask: int, permissions mask
+        :param name: str, permission name
+        :return: bool
+        """
+        flag = self.flags.get(name)
+        return flag is not None and mask & flag == flag
+
+    def invalidate(self):
+        """
+        Invalidate
+        Marks role masks as changed, so that they get reloaded on next use.
+        :return: None
+        """
+        with self._lock:
+            self._stale = True
+            self.version += 1
+
+    def is_stale(self):
+        """ Check if roles changed or refresh interval passed """
+        if self._stale:
+            return True
+        if self.refresh_interval is None:
+            return False
+        return time.monotonic() - self._refreshed_at >= self.refresh_interval
+
+    def refresh_if_stale(self):
+        """
+        Refresh if stale
+        Reloads role masks if roles changed since they were last loaded or
+        refresh interval passed. A reload that finds masks changed by
+        another process bumps the version.
+        :return: None
+        """
+        if not self.is_stale():
+            return
+
+        with self._lock:
+            if not self.is_stale():
+                return
+
+            role_masks = dict()
+            for handle, name in self.loader():
+                role_masks[handle] = role_masks.get(handle, 0) | \
+                    self.register(name)
+
+            if not self._stale and role_masks != self.role_masks:
+                self.version += 1
+            if role_masks != self.role_masks:
+                self._masks = dict()
+            self.role_masks = role_masks
+            self._stale = False
+            self._refreshed_at = time.monotonic()
+
+    def roles_mask(self, handles):
+        """
+        Roles mask
+        Returns mask of all permissions granted to a set of roles.
+        :param handles: frozenset, role handles
+        :return: int
+        """
+        self.refresh_if_stale()
+        mask = self._masks.get(handles)
+        if mask is None:
+            mask = 0
+            role_masks = self.role_masks
+            for handle in handles:
+                mask |= role_masks.get(handle, 0)
+            self._masks[handles] = mask
+        return mask
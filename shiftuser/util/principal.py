@@ -0,0 +1,375 @@
+import datetime
+import threading
+from collections.abc import MutableSet
+from flask_principal import Identity, RoleNeed
+from shiftuser.cache import TTLCache
+
+"""
+Principal
+Principal needs a user provides are looked up on every request that loads
+identity, but only change when user gets or loses a role. This module keeps
+them precomputed as frozensets of interned needs, keyed by user id, user
+roles version and versions of roles themselves, so that loading identity
+does not rebuild them.
+
+It also provides a lightweight authenticated user object that request
+loaders can return instead of a full user entity, and an identity whose
+needs are only resolved once a permission gets checked.
+"""
+
+
+class NeedsCache:
+    """
+    Needs cache
+    Cache of principal needs per user. Users bump their roles version on
+    every role change and role hierarchy and permissions bump theirs when
+    roles change, in this or another process. Either makes previously
+    cached needs unreachable.
+    Needs themselves are interned, so that every user with a role shares
+    a single need object, which is why this cache always stays in process
+    memory regardless of configured cache backend.
+    """
+
+    def __init__(self, max_size=4096, ttl=60):
+        """
+        Initialize cache
+        :param max_size: int, max number of users to cache needs for
+        :param ttl: int, how long to keep needs, in seconds
+        """
+        self._lock = threading.Lock()
+        self._needs = dict()
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    def role_need(self, handle):
+        """
+        Role need
+        Returns interned role need for a role handle.
+        :param handle: str, role handle
+        :return: flask_principal.RoleNeed
+        """
+        need = self._needs.get(handle)
+        if need is None:
+            with self._lock:
+                need = self._needs.setdefault(handle, RoleNeed(handle))
+        return need
+
+    def build(self, user):
+        """
+        Build needs
+        Computes needs of a user from its roles.
+        :param user: shiftuser.models.User
+        :return: frozenset
+        """
+        return frozenset(self.role_need(handle) for handle in user.role_handles)
+
+    def get(self, user):
+        """
+        Get needs
+        Returns cached needs of a user, building them on miss. Users that
+        were not saved yet or have unsaved role changes are never cached.
+        :param user: shiftuser.models.User
+        :return: frozenset
+        """
+        if user.id is None or user.roles_version_pending:
+            return self.build(user)
+
+        key = self.key(user)
+        needs = self.cache.get(key)
+        if needs is None:
+            needs = self.build(user)
+            self.cache.set(key, needs)
+
+        return needs
+
+    def key(self, user):
+        """
+        Key
+        Returns cache key for user needs. Hierarchy gets refreshed first, so
+        that changes made by other processes are seen in its version.
+        :param user: shiftuser.models.User
+        :return: tuple
+        """
+        from shiftuser.models import role_hierarchy, permission_registry
+        role_hierarchy.refresh_if_stale()
+        return (
+            user.id,
+            user.roles_version,
+            role_hierarchy.version,
+            permission_registry.version,
+        )
+
+    def for_roles(self, handles):
+        """
+        For roles
+        Returns cached needs for a set of role handles, e.g. roles of a user
+        restored from cache without the entity.
+        :param handles: frozenset, role handles
+        :return: frozenset
+        """
+        key = ('roles', handles)
+        needs = self.cache.get(key)
+        if needs is None:
+            needs = frozenset(self.role_need(handle) for handle in handles)
+            self.cache.set(key, needs)
+
+        return needs
+
+    def delete(self, user):
+        """
+        Delete
+        Drops cached needs of a user, e.g. when it gets deleted, so that
+        a reused id never picks them up.
+        :param user: shiftuser.models.User
+        :return: None
+        """
+        self.cache.delete(self.key(user))
+
+    def clear(self):
+        """
+        Clear
+        Drops all cached needs, e.g. when a role gets renamed.
+        :return: None
+        """
+        self.cache.clear()
+
+
+needs_cache = NeedsCache()
+
+
+class AuthenticatedUser:
+    """
+    Authenticated user
+    A compact value object standing for current user. Implements flask-login
+    user protocol and what principal needs, which is enough for most
+    requests. Anything else is looked up on user entity, that gets loaded
+    on first access.
+    """
+    __slots__ = (
+        'id',
+        'email',
+        'roles',
+        'needs',
+        'permission_mask',
+        'locked_until',
+        '_loader',
+        '_entity',
+    )
+
+    def __init__(
+        self,
+        id,
+        email,
+        roles,
+        needs,
+        permission_mask=0,
+        locked_until=None,
+        loader=None):
+        """
+        Initialize user
+        :param id: int, user id
+        :param email: str, user email
+        :param roles: frozenset, role handles
+        :param needs: frozenset, principal needs
+        :param permission_mask: int, mask of permissions
+        :param locked_until: datetime or None, account lock
+        :param loader: callable, receives user id and returns user entity
+        """
+        self.id = id
+        self.email = email
+        self.roles = roles
+        self.needs = needs
+        self.permission_mask = permission_mask
+        self.locked_until = locked_until
+        self._loader = loader
+        self._entity = None
+
+    @classmethod
+    def from_user(cls, user, loader=None):
+        """
+        From user
+        Creates authenticated user from user entity.
+        :param user: shiftuser.models.User
+        :param loader: callable, user entity loader
+        :return: shiftuser.util.principal.AuthenticatedUser
+        """
+        authenticated = cls(
+            id=user.id,
+            email=user.email,
+            roles=user.role_handles,
+            needs=user.provide_principal_needs(),
+            permission_mask=user.permission_mask,
+            locked_until=user.locked_until,
+            loader=loader
+        )
+        authenticated._entity = user
+        return authenticated
+
+    def __repr__(self):
+        """ Printable representation of authenticated user """
+        return '<AuthenticatedUser id="{}">'.format(self.id)
+
+    def __getattr__(self, name):
+        """ Look up everything else on user entity """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.entity, name)
+
+    @property
+    def entity(self):
+        """
+        User entity
+        Loads user entity on first access.
+        :return: shiftuser.models.User
+        """
+        if self._entity is None:
+            self._entity = self._loader(self.id)
+        return self._entity
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_active(self):
+        now = datetime.datetime.utcnow()
+        return not self.locked_until or self.locked_until < now
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return str(self.id)
+
+    def has_role(self, role_or_handle):
+        """ Checks if user has role """
+        if not isinstance(role_or_handle, str):
+            role_or_handle = role_or_handle.handle
+        return role_or_handle in self.roles
+
+    def has_any_role(self, *roles_or_handles):
+        """ Checks if user has at least one of the roles """
+        for role in roles_or_handles:
+            if self.has_role(role):
+                return True
+        return False
+
+    def has_all_roles(self, *roles_or_handles):
+        """ Checks if user has every one of the roles """
+        for role in roles_or_handles:
+            if not self.has_role(role):
+                return False
+        return True
+
+    def can(self, permission):
+        """
+        Can?
+        Checks if user has a permission through any of the roles.
+        :param permission: str, permission name
+        :return: bool
+        """
+        from shiftuser.models import permission_registry
+        return permission_registry.allows(self.permission_mask, permission)
+
+    def provide_principal_needs(self):
+        """
+        Provide principal needs
+        Returns principal needs precomputed when user was authenticated.
+        :return: frozenset
+        """
+        return self.needs
+
+
+class LazyNeeds(MutableSet):
+    """
+    Lazy needs
+    A set of principal needs that asks provider for them on first access,
+    so that requests that never check a permission never resolve them.
+    Needs added before that are kept and merged in.
+    """
+
+    def __init__(self, provider, needs=None):
+        """
+        Initialize needs
+        :param provider: callable, returns an iterable of needs
+        :param needs: iterable or None, needs provided so far
+        """
+        self.provider = provider
+        self.pending = set(needs or ())
+        self._needs = None
+
+    @property
+    def needs(self):
+        """
+        Needs
+        Resolves needs on first access.
+        :return: set
+        """
+        if self._needs is None:
+            self._needs = set(self.provider()) | self.pending
+            self.pending = None
+        return self._needs
+
+    @property
+    def resolved(self):
+        """ Check if needs were resolved """
+        return self._needs is not None
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        """ Set operations return plain sets """
+        return set(iterable)
+
+    def __contains__(self, need):
+        return need in self.needs
+
+    def __iter__(self):
+        return iter(self.needs)
+
+    def __len__(self):
+        return len(self.needs)
+
+    def __repr__(self):
+        if not self.resolved:
+            return '<LazyNeeds unresolved>'
+        return repr(self.needs)
+
+    def add(self, need):
+        """ Add need without resolving the rest """
+        if self.resolved:
+            self._needs.add(need)
+        else:
+            self.pending.add(need)
+
+    def discard(self, need):
+        """ Remove need """
+        self.needs.discard(need)
+
+    def update(self, needs):
+        """ Add many needs without resolving the rest """
+        for need in needs:
+            self.add(need)
+
+    def intersection(self, needs):
+        """ Get needs that are also in another set """
+        return self.needs.intersection(needs)
+
+
+class UserIdentity(Identity):
+    """
+    User identity
+    Principal identity of a user, with user permission mask resolved only
+    when asked for.
+    """
+
+    @property
+    def permission_mask(self):
+        """
+        Permission mask
+        Returns mask of user permissions, empty for anonymous users.
+        :return: int
+        """
+        user = getattr(self, 'user', None)
+        if user is None or not user.is_authenticated:
+            return 0
+        return user.permission_mask
@@ -0,0 +1,213 @@
+import os
+import mmap
+import time
+import struct
+import hashlib
+from shiftuser import exceptions as x
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+"""
+Revocation store
+A set of revoked token ids (jti) and user token versions kept in a memory
+mapped file, so that all worker processes on a host share it. Revoking
+process writes to the file and every other worker sees the change straight
+away, without a database read. Checking is a couple of hash table probes
+in shared memory.
+
+The file is a fixed-size open addressing hash table. Each slot holds a
+64-bit fingerprint of the revoked key and the time entry expires (which is
+when the revoked token would have expired anyway). A key only ever lives
+within a short window of slots starting at its home slot, so both adding
+and checking probe at most that many slots, however full the table is.
+Slots of expired entries within the window get reused. Slots are never
+emptied except by clearing the store, so a key is always found before the
+first empty slot of its window. Writers serialize on an exclusive file
+lock, readers don't lock at all: expiry is written before fingerprint, so
+a reader never sees a fingerprint without its expiry.
+"""
+
+MAGIC = b'SUREVOK1'
+HEADER = struct.Struct('<8sQ')  # magic, capacity
+SLOT = struct.Struct('<Qd')  # fingerprint, expires
+MAX_PROBES = 32
+
+
+def fingerprint(key):
+    """
+    Fingerprint
+    Returns a non-zero 64-bit fingerprint of a key. Zero marks empty slots.
+    :param key: str, revoked key
+    :return: int
+    """
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class RevocationStore:
+    """
+    Revocation store
+    Shared memory set of revoked keys with expiration. The file is created
+    on first use. Capacity of an existing file takes precedence over the
+    one passed in.
+    """
+
+    def __init__(self, path, capacity=65536):
+        """
+        Initialize store
+        :param path: str, path to store file
+        :param capacity: int, number of slots
+        """
+        if fcntl is None:
+            msg = 'Revocation store requires a platform with fcntl'
+            raise x.ConfigurationException(msg)
+
+        self.path = path
+        self.capacity = capacity
+        self._fd = None
+        self._map = None
+        self._pid = None
+
+    @property
+    def map(self):
+        """
+        Get memory map
+        Opens the file on first use in every process, as file locks are
+        shared between processes forked with an open descriptor.
+        :return: mmap.mmap
+        """
+        if self._pid != os.getpid():
+            self.open()
+
+        return self._map
+
+    def open(self):
+        """
+        Open
+        Opens or creates the store file and maps it into memory.
+        :return: None
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                magic, capacity = MAGIC, self.capacity
+                os.ftruncate(fd, HEADER.size + capacity * SLOT.size)
+                os.pwrite(fd, HEADER.pack(magic, capacity), 0)
+            else:
+                header = os.pread(fd, HEADER.size, 0)
+                magic, capacity = HEADER.unpack(header)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        if magic != MAGIC:
+            os.close(fd)
+            msg = 'Not a revocation store file [{}]'
+            raise x.ConfigurationException(msg.format(self.path))
+
+        self.capacity = capacity
+        self._fd = fd
+        self._map = mmap.mmap(fd, HEADER.size + self.capacity * SLOT.size)
+        self._pid = os.getpid()
+
+    def close(self):
+        """ Unmap and close store file """
+        if self._pid == os.getpid():
+            self._map.close()
+            os.close(self._fd)
+        self._fd = None
+        self._map = None
+        self._pid = None
+
+    def slots(self, key):
+        """
+        Slots
+        Yields offsets of slots a key can live in, starting with its home
+        slot.
+        :param key: str, revoked key
+        :return: generator of (offset, fingerprint)
+        """
+        fp = fingerprint(key)
+        home = fp % self.capacity
+        for probe in range(min(MAX_PROBES, self.capacity)):
+            index = (home + probe) % self.capacity
+            yield HEADER.size + index * SLOT.size, fp
+
+    def add(self, key, expires):
+        """
+        Add
+        Revokes a key until given time. Updates existing entry of the key,
+        otherwise takes the first empty or expired slot of its window.
+        :param key: str, revoked key
+        :param expires: float, unix timestamp when entry is no longer needed
+        :return: None
+        """
+        store = self.map
+        now = time.time()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            free = None
+            for offset, fp in self.slots(key):
+                slot_fp, slot_expires = SLOT.unpack_from(store, offset)
+                if slot_fp == fp:
+                    free = offset
+                    expires = max(expires, slot_expires)
+                    break
+                if free is None and (not slot_fp or slot_expires <= now):
+                    free = offset
+                if not slot_fp:
+                    break
+
+            if free is not None:
+                # expiry first, so that readers never see it missing
+                struct.pack_into('<d', store, free + 8, expires)
+                struct.pack_into('<Q', store, free, fp)
+                return
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        msg = 'Revocation store is full [{}]'
+        raise x.RevocationStoreFull(msg.format(self.path))
+
+    def is_revoked(self, key):
+        """
+        Is revoked?
+        Checks if key is revoked and the entry did not expire yet.
+        :param key: str, key to check
+        :return: bool
+        """
+        store = self.map
+        for offset, fp in self.slots(key):
+            slot_fp, slot_expires = SLOT.unpack_from(store, offset)
+            if slot_fp == fp:
+                return slot_expires > time.time()
+            if not slot_fp:
+                return False
+
+        return False
+
+    def clear(self):
+        """ Remove all entries """
+        store = self.map
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            size = self.capacity * SLOT.size
+            store[HEADER.size:HEADER.size + size] = bytes(size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def __len__(self):
+        """ Count entries that did not expire yet """
+        store = self.map
+        now = time.time()
+        count = 0
+        for index in range(self.capacity):
+            offset = HEADER.size + index * SLOT.size
+            slot_fp, slot_expires = SLOT.unpack_from(store, offset)
+            if slot_fp and slot_expires > now:
+                count += 1
+
+        return count
@@ -0,0 +1,110 @@
+import time
+import threading
+
+"""
+Token versions
+Stateless JWT mode puts user token version into every token. Revoking user
+tokens bumps the version, so checking a token boils down to comparing its
+version claim with the current one. This module keeps current versions in a
+compact in-process map that gets refreshed incrementally, so that checking
+a token does not need a database round trip.
+"""
+
+
+class TokenVersions:
+    """
+    Token versions
+    Map of user id to current token version. Only users that ever had their
+    tokens revoked are in the map, everyone else is at version 0. The map is
+    refreshed from the database every refresh interval by asking the loader
+    for versions changed since the last seen change.
+    """
+
+    def __init__(self, loader=None, refresh_interval=5):
+        """
+        Initialize versions map
+        :param loader: callable, receives datetime of last seen change (or
+            None on initial load) and returns an iterable of tuples
+            (user_id, version, changed)
+        :param refresh_interval: int, seconds between refreshes
+        """
+        self._lock = threading.Lock()
+        self.init(loader, refresh_interval)
+
+    def init(self, loader=None, refresh_interval=5):
+        """
+        Initialize versions map
+        Reconfigures map and drops everything loaded so far.
+        :param loader: callable, versions loader
+        :param refresh_interval: int, seconds between refreshes
+        :return: None
+        """
+        with self._lock:
+            self.loader = loader
+            self.refresh_interval = refresh_interval
+            self._versions = dict()
+            self._watermark = None
+            self._refreshed_at = None
+
+    def get(self, user_id):
+        """
+        Get version
+        Returns current token version for a user, refreshing the map first
+        if refresh interval passed.
+        :param user_id: int
+        :return: int
+        """
+        self.refresh_if_stale()
+        return self._versions.get(user_id, 0)
+
+    def is_stale(self):
+        """ Check if map was never loaded or refresh interval passed """
+        refreshed_at = self._refreshed_at
+        if refreshed_at is None:
+            return True
+        return time.monotonic() - refreshed_at >= self.refresh_interval
+
+    def refresh_if_stale(self):
+        """
+        Refresh if stale
+        Refreshes map if it was never loaded or refresh interval passed.
+        Staleness is checked again under the lock, so that threads waiting
+        for a refresh do not run it once more.
+        :return: None
+        """
+        if not self.is_stale() or not self.loader:
+            return
+
+        with self._lock:
+            if self.is_stale():
+                self.load()
+
+    def refresh(self):
+        """
+        Refresh
+        Loads versions changed since the last seen change (everything on
+        initial load). Changes with the same timestamp as the last seen one
+        get reloaded, so that none are missed.
+        :return: None
+        """
+        if not self.loader:
+            return
+
+        with self._lock:
+            self.load()
+
+    def load(self):
+        """
+        Load
+        Applies versions changed since the last seen change. Call with lock
+        held.
+        :return: None
+        """
+        for user_id, version, changed in self.loader(self._watermark):
+            self._versions[user_id] = version or 0
+            if changed and (not self._watermark or changed > self._watermark):
+                self._watermark = changed
+        self._refreshed_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._versions)
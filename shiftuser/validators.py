@@ -54,6 +54,19 @@ class UniqueRoleHandle(AbstractValidator):
         return Error(self.error)
 
 
+class RoleParent(AbstractValidator):
+    """ Role can not extend itself, directly or through its parents """
+    error = 'Role can not extend itself'
 
+    def validate(self, value, model=None, context=None):
+        """ Perform validation """
+        if value is None or model is None:
+            return Error()
 
+        parent = value
+        while parent is not None:
+            if parent is model:
+                return Error(self.error)
+            parent = parent.parent
 
+        return Error()
@@ -2,6 +2,7 @@ from copy import deepcopy
 
 from flask.views import View
 from flask import flash, redirect, render_template, url_for, abort, request
+from flask import jsonify
 from flask import current_app
 from flask import session
 from flask_login import current_user
@@ -98,6 +99,8 @@ class Login(View):
                     flash(self.lock_msg.format(locked.locked_until), 'danger')
             except x.EmailNotConfirmed:
                 return redirect(url_for(self.unconfirmed_email_endpoint))
+            except x.LoginOverloaded:
+                abort(429)
 
         params = dict(form=form)
         if self.params:
@@ -107,6 +110,44 @@ class Login(View):
         return render_template(self.template, **params)
 
 
+# -----------------------------------------------------------------------------
+# API tokens
+# -----------------------------------------------------------------------------
+
+
+class RefreshToken(View):
+    """
+    Refresh token
+    Exchanges a refresh token for a new access and refresh token pair. Takes
+    refresh_token from JSON body or form data and responds with a JSON pair.
+    """
+    methods = ['POST']
+
+    def dispatch_request(self):
+        data = request.get_json(silent=True) or request.form
+        refresh_token = data.get('refresh_token')
+        if not refresh_token:
+            abort(400, description='Refresh token required')
+
+        try:
+            pair = user_service.refresh_token_pair(refresh_token)
+        except x.UserException as exception:
+            abort(401, description=str(exception))
+
+        return jsonify(pair)
+
+
+class Jwks(View):
+    """
+    JWKS
+    Publishes public JWT keys as a JSON Web Key Set, so that other services
+    can verify our tokens.
+    """
+
+    def dispatch_request(self):
+        return jsonify(user_service.keyring.jwks())
+
+
 # -----------------------------------------------------------------------------
 # Register
 # -----------------------------------------------------------------------------
@@ -214,7 +255,7 @@ class ConfirmEmailRequest(View):
         # get logged in user
         user = None
         if current_user.is_authenticated:
-            user = current_user._get_current_object()
+            user = user_service.get(current_user.id)
 
         # if not logged in, ask for email and find user
         if not user:
@@ -1,4 +1,6 @@
 from boiler.testing.testcase import ViewTestCase
+from shiftuser.util.principal import needs_cache
+from shiftuser.models import role_hierarchy, permission_registry
 from tests.test_app.app import app as test_app
 
 
@@ -12,4 +14,7 @@ class BaseTestCase(ViewTestCase):
         if not app:
             app = test_app
         super().setUp(app)
+        needs_cache.clear()
+        role_hierarchy.invalidate()
+        permission_registry.invalidate()
 
@@ -0,0 +1,191 @@
+import os
+import time
+import tempfile
+import multiprocessing
+from nose.plugins.attrib import attr
+from tests.base_testcase import BaseTestCase
+
+from shiftuser import exceptions as x
+from shiftuser.cache import CacheBackend, TTLCache, SQLiteCache, create_cache
+
+
+def incr_in_child(path, key, times):
+    """ Increment a counter from another process """
+    cache = SQLiteCache(path)
+    for _ in range(times):
+        cache.incr(key)
+
+
+class CustomCache(TTLCache):
+    """ Custom cache backend """
+    def __init__(self, namespace, max_size, ttl, path):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.namespace = namespace
+
+
+@attr('user', 'cache')
+class CacheTest(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'cache.db')
+
+    # -------------------------------------------------------------------------
+    # Memory backend
+    # -------------------------------------------------------------------------
+
+    def test_memory_cache_evicts_least_recently_used(self):
+        """ Memory cache evicts least recently used entries """
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_memory_cache_incr(self):
+        """ Incrementing counters in memory cache """
+        cache = TTLCache()
+        self.assertEqual(1, cache.incr('counter'))
+        self.assertEqual(6, cache.incr('counter', 5))
+        self.assertEqual(6, cache.get('counter'))
+
+    def test_memory_cache_incr_restarts_expired(self):
+        """ Expired counters start from zero """
+        cache = TTLCache()
+        cache.incr('counter', ttl=0.01)
+        time.sleep(0.02)
+        self.assertEqual(1, cache.incr('counter'))
+
+    def test_memory_cache_incr_is_atomic(self):
+        """ Concurrent increments of a new counter are never lost """
+        import threading
+        cache = TTLCache()
+        barrier = threading.Barrier(8)
+        def incr():
+            barrier.wait()
+            for _ in range(100):
+                cache.incr('counter')
+
+        threads = [threading.Thread(target=incr) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(800, cache.get('counter'))
+
+    # -------------------------------------------------------------------------
+    # SQLite backend
+    # -------------------------------------------------------------------------
+
+    def test_sqlite_cache_get_set_delete(self):
+        """ Caching values in SQLite file """
+        cache = SQLiteCache(self.path)
+        self.assertIsNone(cache.get('missing'))
+        self.assertEqual('default', cache.get('missing', 'default'))
+
+        cache.set('user:1', dict(id=1, roles=frozenset(['user'])))
+        cache.set('count', 5)
+        self.assertEqual(dict(id=1, roles=frozenset(['user'])), cache.get('user:1'))
+        self.assertEqual(5, cache.get('count'))
+        self.assertEqual(2, len(cache))
+
+        cache.delete('user:1')
+        self.assertIsNone(cache.get('user:1'))
+        self.assertEqual(2, cache.stats()['hits'])
+
+    def test_sqlite_cache_file_is_private(self):
+        """ Cache file is created readable by owner only """
+        SQLiteCache(self.path).set('key', 'value')
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+
+    def test_sqlite_cache_expires_entries(self):
+        """ Expired entries are not returned """
+        cache = SQLiteCache(self.path, ttl=60)
+        cache.set('short', 'value', ttl=0.01)
+        cache.set('forever', 'value', ttl=0)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('short'))
+        self.assertEqual('value', cache.get('forever'))
+        self.assertEqual(1, cache.stats()['expirations'])
+
+    def test_sqlite_cache_evicts_oldest(self):
+        """ SQLite cache evicts oldest entries once full """
+        cache = SQLiteCache(self.path, max_size=8)
+        for i in range(20):
+            cache.set(i, i)
+        self.assertLessEqual(len(cache), 8)
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(19, cache.get(19))
+
+    def test_sqlite_cache_namespaces(self):
+        """ Caches in one file are kept apart by namespace """
+        users = SQLiteCache(self.path, namespace='user')
+        tokens = SQLiteCache(self.path, namespace='token')
+        users.set('key', 'user')
+        tokens.set('key', 'token')
+        self.assertEqual('user', users.get('key'))
+
+        tokens.clear()
+        self.assertIsNone(tokens.get('key'))
+        self.assertEqual('user', users.get('key'))
+
+    def test_sqlite_cache_is_shared_between_processes(self):
+        """ Increments from several processes all count """
+        cache = SQLiteCache(self.path)
+        self.assertEqual(1, cache.incr('counter'))
+
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(
+                target=incr_in_child,
+                args=(self.path, 'counter', 20)
+            ) for _ in range(3)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(0, process.exitcode)
+
+        self.assertEqual(61, cache.get('counter'))
+
+    # -------------------------------------------------------------------------
+    # Factory
+    # -------------------------------------------------------------------------
+
+    def test_create_memory_cache_by_default(self):
+        """ Memory backend is used by default """
+        cache = create_cache(max_size=10, ttl=5)
+        self.assertIsInstance(cache, TTLCache)
+        self.assertEqual(10, cache.max_size)
+        self.assertEqual(5, cache.ttl)
+
+    def test_create_sqlite_cache(self):
+        """ Creating SQLite cache requires a path """
+        cache = create_cache('sqlite', namespace='user', path=self.path)
+        self.assertIsInstance(cache, SQLiteCache)
+        self.assertEqual('user', cache.namespace)
+        with self.assertRaises(x.ConfigurationException):
+            create_cache('sqlite')
+
+    def test_incomplete_backend_fails_to_instantiate(self):
+        """ Backend missing interface methods can not be created """
+        class IncompleteCache(CacheBackend):
+            def get(self, key, default=None):
+                return default
+
+        with self.assertRaises(TypeError):
+            IncompleteCache()
+
+    def test_create_custom_cache(self):
+        """ Creating cache from importable class name """
+        cache = create_cache('tests.cache_test.CustomCache', namespace='token')
+        self.assertIsInstance(cache, CustomCache)
+        self.assertEqual('token', cache.namespace)
+        with self.assertRaises(x.ConfigurationException):
+            create_cache('nope.NopeCache')
@@ -0,0 +1,65 @@
+from unittest import mock
+from nose.plugins.attrib import attr
+from tests.base_testcase import BaseTestCase
+
+from shiftuser.util.hierarchy import RoleHierarchy
+
+
+@attr('role', 'hierarchy')
+class RoleHierarchyTest(BaseTestCase):
+
+    def test_build_transitive_closure(self):
+        """ Every role implies all of its ancestors """
+        hierarchy = RoleHierarchy()
+        closure = hierarchy.build([('admin', 'editor'), ('editor', 'author')])
+        self.assertEqual({'admin', 'editor', 'author'}, closure['admin'])
+        self.assertEqual({'editor', 'author'}, closure['editor'])
+        self.assertNotIn('author', closure)
+
+    def test_build_stops_on_cycles(self):
+        """ Cycles in hierarchy do not loop forever """
+        hierarchy = RoleHierarchy()
+        closure = hierarchy.build([('a', 'b'), ('b', 'a')])
+        self.assertEqual({'a', 'b'}, closure['a'])
+        self.assertEqual({'a', 'b'}, closure['b'])
+
+    def test_resolve_implied_roles(self):
+        """ Resolving implied roles from a set of handles """
+        loader = mock.Mock(return_value=[('admin', 'editor')])
+        hierarchy = RoleHierarchy(loader=loader)
+        implied = hierarchy.implied(['admin', 'user'])
+        self.assertEqual({'admin', 'editor', 'user'}, implied)
+        self.assertEqual({'user'}, hierarchy.implied(['user']))
+        loader.assert_called_once_with()
+
+    def test_rebuild_after_invalidation(self):
+        """ Hierarchy gets reloaded on first use after invalidation """
+        loader = mock.Mock(return_value=[])
+        hierarchy = RoleHierarchy(loader=loader)
+        self.assertEqual({'admin'}, hierarchy.implied(['admin']))
+
+        version = hierarchy.version
+        loader.return_value = [('admin', 'editor')]
+        hierarchy.invalidate()
+        self.assertEqual(version + 1, hierarchy.version)
+        self.assertEqual({'admin', 'editor'}, hierarchy.implied(['admin']))
+        self.assertEqual(2, loader.call_count)
+
+    def test_reload_after_refresh_interval(self):
+        """ Hierarchy changed by another process gets picked up """
+        loader = mock.Mock(return_value=[])
+        hierarchy = RoleHierarchy(loader=loader, refresh_interval=30)
+        self.assertEqual({'admin'}, hierarchy.implied(['admin']))
+
+        version = hierarchy.version
+        loader.return_value = [('admin', 'editor')]
+        self.assertEqual({'admin'}, hierarchy.implied(['admin']))
+
+        hierarchy._refreshed_at -= 30
+        self.assertEqual({'admin', 'editor'}, hierarchy.implied(['admin']))
+        self.assertEqual(version + 1, hierarchy.version)
+
+        hierarchy._refreshed_at -= 30
+        hierarchy.implied(['admin'])
+        self.assertEqual(version + 1, hierarchy.version) # unchanged
+        self.assertEqual(3, loader.call_count)
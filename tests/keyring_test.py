@@ -0,0 +1,179 @@
+from nose.plugins.attrib import attr
+from tests.base_testcase import BaseTestCase
+
+import jwt
+import json
+import base64
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+from shiftuser import exceptions as x
+from shiftuser.util.keyring import Keyring
+
+
+def private_pem(key):
+    """ Serialize private key to PEM """
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+
+def public_pem(key):
+    """ Serialize public key of a private key to PEM """
+    return key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+
+
+def forge_token(header):
+    """ Put together unsigned token with arbitrary header """
+    parts = [header, dict(user_id=1)]
+    parts = [json.dumps(part).encode('utf-8') for part in parts]
+    parts = [base64.urlsafe_b64encode(part).rstrip(b'=') for part in parts]
+    return b'.'.join(parts + [b'c2lnbmF0dXJl']).decode('utf-8')
+
+
+@attr('user', 'keyring')
+class KeyringTest(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.rsa = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.ec = ec.generate_private_key(ec.SECP256R1())
+        self.ed = ed25519.Ed25519PrivateKey.generate()
+
+    def test_shared_secret_tokens_have_no_kid(self):
+        """ Shared secret keyring signs tokens without kid header """
+        keyring = Keyring()
+        keyring.init(secret='secret', algorithm='HS256')
+        token = keyring.encode(dict(user_id=1))
+        self.assertNotIn('kid', jwt.get_unverified_header(token))
+        self.assertEqual(1, keyring.decode(token)['user_id'])
+        decoded = jwt.decode(token, 'secret', algorithms=['HS256'])
+        self.assertEqual(1, decoded['user_id'])
+
+    def test_keys_are_parsed_once(self):
+        """ PEM keys are parsed into key objects at init """
+        keyring = Keyring()
+        keyring.init(keys=dict(main=dict(
+            algorithm='RS256',
+            private_key=private_pem(self.rsa)
+        )), key_id='main')
+        key = keyring.get('main')
+        self.assertIsInstance(key.signing_key, rsa.RSAPrivateKey)
+        self.assertIsInstance(key.verifying_key, rsa.RSAPublicKey)
+
+    def test_asymmetric_algorithms(self):
+        """ Signing and verifying with RS256, ES256 and EdDSA keys """
+        for algorithm, key in [
+            ('RS256', self.rsa),
+            ('ES256', self.ec),
+            ('EdDSA', self.ed)
+        ]:
+            keyring = Keyring()
+            keyring.init(keys=dict(main=dict(
+                algorithm=algorithm,
+                private_key=private_pem(key)
+            )), key_id='main')
+            token = keyring.encode(dict(user_id=1))
+            header = jwt.get_unverified_header(token)
+            self.assertEqual('main', header['kid'])
+            self.assertEqual(algorithm, header['alg'])
+            self.assertEqual(1, keyring.decode(token)['user_id'])
+
+            # verifiable with public key alone
+            decoded = jwt.decode(token, public_pem(key), algorithms=[algorithm])
+            self.assertEqual(1, decoded['user_id'])
+
+    def test_rotation_keeps_old_tokens_valid(self):
+        """ Tokens signed with retired key verify with its public key """
+        old = Keyring()
+        old.init(keys=dict(old=dict(
+            algorithm='RS256',
+            private_key=private_pem(self.rsa)
+        )), key_id='old')
+        old_token = old.encode(dict(user_id=1))
+
+        keyring = Keyring()
+        keyring.init(keys=dict(
+            old=dict(algorithm='RS256', public_key=public_pem(self.rsa)),
+            new=dict(algorithm='ES256', private_key=private_pem(self.ec)),
+        ), key_id='new')
+        new_token = keyring.encode(dict(user_id=2))
+        self.assertEqual('new', jwt.get_unverified_header(new_token)['kid'])
+        self.assertEqual(1, keyring.decode(old_token)['user_id'])
+        self.assertEqual(2, keyring.decode(new_token)['user_id'])
+
+    def test_unknown_kid_fails_to_decode(self):
+        """ Tokens with unknown key id fail to decode """
+        other = Keyring()
+        other.init(keys=dict(other=dict(
+            algorithm='RS256',
+            private_key=private_pem(self.rsa)
+        )), key_id='other')
+        keyring = Keyring()
+        keyring.init(secret='secret')
+        with self.assertRaises(jwt.exceptions.DecodeError):
+            keyring.decode(other.encode(dict(user_id=1)))
+
+    def test_malformed_kid_fails_to_decode(self):
+        """ Tokens with non-string key id fail as decode errors """
+        keyring = Keyring()
+        keyring.init(secret='secret')
+        for kid in [123, ['main'], 'unknown']:
+            token = forge_token(dict(alg='HS256', typ='JWT', kid=kid))
+            with self.assertRaises(jwt.exceptions.DecodeError):
+                keyring.decode(token)
+
+    def test_only_key_algorithm_is_accepted(self):
+        """ Token can't switch algorithm of the key it claims """
+        keyring = Keyring()
+        keyring.init(keys=dict(main=dict(
+            algorithm='RS256',
+            public_key=public_pem(self.rsa)
+        )), secret='secret')
+        forged = jwt.encode(
+            dict(user_id=1),
+            'secret',
+            algorithm='HS512',
+            headers=dict(kid='main')
+        )
+        with self.assertRaises(jwt.exceptions.InvalidAlgorithmError):
+            keyring.decode(forged)
+
+    def test_fail_on_misconfiguration(self):
+        """ Misconfigured keys fail at init """
+        with self.assertRaises(x.ConfigurationException):
+            Keyring().init(secret='secret', algorithm='FAKE526')
+        with self.assertRaises(x.ConfigurationException):
+            Keyring().init(keys=dict(main=dict(
+                algorithm='RS256',
+                private_key='not a key'
+            )), key_id='main')
+        with self.assertRaises(x.ConfigurationException):
+            Keyring().init(keys=dict(main=dict(
+                algorithm='RS256',
+                public_key=public_pem(self.rsa)
+            )), key_id='main')
+
+    def test_jwks_publishes_public_keys_only(self):
+        """ JWKS contains public keys and never the shared secret """
+        keyring = Keyring()
+        keyring.init(secret='secret', keys=dict(main=dict(
+            algorithm='RS256',
+            private_key=private_pem(self.rsa)
+        )))
+        jwks = keyring.jwks()
+        self.assertEqual(1, len(jwks['keys']))
+        jwk = jwks['keys'][0]
+        self.assertEqual('main', jwk['kid'])
+        self.assertEqual('RSA', jwk['kty'])
+        self.assertNotIn('d', jwk)
+
+        public = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+        keyring.use('main')
+        token = keyring.encode(dict(user_id=1))
+        decoded = jwt.decode(token, public, algorithms=['RS256'])
+        self.assertEqual(1, decoded['user_id'])
@@ -0,0 +1,138 @@
+from nose.plugins.attrib import attr
+from tests.base_testcase import BaseTestCase
+
+from shiftuser.util.passlib import build_context, get_context
+from shiftuser.util import hash_benchmark
+
+
+@attr('user', 'passlib')
+class PasslibTests(BaseTestCase):
+
+    def test_build_context_from_config(self):
+        """ Building crypt context from config """
+        config = dict(PASSLIB_ALGO='bcrypt', PASSLIB_SCHEMES=['bcrypt'])
+        context = build_context(config)
+        self.assertTrue(context.hash('123').startswith('$2b$12$'))
+
+    def test_build_context_applies_rounds(self):
+        """ Crypt context uses configured rounds """
+        config = dict(
+            PASSLIB_ALGO='bcrypt',
+            PASSLIB_SCHEMES=['bcrypt', 'md5_crypt'],
+            PASSLIB_ROUNDS=dict(bcrypt=5)
+        )
+        context = build_context(config)
+        hash = context.hash('123')
+        self.assertTrue(hash.startswith('$2b$05$'))
+        self.assertTrue(context.verify('123', hash))
+
+    def test_get_context_for_current_app(self):
+        """ Crypt context is built once per app and cached """
+        context = get_context()
+        self.assertIs(context, get_context(self.app))
+        state = self.app.extensions['shiftuser']
+        self.assertIs(context, state['passlib_context'])
+
+    def test_get_context_per_app(self):
+        """ Each app gets crypt context built from its own config """
+        from boiler import bootstrap
+        from boiler.config import DefaultConfig
+        from shiftuser.config import UserConfig
+
+        class CustomConfig(DefaultConfig, UserConfig):
+            PASSLIB_ALGO = 'bcrypt'
+            PASSLIB_ROUNDS = dict(bcrypt=5)
+
+        app = bootstrap.create_app(__name__, config=CustomConfig())
+        context = get_context(app)
+        self.assertIsNot(context, get_context(self.app))
+        self.assertTrue(context.hash('123').startswith('$2b$05$'))
+        with app.app_context():
+            self.assertIs(context, get_context())
+
+    def test_get_context_requires_an_app(self):
+        """ Fail to get crypt context outside of app context """
+        import threading
+        errors = []
+
+        def get():
+            try:
+                get_context()
+            except RuntimeError as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=get)
+        thread.start()
+        thread.join()
+        self.assertEqual(1, len(errors))
+
+    def test_passlib_context_module_attribute(self):
+        """ Module level passlib_context resolves for current app """
+        from shiftuser.util.passlib import passlib_context
+        self.assertIs(get_context(), passlib_context)
+
+    def test_measure_scheme(self):
+        """ Measuring scheme hashing times """
+        result = hash_benchmark.measure('bcrypt', rounds=4, samples=1)
+        self.assertEqual('bcrypt', result['scheme'])
+        self.assertEqual(4, result['rounds'])
+        self.assertGreater(result['hash_ms'], 0)
+        self.assertGreater(result['verify_ms'], 0)
+
+    def test_benchmark_scheme_without_rounds(self):
+        """ No rounds recommendation for schemes without cost setting """
+        rounds, results = hash_benchmark.benchmark('md5_crypt', samples=1)
+        self.assertIsNone(rounds)
+        self.assertEqual(1, len(results))
+
+    def test_benchmark_recommends_rounds_within_target(self):
+        """ Recommend highest rounds within target time """
+        rounds, results = hash_benchmark.benchmark(
+            'bcrypt',
+            target_ms=10,
+            samples=1
+        )
+        self.assertGreaterEqual(rounds, 4)
+        within = [r for r in results if r['rounds'] == rounds][0]
+        if rounds > 4:
+            self.assertLessEqual(within['verify_ms'], 10)
+        self.assertGreater(results[-1]['verify_ms'], 10)
+
+    def test_write_setting_keeps_other_lines(self):
+        """ Writing rounds setting replaces only its own line """
+        import os, tempfile
+        fd, path = tempfile.mkstemp(suffix='.py')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write("SECRET_KEY = 'secret'\n")
+                file.write("PASSLIB_ROUNDS = {'bcrypt': 4}\n")
+                file.write("DEBUG = False\n")
+
+            hash_benchmark.write_setting(path, dict(bcrypt=12))
+            with open(path) as file:
+                lines = file.read().splitlines()
+            self.assertEqual([
+                "SECRET_KEY = 'secret'",
+                "PASSLIB_ROUNDS = {'bcrypt': 12}",
+                "DEBUG = False",
+            ], lines)
+        finally:
+            os.remove(path)
+
+    def test_write_setting_appends_when_missing(self):
+        """ Writing rounds setting appends it to a config without one """
+        import os, tempfile
+        fd, path = tempfile.mkstemp(suffix='.py')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write("DEBUG = False")
+
+            hash_benchmark.write_setting(path, dict(bcrypt=12))
+            with open(path) as file:
+                lines = file.read().splitlines()
+            self.assertEqual(
+                ["DEBUG = False", "PASSLIB_ROUNDS = {'bcrypt': 12}"],
+                lines
+            )
+        finally:
+            os.remove(path)
@@ -0,0 +1,81 @@
+from unittest import mock
+from nose.plugins.attrib import attr
+from tests.base_testcase import BaseTestCase
+
+from shiftuser.util.permissions import PermissionRegistry
+
+
+@attr('role', 'permissions')
+class PermissionRegistryTest(BaseTestCase):
+
+    def test_register_assigns_bits(self):
+        """ Every permission gets its own bit """
+        registry = PermissionRegistry()
+        self.assertEqual(1, registry.register('post.edit'))
+        self.assertEqual(2, registry.register('post.delete'))
+        self.assertEqual(1, registry.register('post.edit'))
+
+    def test_mask_and_names(self):
+        """ Converting permission names to mask and back """
+        registry = PermissionRegistry()
+        mask = registry.mask(['post.edit', 'post.delete'])
+        self.assertEqual(3, mask)
+        self.assertEqual(['post.edit', 'post.delete'], registry.names(mask))
+
+    def test_allows(self):
+        """ Checking permission in a mask """
+        registry = PermissionRegistry()
+        mask = registry.mask(['post.edit'])
+        registry.register('post.delete')
+        self.assertTrue(registry.allows(mask, 'post.edit'))
+        self.assertFalse(registry.allows(mask, 'post.delete'))
+        self.assertFalse(registry.allows(mask, 'unknown'))
+        self.assertNotIn('unknown', registry.flags)
+
+    def test_roles_mask(self):
+        """ Mask of roles combines masks of every role """
+        loader = mock.Mock(return_value=[
+            ('editor', 'post.edit'),
+            ('admin', 'post.delete'),
+            ('admin', 'user.ban'),
+        ])
+        registry = PermissionRegistry(loader=loader)
+        mask = registry.roles_mask(frozenset(['editor', 'admin']))
+        self.assertEqual(
+            {'post.edit', 'post.delete', 'user.ban'},
+            set(registry.names(mask))
+        )
+        self.assertEqual(0, registry.roles_mask(frozenset(['user'])))
+        loader.assert_called_once_with()
+
+    def test_reload_after_invalidation(self):
+        """ Role masks get reloaded on first use after invalidation """
+        loader = mock.Mock(return_value=[('editor', 'post.edit')])
+        registry = PermissionRegistry(loader=loader)
+        handles = frozenset(['editor'])
+        self.assertEqual(1, registry.roles_mask(handles))
+
+        loader.return_value = [('editor', 'post.delete')]
+        registry.invalidate()
+        self.assertEqual(2, registry.roles_mask(handles))
+        self.assertEqual(2, loader.call_count)
+
+    def test_reload_after_refresh_interval(self):
+        """ Permissions changed by another process get picked up """
+        loader = mock.Mock(return_value=[('editor', 'post.edit')])
+        registry = PermissionRegistry(loader=loader, refresh_interval=30)
+        handles = frozenset(['editor'])
+        self.assertEqual(1, registry.roles_mask(handles))
+
+        version = registry.version
+        loader.return_value = [('editor', 'post.delete')]
+        self.assertEqual(1, registry.roles_mask(handles))
+
+        registry._refreshed_at -= 30
+        self.assertEqual(2, registry.roles_mask(handles))
+        self.assertEqual(version + 1, registry.version)
+
+        registry._refreshed_at -= 30
+        registry.roles_mask(handles)
+        self.assertEqual(version + 1, registry.version) # unchanged
+        self.assertEqual(3, loader.call_count)
@@ -0,0 +1,183 @@
+from datetime import datetime, timedelta
+from unittest import mock
+from nose.plugins.attrib import attr
+from tests.base_testcase import BaseTestCase
+
+from flask_principal import RoleNeed
+from shiftuser.models import User, Role
+from shiftuser.services import role_service
+from shiftuser.util.principal import NeedsCache, AuthenticatedUser
+from shiftuser.util.principal import LazyNeeds, UserIdentity
+
+
+@attr('user', 'principal')
+class PrincipalTest(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create_db()
+
+    def create_user(self):
+        """ Create a user with a role """
+        role = Role(handle='demo', title='Demo role')
+        role_service.save(role)
+        user = User(email='test@test.com', password='123456')
+        user.id = 123
+        user.add_role(role)
+        return user
+
+    # -------------------------------------------------------------------------
+    # Needs cache
+    # -------------------------------------------------------------------------
+
+    def test_needs_cache_interns_role_needs(self):
+        """ Every role handle maps to a single need object """
+        cache = NeedsCache()
+        self.assertIs(cache.role_need('demo'), cache.role_need('demo'))
+        self.assertEqual(RoleNeed('demo'), cache.role_need('demo'))
+
+    def test_needs_cache_skips_unsaved_users(self):
+        """ Needs of users without id are not cached """
+        cache = NeedsCache()
+        user = User()
+        self.assertEqual({RoleNeed('user')}, cache.get(user))
+        self.assertEqual(0, len(cache.cache))
+
+    def test_needs_cache_deletes_user_needs(self):
+        """ Deleting user drops its cached needs """
+        cache = NeedsCache()
+        user = self.create_user()
+        cache.get(user)
+        self.assertEqual(1, len(cache.cache))
+        cache.delete(user)
+        self.assertEqual(0, len(cache.cache))
+
+    # -------------------------------------------------------------------------
+    # Authenticated user
+    # -------------------------------------------------------------------------
+
+    def test_create_authenticated_user_from_entity(self):
+        """ Creating authenticated user from user entity """
+        user = self.create_user()
+        authenticated = AuthenticatedUser.from_user(user)
+        self.assertEqual(123, authenticated.id)
+        self.assertEqual('test@test.com', authenticated.email)
+        self.assertEqual({'user', 'demo'}, authenticated.roles)
+        self.assertIs(user.provide_principal_needs(), authenticated.needs)
+        self.assertEqual(user.permission_mask, authenticated.permission_mask)
+        self.assertIs(user, authenticated.entity)
+
+    def test_authenticated_user_checks_permissions(self):
+        """ Checking authenticated user permissions """
+        role = Role(handle='editor', title='Editor')
+        role.grant('post.edit')
+        role_service.save(role)
+        user = User(email='test@test.com', password='123456')
+        user.add_role(role)
+        authenticated = AuthenticatedUser.from_user(user)
+        self.assertTrue(authenticated.can('post.edit'))
+        self.assertFalse(authenticated.can('post.delete'))
+
+    def test_authenticated_user_has_no_dict(self):
+        """ Authenticated user is a slotted object """
+        authenticated = AuthenticatedUser.from_user(self.create_user())
+        self.assertFalse(hasattr(authenticated, '__dict__'))
+
+    def test_authenticated_user_implements_login_protocol(self):
+        """ Authenticated user works with flask-login """
+        authenticated = AuthenticatedUser.from_user(self.create_user())
+        self.assertTrue(authenticated.is_authenticated)
+        self.assertTrue(authenticated.is_active)
+        self.assertFalse(authenticated.is_anonymous)
+        self.assertEqual('123', authenticated.get_id())
+
+        authenticated.locked_until = datetime.utcnow() + timedelta(minutes=5)
+        self.assertFalse(authenticated.is_active)
+
+    def test_authenticated_user_checks_roles(self):
+        """ Checking authenticated user roles by handle or role """
+        user = self.create_user()
+        authenticated = AuthenticatedUser.from_user(user)
+        self.assertTrue(authenticated.has_role('demo'))
+        self.assertTrue(authenticated.has_role(user.roles[0]))
+        self.assertFalse(authenticated.has_role('admin'))
+        self.assertTrue(authenticated.has_any_role('admin', 'demo'))
+        self.assertTrue(authenticated.has_all_roles('user', 'demo'))
+        self.assertFalse(authenticated.has_all_roles('admin', 'demo'))
+        needs = authenticated.provide_principal_needs()
+        self.assertIn(RoleNeed('demo'), needs)
+
+    def test_authenticated_user_loads_entity_lazily(self):
+        """ Entity is loaded once, on first access to its attributes """
+        user = self.create_user()
+        loader = mock.Mock(return_value=user)
+        authenticated = AuthenticatedUser(
+            id=123,
+            email='test@test.com',
+            roles=frozenset(['user']),
+            needs=frozenset([RoleNeed('user')]),
+            loader=loader
+        )
+
+        self.assertTrue(authenticated.has_role('user'))
+        loader.assert_not_called()
+
+        self.assertEqual(user.email_secure, authenticated.email_secure)
+        self.assertIs(user, authenticated.entity)
+        loader.assert_called_once_with(123)
+
+    def test_authenticated_user_private_attributes_are_not_delegated(self):
+        """ Private entity attributes are not looked up """
+        loader = mock.Mock()
+        authenticated = AuthenticatedUser(
+            123, 'a@b.c', frozenset(), frozenset(), loader=loader
+        )
+        with self.assertRaises(AttributeError):
+            authenticated._password
+        loader.assert_not_called()
+
+    # -------------------------------------------------------------------------
+    # Lazy needs
+    # -------------------------------------------------------------------------
+
+    def test_lazy_needs_resolve_on_first_access(self):
+        """ Needs are not provided until accessed """
+        provider = mock.Mock(return_value=frozenset([RoleNeed('user')]))
+        needs = LazyNeeds(provider)
+        self.assertFalse(needs.resolved)
+        provider.assert_not_called()
+
+        self.assertIn(RoleNeed('user'), needs)
+        self.assertTrue(needs.resolved)
+        self.assertEqual(1, len(needs))
+        self.assertEqual({RoleNeed('user')}, needs.intersection(needs))
+        self.assertEqual(set(), needs & {RoleNeed('admin')})
+        provider.assert_called_once_with()
+
+    def test_lazy_needs_keep_added_needs(self):
+        """ Needs added before resolving are merged in """
+        provider = mock.Mock(return_value=[RoleNeed('user')])
+        needs = LazyNeeds(provider, {RoleNeed('existing')})
+        needs.add(RoleNeed('added'))
+        needs.update([RoleNeed('updated')])
+        provider.assert_not_called()
+
+        expected = {
+            RoleNeed('user'),
+            RoleNeed('existing'),
+            RoleNeed('added'),
+            RoleNeed('updated'),
+        }
+        self.assertEqual(expected, set(needs))
+
+        needs.discard(RoleNeed('added'))
+        needs.add(RoleNeed('late'))
+        self.assertNotIn(RoleNeed('added'), needs)
+        self.assertIn(RoleNeed('late'), needs)
+
+    def test_user_identity_permission_mask(self):
+        """ User identity resolves permission mask from user """
+        identity = UserIdentity(123)
+        self.assertEqual(0, identity.permission_mask)
+        identity.user = mock.Mock(is_authenticated=True, permission_mask=5)
+        self.assertEqual(5, identity.permission_mask)
@@ -0,0 +1,124 @@
+import os
+import time
+import tempfile
+import multiprocessing
+from nose.plugins.attrib import attr
+from tests.base_testcase import BaseTestCase
+
+from shiftuser import exceptions as x
+from shiftuser.util.revocation import RevocationStore, MAX_PROBES
+
+
+def revoke_in_child(path, key):
+    """ Revoke a key from another process """
+    store = RevocationStore(path)
+    store.add(key, time.time() + 60)
+
+
+@attr('user', 'revocation')
+class RevocationStoreTest(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'revoked')
+
+    def test_create_store_file(self):
+        """ Store file is created on first use """
+        store = RevocationStore(self.path, capacity=128)
+        self.assertFalse(store.is_revoked('jti:123'))
+        self.assertTrue(os.path.isfile(self.path))
+        self.assertEqual(0, len(store))
+
+    def test_add_and_check(self):
+        """ Revoking keys """
+        store = RevocationStore(self.path, capacity=128)
+        store.add('jti:123', time.time() + 60)
+        self.assertTrue(store.is_revoked('jti:123'))
+        self.assertFalse(store.is_revoked('jti:456'))
+        self.assertEqual(1, len(store))
+
+    def test_expired_entries_are_not_revoked(self):
+        """ Entries are only kept until revoked token would expire """
+        store = RevocationStore(self.path, capacity=128)
+        store.add('jti:123', time.time() - 1)
+        self.assertFalse(store.is_revoked('jti:123'))
+        self.assertEqual(0, len(store))
+
+    def test_expired_slots_are_reused(self):
+        """ Expired entries free their slots """
+        store = RevocationStore(self.path, capacity=4)
+        for i in range(4):
+            store.add('expired:{}'.format(i), time.time() - 1)
+        for i in range(4):
+            store.add('jti:{}'.format(i), time.time() + 60)
+        for i in range(4):
+            self.assertTrue(store.is_revoked('jti:{}'.format(i)))
+
+    def test_probes_are_bounded_when_table_is_full_of_expired_entries(self):
+        """ Checking a key never scans past its probe window """
+        from shiftuser.util import revocation
+        store = RevocationStore(self.path, capacity=256)
+        for index in range(256):
+            offset = revocation.HEADER.size + index * revocation.SLOT.size
+            revocation.SLOT.pack_into(store.map, offset, index + 1, 1.0)
+        self.assertEqual(0, len(store))
+
+        self.assertEqual(MAX_PROBES, len(list(store.slots('jti:missing'))))
+        self.assertFalse(store.is_revoked('jti:missing'))
+        store.add('jti:new', time.time() + 60)
+        self.assertTrue(store.is_revoked('jti:new'))
+
+    def test_reusing_expired_slot_keeps_key_unique(self):
+        """ Re-adding a key updates its entry past expired slots """
+        store = RevocationStore(self.path, capacity=4)
+        store.add('expired', time.time() + 60)
+        store.add('jti:1', time.time() + 60)
+        store.add('jti:2', time.time() + 60)
+        store.add('jti:1', time.time() + 120)
+        self.assertEqual(3, len(store))
+
+    def test_raise_when_full(self):
+        """ Raise when there's no free slot """
+        store = RevocationStore(self.path, capacity=2)
+        store.add('jti:1', time.time() + 60)
+        store.add('jti:2', time.time() + 60)
+        with self.assertRaises(x.RevocationStoreFull):
+            store.add('jti:3', time.time() + 60)
+
+    def test_existing_file_capacity_takes_precedence(self):
+        """ Capacity is read from existing store file """
+        RevocationStore(self.path, capacity=16).add('jti:1', time.time() + 60)
+        store = RevocationStore(self.path, capacity=1024)
+        self.assertTrue(store.is_revoked('jti:1'))
+        self.assertEqual(16, store.capacity)
+
+    def test_refuse_foreign_file(self):
+        """ Refuse to use a file that is not a revocation store """
+        with open(self.path, 'wb') as file:
+            file.write(b'something else entirely')
+        with self.assertRaises(x.ConfigurationException):
+            RevocationStore(self.path).is_revoked('jti:1')
+
+    def test_revocations_are_shared_between_processes(self):
+        """ Keys revoked in one process are seen by others """
+        store = RevocationStore(self.path, capacity=128)
+        self.assertFalse(store.is_revoked('jti:123'))
+
+        context = multiprocessing.get_context('fork')
+        process = context.Process(
+            target=revoke_in_child,
+            args=(self.path, 'jti:123')
+        )
+        process.start()
+        process.join()
+        self.assertEqual(0, process.exitcode)
+        self.assertTrue(store.is_revoked('jti:123'))
+
+    def test_clear(self):
+        """ Clearing store """
+        store = RevocationStore(self.path, capacity=128)
+        store.add('jti:123', time.time() + 60)
+        store.clear()
+        self.assertFalse(store.is_revoked('jti:123'))
@@ -5,7 +5,7 @@ from shiftschema.result import Result
 
 from shiftuser.role_service import RoleService
 from shiftuser.services import role_service
-from shiftuser.models import Role
+from shiftuser.models import User, Role
 from shiftuser import events
 
 
@@ -86,4 +86,112 @@ class RoleServiceTests(BaseTestCase):
             spy = mock.Mock()
             events.role_deleted_event.connect(spy, weak=False)
             role_service.delete(role)
-            spy.assert_called_with(role)
\ No newline at end of file
+            spy.assert_called_with(role)
+
+    # ------------------------------------------------------------------------
+    # Hierarchy
+    # ------------------------------------------------------------------------
+
+    def test_create_role_extending_parent(self):
+        """ Creating role that extends a parent role """
+        editor = role_service.create('editor')
+        admin = role_service.create('admin', parent=editor)
+        self.assertEqual(editor.id, admin.parent_id)
+        self.assertIn(admin, editor.children)
+
+    def test_role_can_not_extend_itself(self):
+        """ Cycles in role hierarchy are rejected """
+        editor = role_service.create('editor')
+        admin = role_service.create('admin', parent=editor)
+        editor.parent = admin
+        res = role_service.save(editor)
+        self.assertIsInstance(res, Result)
+        self.assertIn('parent', res.errors)
+
+    def test_user_has_implied_roles(self):
+        """ User with a role has roles it extends implied """
+        author = role_service.create('author')
+        editor = role_service.create('editor', parent=author)
+        admin = role_service.create('admin', parent=editor)
+        user = User(email='test@test.com', password='123456')
+        user.id = 123
+        user.add_role(admin)
+        self.assertTrue(user.has_all_roles('admin', 'editor', 'author'))
+        self.assertFalse(user.has_role('moderator'))
+        needs = [need.value for need in user.provide_principal_needs()]
+        self.assertEqual({'user', 'admin', 'editor', 'author'}, set(needs))
+
+    def test_changing_hierarchy_updates_implied_roles(self):
+        """ Saving role rebuilds hierarchy and drops cached needs """
+        editor = role_service.create('editor')
+        admin = role_service.create('admin')
+        user = User(email='test@test.com', password='123456')
+        user.id = 123
+        user.add_role(admin)
+        self.assertFalse(user.has_role('editor'))
+        self.assertEqual(2, len(user.provide_principal_needs()))
+
+        admin.parent = editor
+        role_service.save(admin)
+        self.assertTrue(user.has_role('editor'))
+        self.assertEqual(3, len(user.provide_principal_needs()))
+
+    def test_deleting_parent_role_detaches_children(self):
+        """ Deleting a role leaves roles extending it without parent """
+        editor = role_service.create('editor')
+        admin = role_service.create('admin', parent=editor)
+        user = User(email='test@test.com', password='123456')
+        user.add_role(admin)
+        self.assertTrue(user.has_role('editor'))
+
+        role_service.delete(editor)
+        self.assertIsNone(admin.parent_id)
+        self.assertFalse(user.has_role('editor'))
+
+    # ------------------------------------------------------------------------
+    # Permissions
+    # ------------------------------------------------------------------------
+
+    def test_grant_and_revoke_permissions(self):
+        """ Granting and revoking role permissions """
+        role = role_service.create('editor')
+        role.grant('post.edit')
+        role.grant('post.edit')
+        role.grant('post.publish')
+        role_service.save(role)
+        self.assertEqual(('post.edit', 'post.publish'), role.permissions)
+
+        role.revoke('post.publish')
+        role_service.save(role)
+        self.assertEqual(('post.edit',), role.permissions)
+
+    def test_role_permission_mask_includes_parents(self):
+        """ Role mask has permissions of roles it extends """
+        from shiftuser.models import permission_registry
+        editor = role_service.create('editor')
+        editor.grant('post.edit')
+        role_service.save(editor)
+        admin = role_service.create('admin', parent=editor)
+        admin.grant('user.ban')
+        role_service.save(admin)
+
+        names = permission_registry.names(admin.permission_mask)
+        self.assertEqual({'post.edit', 'user.ban'}, set(names))
+        names = permission_registry.names(editor.permission_mask)
+        self.assertEqual(['post.edit'], names)
+
+    def test_user_can(self):
+        """ Checking user permissions """
+        editor = role_service.create('editor')
+        editor.grant('post.edit')
+        role_service.save(editor)
+        user = User(email='test@test.com', password='123456')
+        self.assertFalse(user.can('post.edit'))
+
+        user.add_role(editor)
+        self.assertTrue(user.can('post.edit'))
+        self.assertFalse(user.can('post.delete'))
+
+        editor.revoke('post.edit')
+        role_service.save(editor)
+        self.assertFalse(user.can('post.edit'))
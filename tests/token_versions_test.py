@@ -0,0 +1,64 @@
+import time
+from unittest import mock
+from nose.plugins.attrib import attr
+from tests.base_testcase import BaseTestCase
+
+from datetime import datetime, timedelta
+from shiftuser.util.token_versions import TokenVersions
+
+
+@attr('user', 'token_versions')
+class TokenVersionsTest(BaseTestCase):
+
+    def test_users_default_to_version_zero(self):
+        """ Users not in the map are at version zero """
+        versions = TokenVersions(loader=lambda since: [])
+        self.assertEqual(0, versions.get(123))
+
+    def test_loads_versions_initially(self):
+        """ Initial load passes no watermark """
+        loader = mock.Mock(return_value=[(1, 2, datetime.utcnow())])
+        versions = TokenVersions(loader=loader)
+        self.assertEqual(2, versions.get(1))
+        loader.assert_called_once_with(None)
+
+    def test_refreshes_incrementally(self):
+        """ Refresh asks only for changes since last seen one """
+        changed = datetime.utcnow()
+        loader = mock.Mock(return_value=[(1, 1, changed)])
+        versions = TokenVersions(loader=loader, refresh_interval=0)
+        versions.get(1)
+
+        loader.return_value = [(2, 3, changed + timedelta(seconds=1))]
+        self.assertEqual(3, versions.get(2))
+        self.assertEqual(1, versions.get(1))
+        loader.assert_any_call(changed)
+
+    def test_does_not_refresh_within_interval(self):
+        """ Map is not reloaded until refresh interval passes """
+        loader = mock.Mock(return_value=[])
+        versions = TokenVersions(loader=loader, refresh_interval=60)
+        versions.get(1)
+        versions.get(1)
+        self.assertEqual(1, loader.call_count)
+
+    def test_concurrent_refresh_runs_once(self):
+        """ Threads finding the map stale at once refresh it only once """
+        import threading
+        barrier = threading.Barrier(4)
+        def loader(since):
+            time.sleep(0.05)
+            return []
+
+        loader = mock.Mock(side_effect=loader)
+        versions = TokenVersions(loader=loader, refresh_interval=60)
+        def get():
+            barrier.wait()
+            versions.get(1)
+
+        threads = [threading.Thread(target=get) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, loader.call_count)
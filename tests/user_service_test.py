@@ -1,3 +1,4 @@
+import re
 from unittest import mock
 from nose.plugins.attrib import attr
 from tests.base_testcase import BaseTestCase
@@ -13,8 +14,11 @@ from shiftuser.feature import user_feature
 from shiftuser.services import user_service, role_service
 from shiftuser import events, exceptions as x
 from shiftuser.events import events as user_events
-from shiftuser.models import User, Role
+from shiftuser.models import User, Role, UserToken
+from shiftuser.models import role_hierarchy, permission_registry
 from shiftuser.user_service import UserService
+from shiftuser.cache import TTLCache
+from shiftuser.util.principal import AuthenticatedUser
 from boiler.config import DefaultConfig
 from boiler import bootstrap
 
@@ -212,6 +216,299 @@ class UserServiceTests(BaseTestCase):
             current_user = None  # None, since mocked
             spy.assert_called_with(current_user)
 
+    def test_hash_and_verify_password(self):
+        """ Hashing and verifying passwords via service """
+        user = self.create_user()
+        user._password = user_service.hash_password('new-password')
+        self.assertTrue(user_service.verify_password(user, 'new-password'))
+        self.assertFalse(user_service.verify_password(user, 'BAD!'))
+
+    def test_hash_passwords_in_bulk(self):
+        """ Hashing passwords in bulk on a process pool """
+        from shiftuser.util.passlib import get_context
+        passwords = ['password-{}'.format(i) for i in range(6)]
+        hashes = user_service.hash_passwords_bulk(passwords, workers=2)
+        self.assertEqual(len(passwords), len(hashes))
+        for password, hash in zip(passwords, hashes):
+            self.assertTrue(get_context().verify(password, hash))
+
+    def test_create_users_in_bulk(self):
+        """ Creating users in bulk """
+        data = [
+            dict(email='one@test.com', password='111111'),
+            dict(email='two@test.com', password='222222'),
+        ]
+        with user_events.disconnect_receivers():
+            users = user_service.create_users_bulk(data, workers=2)
+        self.assertEqual(2, len(users))
+        for user, user_data in zip(users, data):
+            self.assertIsNotNone(user.id)
+            self.assertEqual(user_data['email'], user.email)
+            self.assertTrue(user.verify_password(user_data['password']))
+
+    def test_create_users_in_bulk_returns_validation_errors(self):
+        """ Nothing created in bulk if any of the users is invalid """
+        data = [
+            dict(email='one@test.com', password='111111'),
+            dict(email='not-an-email', password='222222'),
+        ]
+        with user_events.disconnect_receivers():
+            with mock.patch.object(user_service, 'hash_passwords_bulk') as bulk:
+                result = user_service.create_users_bulk(data, workers=1)
+                bulk.assert_not_called()
+        self.assertIsInstance(result, Result)
+        self.assertIsNone(user_service.first(email='one@test.com'))
+
+    def test_create_users_in_bulk_rejects_duplicate_emails(self):
+        """ Emails repeated within a batch are rejected before hashing """
+        data = [
+            dict(email='one@test.com', password='111111'),
+            dict(email=' ONE@test.com', password='222222'),
+        ]
+        with mock.patch.object(user_service, 'hash_passwords_bulk') as bulk:
+            with user_events.disconnect_receivers():
+                result = user_service.create_users_bulk(data, workers=1)
+            bulk.assert_not_called()
+        self.assertIsInstance(result, Result)
+        self.assertIn('email', result.errors)
+        self.assertIsNone(user_service.first(email='one@test.com'))
+
+    def test_verify_password_on_hashing_pool(self):
+        """ Verifying passwords on a thread pool """
+        user = self.create_user()
+        user_service.hashing_pool.init(2)
+        try:
+            self.assertTrue(user_service.verify_password(user, '123456'))
+            self.assertFalse(user_service.verify_password(user, 'BAD!'))
+            self.assertIsNotNone(user_service.hashing_pool.executor)
+        finally:
+            user_service.hashing_pool.init(None)
+
+    def test_verify_password_fails_for_users_without_password(self):
+        """ Password verification fails if user has no password """
+        user = User(email='test@test.com')
+        self.assertFalse(user_service.verify_password(user, '123456'))
+
+    def test_login_async(self):
+        """ Can login with awaitable login """
+        import asyncio
+        user = self.create_user()
+        user_service.hashing_pool.init(2)
+        try:
+            with user_events.disconnect_receivers():
+                with self.app.test_request_context():
+                    res = asyncio.run(
+                        user_service.login_async(user.email, '123456')
+                    )
+                    self.assertTrue(res)
+                    self.assertTrue(current_user.is_authenticated)
+        finally:
+            user_service.hashing_pool.init(None)
+
+    def test_login_async_fails_with_bad_credentials(self):
+        """ Awaitable login fails with bad credentials """
+        import asyncio
+        user = self.create_user()
+        with user_events.disconnect_receivers():
+            with self.app.test_request_context():
+                res = asyncio.run(user_service.login_async(user.email, 'BAD!'))
+                self.assertFalse(res)
+                self.assertEqual(1, user.failed_logins)
+
+    def test_login_upgrades_legacy_password_hash(self):
+        """ Legacy password hash gets upgraded and saved on login """
+        from passlib.hash import bcrypt
+        from shiftuser.util.passlib import passlib_context
+        user = self.create_user()
+        user._password = bcrypt.using(rounds=4).hash('123456')
+        with user_events.disconnect_receivers():
+            user_service.save(user)
+            self.assertEqual(1, user_service.count_legacy_hashes())
+            upgraded = user_service.upgraded_hashes
+            with self.app.test_request_context():
+                self.assertTrue(user_service.login(user.email, '123456'))
+
+        self.db.session.expire_all()
+        user = user_service.get(user.id)
+        self.assertFalse(passlib_context.needs_update(user.password))
+        self.assertEqual(upgraded + 1, user_service.upgraded_hashes)
+        self.assertEqual(0, user_service.legacy_hashes)
+        self.assertEqual(0, user_service.count_legacy_hashes())
+
+    def test_hash_upgrade_not_counted_when_login_fails(self):
+        """ Upgraded hash of a locked account is neither saved nor counted """
+        from passlib.hash import bcrypt
+        user = self.create_user()
+        legacy = bcrypt.using(rounds=4).hash('123456')
+        user._password = legacy
+        user.locked_until = datetime.utcnow() + timedelta(minutes=10)
+        with user_events.disconnect_receivers():
+            user_service.save(user)
+            self.assertEqual(1, user_service.count_legacy_hashes())
+            upgraded = user_service.upgraded_hashes
+            with self.app.test_request_context():
+                with self.assertRaises(x.AccountLocked):
+                    user_service.login(user.email, '123456')
+
+        self.assertEqual(upgraded, user_service.upgraded_hashes)
+        self.assertEqual(1, user_service.legacy_hashes)
+        self.db.session.rollback()
+        self.db.session.expire_all()
+        self.assertEqual(legacy, user_service.get(user.id).password)
+
+    def test_legacy_hashes_counted_on_first_access(self):
+        """ Legacy hashes get counted when first asked for """
+        from passlib.hash import bcrypt
+        user = self.create_user()
+        user._password = bcrypt.using(rounds=4).hash('123456')
+        with user_events.disconnect_receivers():
+            user_service.save(user)
+
+        user_service._legacy_hashes = None
+        self.assertEqual(1, user_service.legacy_hashes)
+        with user_events.disconnect_receivers():
+            with self.app.test_request_context():
+                self.assertTrue(user_service.login(user.email, '123456'))
+        self.assertEqual(0, user_service.legacy_hashes)
+
+    def test_failed_login_does_not_upgrade_legacy_hash(self):
+        """ Legacy password hash stays in place if login failed """
+        from passlib.hash import bcrypt
+        user = self.create_user()
+        legacy = bcrypt.using(rounds=4).hash('123456')
+        user._password = legacy
+        with user_events.disconnect_receivers():
+            user_service.save(user)
+            with self.app.test_request_context():
+                self.assertFalse(user_service.login(user.email, 'BAD!'))
+        self.assertEqual(legacy, user.password)
+
+    def test_login_fails_fast_when_overloaded(self):
+        """ Reject login when too many verifications are in flight """
+        user = self.create_user()
+        limiter = user_service.password_limiter
+        limiter.init(limit=1, queue_size=0)
+        try:
+            self.assertTrue(limiter.admit())  # occupy the only slot
+            with user_events.disconnect_receivers():
+                with self.app.test_request_context():
+                    with self.assertRaises(x.LoginOverloaded):
+                        user_service.login(user.email, '123456')
+
+            stats = limiter.stats()
+            self.assertEqual(1, stats['in_flight'])
+            self.assertEqual(1, stats['rejected'])
+            limiter.release()
+            self.assertEqual(0, limiter.stats()['in_flight'])
+        finally:
+            limiter.init()
+
+    def test_queued_verification_waits_for_a_slot(self):
+        """ Queued password verification proceeds once a slot frees up """
+        import threading
+        user = self.create_user()
+        limiter = user_service.password_limiter
+        limiter.init(limit=1, queue_size=1, timeout=5)
+        results = []
+        try:
+            self.assertTrue(limiter.admit())  # occupy the only slot
+            def verify():
+                with self.app.app_context():
+                    verified = user_service.verify_password(user, '123456')
+                results.append(verified)
+
+            thread = threading.Thread(target=verify)
+            thread.start()
+            while not limiter.stats()['waiting']:
+                pass
+            limiter.release()
+            thread.join()
+            self.assertEqual([True], results)
+            self.assertEqual(0, limiter.stats()['rejected'])
+        finally:
+            limiter.init()
+
+    def test_async_waiter_gets_slot_handed_over(self):
+        """ Queued async task proceeds once a slot frees up """
+        import asyncio
+        limiter = user_service.password_limiter
+        limiter.init(limit=1, queue_size=1, timeout=5)
+
+        async def run():
+            self.assertTrue(limiter.admit())  # occupy the only slot
+            async def queued():
+                async with limiter.slot_async():
+                    return limiter.stats()['in_flight']
+
+            task = asyncio.ensure_future(queued())
+            while not limiter.stats()['waiting']:
+                await asyncio.sleep(0)
+            limiter.release()
+            return await task
+
+        try:
+            self.assertEqual(1, asyncio.run(run()))
+            stats = limiter.stats()
+            self.assertEqual(0, stats['in_flight'])
+            self.assertEqual(0, stats['waiting'])
+        finally:
+            limiter.init()
+
+    def test_cancelled_async_waiter_does_not_leak_slot(self):
+        """ Cancelling a queued async task leaves no slot taken """
+        import asyncio
+        limiter = user_service.password_limiter
+        limiter.init(limit=1, queue_size=1, timeout=5)
+
+        async def run():
+            self.assertTrue(limiter.admit())  # occupy the only slot
+            async def queued():
+                async with limiter.slot_async():
+                    pass
+
+            task = asyncio.ensure_future(queued())
+            while not limiter.stats()['waiting']:
+                await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            limiter.release()
+            await asyncio.sleep(0)
+
+        try:
+            asyncio.run(run())
+            stats = limiter.stats()
+            self.assertEqual(0, stats['in_flight'])
+            self.assertEqual(0, stats['waiting'])
+            self.assertTrue(limiter.admit())
+            limiter.release()
+        finally:
+            limiter.init()
+
+    def test_async_waiter_times_out(self):
+        """ Queued async task is rejected when no slot frees up in time """
+        import asyncio
+        limiter = user_service.password_limiter
+        limiter.init(limit=1, queue_size=1, timeout=0.01)
+
+        async def run():
+            async with limiter.slot_async():
+                pass
+
+        try:
+            self.assertTrue(limiter.admit())  # occupy the only slot
+            with self.assertRaises(x.LoginOverloaded):
+                asyncio.run(run())
+            limiter.release()
+            stats = limiter.stats()
+            self.assertEqual(0, stats['in_flight'])
+            self.assertEqual(0, stats['waiting'])
+            self.assertEqual(1, stats['rejected'])
+            self.assertTrue(limiter.admit())
+            limiter.release()
+        finally:
+            limiter.init()
+
     # -------------------------------------------------------------------------
     # Account locks and counting bad logins
     # -------------------------------------------------------------------------
@@ -236,6 +533,57 @@ class UserServiceTests(BaseTestCase):
                 self.assertEqual(0, user.failed_logins)
                 self.assertTrue(user.is_locked())
 
+    def test_record_failed_login_in_one_statement(self):
+        """ Failed login is counted with a single update """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            user.failed_logins
+            queries = self.count_queries()
+            user_service.record_failed_login(user)
+            self.assertEqual(1, len(queries))
+            self.assertTrue(queries[0].startswith('UPDATE'))
+            self.assertEqual(1, user.failed_logins)
+
+    def test_record_failed_login_does_not_lose_increments(self):
+        """ Failed logins counted elsewhere meanwhile are not lost """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            self.assertEqual(0, user.failed_logins)
+
+            # another worker counts a failed login for the same user
+            table = User.__table__
+            with self.db.engine.begin() as connection:
+                connection.execute(table.update().where(
+                    table.c.id == user.id
+                ).values(failed_logins=table.c.failed_logins + 1))
+
+            user_service.record_failed_login(user)
+            self.assertEqual(2, user.failed_logins)
+
+    def test_record_failed_login_locks_on_reaching_limit(self):
+        """ Reaching failed logins limit locks account in database """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            user.failed_logins = User.failed_login_limit
+            user_service.save(user)
+            user_service.record_failed_login(user)
+            self.assertEqual(0, user.failed_logins)
+            self.assertTrue(user.is_locked())
+            expected = datetime.utcnow() + timedelta(
+                minutes=User.failed_login_lock_minutes
+            )
+            delta = expected - user.locked_until
+            self.assertLess(abs(delta.total_seconds()), 5)
+
+    def test_record_failed_login_emits_save_event(self):
+        """ Recording failed login emits user saved event """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            spy = mock.Mock()
+            events.user_save_event.connect(spy, weak=False)
+            user_service.record_failed_login(user)
+            spy.assert_called_with(user)
+
     def test_login_fails_if_locked(self):
         """ Abort login if account locked """
         with user_events.disconnect_receivers():
@@ -361,6 +709,25 @@ class UserServiceTests(BaseTestCase):
         verified = user.verify_password(password)
         self.assertTrue(verified)
 
+    def test_register_hashes_password_on_hashing_pool(self):
+        """ Registration hashes password via hashing pool once data is valid """
+        pool = user_service.hashing_pool
+        with mock.patch.object(pool, 'run', wraps=pool.run) as run:
+            with user_events.disconnect_receivers():
+                result = user_service.register(
+                    user_data=dict(email='not.email', password='123'),
+                    send_welcome=False
+                )
+                self.assertFalse(result)
+                run.assert_not_called()
+
+                user = user_service.register(
+                    user_data=dict(email='tester@test.com', password='123'),
+                    send_welcome=False
+                )
+            self.assertEqual(1, run.call_count)
+        self.assertTrue(user.verify_password('123'))
+
     def test_register_emits_event(self):
         """ Registration emits event """
         event = events.register_event
@@ -584,6 +951,16 @@ class UserServiceTests(BaseTestCase):
                 self.assertFalse(current_user.is_authenticated)
                 self.assertTrue(u.verify_password('0987654'))
 
+    def test_password_change_hashes_on_hashing_pool(self):
+        """ Password change hashes new password via hashing pool """
+        u = self.create_user()
+        pool = user_service.hashing_pool
+        with mock.patch.object(pool, 'run', wraps=pool.run) as run:
+            with events.events.disconnect_receivers():
+                user_service.change_password(u, '0987654')
+            run.assert_called_once()
+        self.assertTrue(u.verify_password('0987654'))
+
     def test_password_change_emits_event(self):
         """ Password change  """
         u = self.create_user()
@@ -691,6 +1068,47 @@ class UserServiceTests(BaseTestCase):
             user_service.remove_role_from_user(user, role)
             spy.assert_called_with(user, role=role)
 
+    def test_role_changes_persist_roles_version(self):
+        """ Role changes persist roles version used to cache needs """
+        from flask_principal import RoleNeed
+        with events.events.disconnect_receivers():
+            user = self.create_user()
+            role = Role(handle='test_role', title='Testing')
+            role_service.save(role)
+            self.assertNotIn(RoleNeed('test_role'), user.provide_principal_needs())
+
+            user_service.add_role_to_user(user, role)
+            user_id = user.id
+            self.db.session.remove()
+            user = user_service.get(user_id)
+            self.assertEqual(1, user.roles_version)
+            self.assertIn(RoleNeed('test_role'), user.provide_principal_needs())
+
+    def test_concurrent_role_changes_get_distinct_versions(self):
+        """ Role changes saved from two sessions never share a version """
+        with events.events.disconnect_receivers():
+            user = self.create_user()
+            one = Role(handle='one', title='One')
+            two = Role(handle='two', title='Two')
+            role_service.save(one)
+            role_service.save(two)
+            user_id, two_id = user.id, two.id
+
+            # both sessions see version 0 before either commits
+            other = self.db.create_scoped_session()
+            other_user = other.query(User).get(user_id)
+            self.assertEqual(0, other_user.roles_version)
+            other_user.add_role(other.query(Role).get(two_id))
+
+            user_service.add_role_to_user(user, one)
+            self.assertEqual(1, user.roles_version)
+            other.commit()
+            self.assertEqual(2, other_user.roles_version)
+            other.remove()
+
+        self.db.session.remove()
+        self.assertEqual(2, user_service.get(user_id).roles_version)
+
     # -------------------------------------------------------------------------
     # JWT tokens
     # -------------------------------------------------------------------------
@@ -699,7 +1117,7 @@ class UserServiceTests(BaseTestCase):
         """ Initializing user service with config options """
         class CustomConfig(DefaultConfig, UserConfig):
             USER_JWT_SECRET='SuperSecret'
-            USER_JWT_ALGO='FAKE526'
+            USER_JWT_ALGO='HS512'
             USER_JWT_LIFETIME_SECONDS=-1
             USER_JWT_IMPLEMENTATION=None
             USER_JWT_LOADER_IMPLEMENTATION=None
@@ -746,39 +1164,79 @@ class UserServiceTests(BaseTestCase):
         with self.assertRaises(x.JwtNoUser):
             user_service.get_token(111)
 
-    def test_default_implemnetation_returns_token_on_file_if_got_one(self):
-        """ Return token from user model if it's still valid"""
+    def test_default_implementation_stores_token_digest(self):
+        """ Default implementation puts token digest on file, not the token """
         with user_events.disconnect_receivers():
             user = self.create_user(confirm_email=True)
-        from_now = timedelta(seconds=user_service.jwt_lifetime)
-        expires = datetime.utcnow() + from_now
-        data = dict(exp=expires, user_id=user.id)
-        token = jwt.encode(
-            data,
-            user_service.jwt_secret,
-            algorithm=user_service.jwt_algo
-        )
-        user._token = token
-        user_service.save(user)
-        token = user_service.get_token(user.id)
-        self.assertEquals(user._token, token)
+            token = user_service.get_token(user.id, device='phone')
+
+        user_token = UserToken.query.filter_by(user_id=user.id).one()
+        self.assertEquals(64, len(user_token.token_hash))
+        self.assertEquals(UserToken.hash(token), user_token.token_hash)
+        self.assertEquals('phone', user_token.device)
+        self.assertFalse(user_token.is_expired())
 
-    def test_default_implementation_regenerates_token_if_expired(self):
-        """ Regenerate user token if the one on file expired"""
+    def test_default_implementation_issues_token_per_device(self):
+        """ Tokens from several devices are valid at the same time """
         with user_events.disconnect_receivers():
             user = self.create_user(confirm_email=True)
-        from_now = timedelta(seconds=-20)
-        expires = datetime.utcnow() + from_now
-        data = dict(exp=expires, user_id=user.id)
-        token = jwt.encode(
-            data,
-            user_service.jwt_secret,
-            algorithm=user_service.jwt_algo
-        )
-        user._token = token
-        user_service.save(user)
-        token = user_service.get_token(user.id)
-        self.assertEquals(token, user._token)
+            phone = user_service.get_token(user.id, device='phone')
+            laptop = user_service.get_token(user.id, device='laptop')
+            self.assertNotEquals(phone, laptop)
+            self.assertEquals(2, user._tokens.count())
+            for token in (phone, laptop):
+                loaded = user_service.default_token_user_loader(token)
+                self.assertEquals(user.id, loaded.id)
+
+    def test_default_implementation_replaces_token_of_same_device(self):
+        """ New token for a device replaces the one it had before """
+        with user_events.disconnect_receivers():
+            user = self.create_user(confirm_email=True)
+            old = user_service.get_token(user.id, device='phone')
+            new = user_service.get_token(user.id, device='phone')
+            self.assertNotEquals(old, new)
+            self.assertEquals(1, user._tokens.count())
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.default_token_user_loader(old)
+
+    def test_default_implementation_prunes_expired_tokens(self):
+        """ Expired tokens are dropped when issuing new ones """
+        with user_events.disconnect_receivers():
+            user = self.create_user(confirm_email=True)
+            user_service.jwt_lifetime = -1
+            user_service.get_token(user.id)
+            user_service.jwt_lifetime = 86400
+            user_service.get_token(user.id)
+            self.assertEquals(1, user._tokens.count())
+
+    def test_revoke_tokens_of_a_device(self):
+        """ Revoking tokens of a device leaves other devices logged in """
+        with user_events.disconnect_receivers():
+            user = self.create_user(confirm_email=True)
+            phone = user_service.get_token(user.id, device='phone')
+            laptop = user_service.get_token(user.id, device='laptop')
+            user_service.revoke_user_token(user.id, device='phone')
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.default_token_user_loader(phone)
+            loaded = user_service.default_token_user_loader(laptop)
+            self.assertEquals(user.id, loaded.id)
+
+    def test_revoke_tokens_of_all_devices(self):
+        """ Revoking user tokens logs out all devices """
+        with user_events.disconnect_receivers():
+            user = self.create_user(confirm_email=True)
+            user_service.get_token(user.id, device='phone')
+            user_service.get_token(user.id, device='laptop')
+            user_service.revoke_user_token(user.id)
+        self.assertEquals(0, UserToken.query.count())
+
+    def test_deleting_user_deletes_tokens(self):
+        """ User tokens are deleted along with the user """
+        with user_events.disconnect_receivers():
+            user = self.create_user(confirm_email=True)
+            user_service.get_token(user.id)
+            user_service.delete(user)
+        self.assertEquals(0, UserToken.query.count())
 
     def test_default_tokens_fail_if_tampered_with(self):
         """ Default tokens fail if tampered with"""
@@ -817,6 +1275,15 @@ class UserServiceTests(BaseTestCase):
             with self.assertRaises(x.JwtDecodeError):
                 user_service.default_token_user_loader(token)
 
+    def test_token_with_malformed_kid_fails_to_decode(self):
+        """ Forged kid header fails as decode error, not a server error """
+        from tests.keyring_test import forge_token
+        token = forge_token(dict(alg='HS256', typ='JWT', kid=123))
+        with self.assertRaises(x.JwtDecodeError):
+            user_service.default_token_user_loader(token)
+        with self.assertRaises(x.JwtDecodeError):
+            user_service.revoke_token(token)
+
     def test_default_token_user_loader_fails_if_expired(self):
         """ Default token user loader fails if expired """
         with user_events.disconnect_receivers():
@@ -879,9 +1346,9 @@ class UserServiceTests(BaseTestCase):
         token = user_service.get_token(user.id)
         decoded = user_service.decode_token(token)
         self.assertEquals(user.id, decoded['user_id'])
-        for claim in ['exp', 'nbf', 'iat', 'user_id']:
+        for claim in ['exp', 'nbf', 'iat', 'jti', 'user_id']:
             self.assertTrue(claim in decoded.keys())
-        self.assertEquals(4, len(decoded.keys()))
+        self.assertEquals(5, len(decoded.keys()))
 
     def test_fall_back_to_default_token_loader_if_no_custom(self):
         """ Fall back to default token user loader if no custom"""
@@ -900,9 +1367,8 @@ class UserServiceTests(BaseTestCase):
 
         cfg = CustomConfig()
         app = bootstrap.create_app(__name__, config=cfg)
-        user_feature(app)
         with self.assertRaises(x.ConfigurationException):
-            user_service.get_token(123)
+            user_feature(app)
 
     def test_can_use_custom_token_implementation(self):
         """ Can register and use custom token implementation"""
@@ -929,9 +1395,37 @@ class UserServiceTests(BaseTestCase):
 
         cfg = CustomConfig()
         app = bootstrap.create_app(__name__, config=cfg)
-        user_feature(app)
         with self.assertRaises(x.ConfigurationException):
+            user_feature(app)
+
+    def test_raise_when_custom_token_loader_is_not_callable(self):
+        """ Raising exception if custom token loader is not callable """
+        class CustomConfig(DefaultConfig, UserConfig):
+            USER_JWT_SECRET='SuperSecret'
+            USER_JWT_LOADER_IMPLEMENTATION='shiftuser.config'
+
+        cfg = CustomConfig()
+        app = bootstrap.create_app(__name__, config=cfg)
+        with self.assertRaises(x.ConfigurationException):
+            user_feature(app)
+
+    def test_custom_implementations_are_resolved_once(self):
+        """ Custom implementations are imported at init, not per call """
+        loader = 'tests.user_service_test.custom_token_loader'
+
+        class CustomConfig(DefaultConfig, UserConfig):
+            USER_JWT_SECRET='SuperSecret'
+            USER_JWT_LOADER_IMPLEMENTATION=loader
+
+        cfg = CustomConfig()
+        app = bootstrap.create_app(__name__, config=cfg)
+        user_feature(app)
+        self.assertIs(custom_token_loader, user_service.token_loader)
+        path = 'shiftuser.user_service.import_string'
+        with mock.patch(path) as import_string:
             user_service.get_user_by_token(123)
+            user_service.get_user_by_token(123)
+            self.assertFalse(import_string.called)
 
     def test_can_use_custom_token_loader(self):
         """ Can register and use custom token user loader"""
@@ -949,25 +1443,770 @@ class UserServiceTests(BaseTestCase):
         expected = custom_token_loader(123)
         self.assertEquals(expected, loaded)
 
+    # -------------------------------------------------------------------------
+    # JWT token cache
+    # -------------------------------------------------------------------------
 
+    def count_queries(self):
+        """ Start counting sql queries, returns a list to inspect """
+        from sqlalchemy import event
+        queries = []
+        counter = lambda *args: queries.append(args[2])
+        event.listen(self.db.engine, 'before_cursor_execute', counter)
+        self.addCleanup(
+            event.remove,
+            self.db.engine,
+            'before_cursor_execute',
+            counter
+        )
+        return queries
 
+    def test_token_cache_disabled_by_default(self):
+        """ Token cache is not enabled unless configured """
+        self.assertIsNone(user_service.token_cache)
 
+    def test_token_loader_caches_decoded_token_and_user(self):
+        """ Repeated loads of the same token skip decoding and user query """
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            loaded = user_service.default_token_user_loader(token)
+            self.assertEqual(user.id, loaded.id)
 
+        self.db.session.remove()
+        queries = self.count_queries()
+        with mock.patch.object(user_service, 'decode_token') as decode:
+            loaded = user_service.default_token_user_loader(token)
+            self.assertFalse(decode.called)
+
+        self.assertEqual(1, len(queries)) # token on file
+        self.assertEqual(user.id, loaded.id)
+        self.assertEqual(user.email, loaded.email)
+        self.assertGreater(user_service.token_cache.stats()['hits'], 0)
+
+    def test_caches_can_use_sqlite_backend(self):
+        """ Token and user caches share a configured SQLite file """
+        import tempfile
+        from shiftuser.cache import SQLiteCache
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        config = dict(
+            USER_CACHE_BACKEND='sqlite',
+            USER_CACHE_PATH=tmp.name + '/cache.db',
+            USER_JWT_CACHE_SIZE=100,
+            USER_SESSION_CACHE_SIZE=100
+        )
+        with mock.patch.dict(self.app.config, config):
+            user_feature(self.app)
+        self.addCleanup(user_feature, self.app)
+        self.assertIsInstance(user_service.token_cache, SQLiteCache)
+        self.assertIsInstance(user_service.user_cache, SQLiteCache)
 
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.default_token_user_loader(token)
 
+        self.db.session.remove()
+        queries = self.count_queries()
+        loaded = user_service.default_token_user_loader(token)
+        self.assertEqual(1, len(queries)) # token on file
+        self.assertEqual(user.email, loaded.email)
 
+    def test_cached_token_still_checks_account_lock(self):
+        """ Account lock is checked for cached tokens """
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.default_token_user_loader(token)
 
+        cached = user_service.get_cached_token(token)
+        cached['user']['locked_until'] = datetime.utcnow() + timedelta(1)
+        with self.assertRaises(x.AccountLocked):
+            user_service.default_token_user_loader(token)
 
+    def test_saving_user_invalidates_cached_tokens(self):
+        """ Cached tokens are dropped when user is saved """
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.default_token_user_loader(token)
+        self.assertIsNotNone(user_service.get_cached_token(token))
+
+        user_service.save(user)
+        self.assertIsNone(user_service.get_cached_token(token))
+
+    def test_revoking_token_invalidates_cached_tokens(self):
+        """ Revoked token fails to load even if it was cached """
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.default_token_user_loader(token)
+            user_service.revoke_user_token(user.id)
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.default_token_user_loader(token)
+
+    def test_cached_token_revoked_elsewhere_fails(self):
+        """ Cached token deleted by another process fails to load """
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.default_token_user_loader(token)
+
+        # delete behind the back of local cache
+        UserToken.query.filter_by(user_id=user.id).delete()
+        self.db.session.commit()
+        self.assertIsNotNone(user_service.get_cached_token(token))
+        with self.assertRaises(x.JwtTokenMismatch):
+            user_service.default_token_user_loader(token)
+
+    def test_cached_token_does_not_outlive_expiration(self):
+        """ Token cache entries expire no later than the token """
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            claims = user_service.decode_token(token)
+            claims['exp'] = claims['iat'] - 1  # already expired
+            user_service.cache_token(token, claims, user)
+        self.assertIsNone(user_service.get_cached_token(token))
+
+
+    # -------------------------------------------------------------------------
+    # Stateless JWT mode
+    # -------------------------------------------------------------------------
+
+    def test_stateless_tokens_are_not_stored(self):
+        """ Stateless tokens are not persisted and carry version and jti """
+        user_service.jwt_stateless = True
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token1 = user_service.get_token(user.id)
+            token2 = user_service.get_token(user.id)
+
+        self.assertEqual(0, UserToken.query.count())
+        self.assertNotEqual(token1, token2)
+        claims = user_service.decode_token(token1)
+        self.assertEqual(0, claims['token_version'])
+        self.assertIn('jti', claims)
+
+    def test_stateless_token_loader_can_load_user(self):
+        """ Stateless token loads user without comparing to token on file """
+        user_service.jwt_stateless = True
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            loaded = user_service.default_token_user_loader(token)
+        self.assertEqual(user.id, loaded.id)
+
+    def test_stateless_revoke_bumps_token_version(self):
+        """ Revoking in stateless mode fails all tokens issued so far """
+        user_service.jwt_stateless = True
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.revoke_user_token(user.id)
+            self.assertEqual(1, user_service.get(user.id).token_version)
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.default_token_user_loader(token)
+
+            new_token = user_service.get_token(user.id)
+            loaded = user_service.default_token_user_loader(new_token)
+            self.assertEqual(user.id, loaded.id)
+
+    def test_stateless_revoke_fails_cached_tokens(self):
+        """ Version check also applies to cached tokens """
+        user_service.jwt_stateless = True
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.default_token_user_loader(token)
+
+            # bump version elsewhere, bypassing cache invalidation
+            self.db.session.query(User).filter(User.id == user.id).update(
+                dict(
+                    token_version=User.token_version + 1,
+                    token_version_changed=datetime.utcnow()
+                ),
+                synchronize_session=False
+            )
+            self.db.session.commit()
+            user_service.token_versions.refresh()
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.default_token_user_loader(token)
+
+    def test_stateless_cached_token_makes_no_queries(self):
+        """ Cached stateless token loads without database round trips """
+        user_service.jwt_stateless = True
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.default_token_user_loader(token)
+
+        self.db.session.remove()
+        queries = self.count_queries()
+        loaded = user_service.default_token_user_loader(token)
+        self.assertEqual(user.id, loaded.id)
+        self.assertEqual(0, len(queries))
+
+    # -------------------------------------------------------------------------
+    # Access and refresh tokens
+    # -------------------------------------------------------------------------
+
+    def test_issue_token_pair(self):
+        """ Issuing access token with a refresh token """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            pair = user_service.issue_token_pair(user.id, device='phone')
+
+        claims = user_service.decode_token(pair['access_token'])
+        self.assertEqual('access', claims['type'])
+        self.assertEqual(user.id, claims['user_id'])
+        self.assertEqual(user_service.jwt_access_lifetime, pair['expires_in'])
+
+        stored = UserToken.query.one()
+        self.assertEqual('refresh', stored.kind)
+        self.assertEqual('phone', stored.device)
+        self.assertEqual(UserToken.hash(pair['refresh_token']), stored.token_hash)
+
+    def test_access_token_validated_without_token_lookup(self):
+        """ Access tokens are not looked up on file """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            pair = user_service.issue_token_pair(user.id)
+
+        user_service.get(user.id)  # in identity map now
+        queries = self.count_queries()
+        loaded = user_service.default_token_user_loader(pair['access_token'])
+        self.assertEqual(user.id, loaded.id)
+        token_lookups = [q for q in queries if re.search(r'\buser_token\b', q)]
+        self.assertEqual([], token_lookups)
+
+    def test_access_token_with_cache_needs_no_queries(self):
+        """ Cached access tokens make no database round trips """
+        user_service.token_cache = TTLCache(max_size=100, ttl=60)
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            pair = user_service.issue_token_pair(user.id)
+            user_service.default_token_user_loader(pair['access_token'])
+
+        self.db.session.remove()
+        queries = self.count_queries()
+        loaded = user_service.default_token_user_loader(pair['access_token'])
+        self.assertEqual(user.id, loaded.id)
+        self.assertEqual(0, len(queries))
+
+    def test_refresh_token_pair_rotates_refresh_token(self):
+        """ Refresh tokens can only be used once """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            pair = user_service.issue_token_pair(user.id, device='phone')
+            new_pair = user_service.refresh_token_pair(pair['refresh_token'])
+            self.assertNotEqual(pair['refresh_token'], new_pair['refresh_token'])
+            self.assertEqual(1, UserToken.query.count())
+            self.assertEqual('phone', UserToken.query.one().device)
+
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.refresh_token_pair(pair['refresh_token'])
+
+    def test_refresh_fails_if_refresh_token_expired(self):
+        """ Expired refresh tokens can't be used """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            user_service.jwt_refresh_lifetime = -1
+            pair = user_service.issue_token_pair(user.id)
+            with self.assertRaises(x.JwtExpired):
+                user_service.refresh_token_pair(pair['refresh_token'])
 
+    def test_refresh_fails_if_account_locked(self):
+        """ Locked accounts can't refresh tokens """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            pair = user_service.issue_token_pair(user.id)
+            user.lock_account(minutes=1)
+            user_service.save(user)
+            with self.assertRaises(x.AccountLocked):
+                user_service.refresh_token_pair(pair['refresh_token'])
+
+    def test_revoking_user_tokens_revokes_refresh_tokens(self):
+        """ Revoking user tokens revokes refresh tokens """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            pair = user_service.issue_token_pair(user.id)
+            user_service.revoke_user_token(user.id)
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.refresh_token_pair(pair['refresh_token'])
+
+    def test_refresh_token_view(self):
+        """ Refresh token view responds with a new pair """
+        from shiftuser.views import RefreshToken
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            pair = user_service.issue_token_pair(user.id)
+
+        view = RefreshToken.as_view('refresh')
+        data = dict(refresh_token=pair['refresh_token'])
+        with self.app.test_request_context(method='POST', json=data):
+            response = view()
+        self.assertIn('access_token', response.get_json())
+        self.assertIn('refresh_token', response.get_json())
+
+        from werkzeug.exceptions import Unauthorized
+        with self.app.test_request_context(method='POST', json=data):
+            with self.assertRaises(Unauthorized):
+                view()
+
+    # -------------------------------------------------------------------------
+    # JWT keyring
+    # -------------------------------------------------------------------------
+
+    def test_can_use_asymmetric_jwt_keys(self):
+        """ Issuing and loading tokens signed with asymmetric keys """
+        from tests.keyring_test import private_pem
+        from cryptography.hazmat.primitives.asymmetric import ec
+        key = ec.generate_private_key(ec.SECP256R1())
+        config = self.app.config
+        keys = dict(main=dict(algorithm='ES256', private_key=private_pem(key)))
+        with mock.patch.dict(config, USER_JWT_KEYS=keys, USER_JWT_KEY_ID='main'):
+            user_feature(self.app)
+
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            self.assertEqual('main', jwt.get_unverified_header(token)['kid'])
+            loaded = user_service.get_user_by_token(token)
+            self.assertEqual(user.id, loaded.id)
+
+    def test_keys_are_not_parsed_per_token(self):
+        """ Decoding tokens does not parse keys """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+
+        key = user_service.keyring.get(None)
+        with mock.patch('shiftuser.util.keyring.prepare_key') as prepare:
+            user_service.decode_token(token)
+            self.assertFalse(prepare.called)
+        self.assertIs(key, user_service.keyring.get(None))
+
+    # -------------------------------------------------------------------------
+    # Revocation store
+    # -------------------------------------------------------------------------
+
+    def use_revocation_store(self):
+        """ Configure user service with a temporary revocation store """
+        import tempfile
+        from shiftuser.util.revocation import RevocationStore
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = tmp.name + '/revoked'
+        user_service.revocations = RevocationStore(path, capacity=128)
+        return path
+
+    def test_revocation_store_disabled_by_default(self):
+        """ Revocation store is not used unless configured """
+        self.assertIsNone(user_service.revocations)
+
+    def test_revoke_single_access_token(self):
+        """ Revoking an access token that is not on file """
+        self.use_revocation_store()
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            revoked = user_service.issue_token_pair(user.id)['access_token']
+            other = user_service.issue_token_pair(user.id)['access_token']
+            user_service.revoke_token(revoked)
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.default_token_user_loader(revoked)
+            loaded = user_service.default_token_user_loader(other)
+            self.assertEqual(user.id, loaded.id)
+
+    def test_revoking_token_not_on_file_requires_revocation_store(self):
+        """ Revoking access token without revocation store fails loudly """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.issue_token_pair(user.id)['access_token']
+            with self.assertRaises(x.ConfigurationException):
+                user_service.revoke_token(token)
+
+            user_service.jwt_stateless = True
+            try:
+                token = user_service.get_token(user.id)
+                with self.assertRaises(x.ConfigurationException):
+                    user_service.revoke_token(token)
+            finally:
+                user_service.jwt_stateless = False
+
+    def test_revoke_single_token_on_file(self):
+        """ Revoking a token on file deletes it """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.revoke_token(token)
+            self.assertEqual(0, UserToken.query.count())
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.default_token_user_loader(token)
 
+    def test_revoked_version_seen_before_versions_refresh(self):
+        """ Other workers see revoked versions without refreshing """
+        path = self.use_revocation_store()
+        user_service.jwt_stateless = True
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            token = user_service.get_token(user.id)
+            user_service.default_token_user_loader(token)
 
+            # another worker with a stale versions map
+            from shiftuser.util.revocation import RevocationStore
+            worker = UserService()
+            worker.init(self.app)
+            worker.jwt_stateless = True
+            worker.revocations = RevocationStore(path)
+            worker.token_versions.refresh_interval = 3600
+            worker.default_token_user_loader(token)
+
+            user_service.revoke_user_token(user.id)
+            with self.assertRaises(x.JwtTokenMismatch):
+                worker.default_token_user_loader(token)
+
+    def test_full_revocation_store_fails_before_commit(self):
+        """ Stateless revoke does not bump version if store is full """
+        self.use_revocation_store()
+        user_service.jwt_stateless = True
+        with user_events.disconnect_receivers():
+            user_id = self.create_user().id
+        full = x.RevocationStoreFull('full')
+        with mock.patch.object(user_service.revocations, 'add', side_effect=full):
+            with self.assertRaises(x.RevocationStoreFull):
+                user_service.revoke_user_token(user_id)
+        self.db.session.remove()
+        self.assertEqual(0, user_service.get_token_version(user_id))
 
+    # -------------------------------------------------------------------------
+    # Token issuance
+    # -------------------------------------------------------------------------
 
+    def test_issuing_token_does_not_load_or_save_user(self):
+        """ Token issuance is a targeted delete and insert """
+        with user_events.disconnect_receivers():
+            user_id = self.create_user().id
 
+        self.db.session.remove()
+        queries = self.count_queries()
+        user_service.get_token(user_id, device='phone')
+        statements = [query.split()[0].upper() for query in queries]
+        self.assertEqual(['DELETE', 'INSERT'], statements)
 
+    def test_stateless_revoke_is_a_targeted_update(self):
+        """ Stateless revocation updates version without a validated save """
+        user_service.jwt_stateless = True
+        with user_events.disconnect_receivers():
+            user_id = self.create_user().id
+
+        self.db.session.remove()
+        queries = self.count_queries()
+        user_service.revoke_user_token(user_id)
+        updates = [query for query in queries if query.startswith('UPDATE')]
+        self.assertEqual(1, len(updates))
+        self.assertNotIn('email', ' '.join(queries))
+        self.assertEqual(1, user_service.get_token_version(user_id))
+
+    def test_get_tokens_in_bulk(self):
+        """ Minting tokens for many users at once """
+        with user_events.disconnect_receivers():
+            users = user_service.create_users_bulk([
+                dict(email='user{}@test.com'.format(i), password='123456')
+                for i in range(5)
+            ], workers=1)
+            for user in users:
+                user.confirm_email()
+                user_service.save(user)
+        user_ids = [user.id for user in users]
+
+        self.db.session.remove()
+        queries = self.count_queries()
+        pairs = list(user_service.get_tokens(user_ids + [999], chunk_size=3))
+        inserts = [query for query in queries if query.startswith('INSERT')]
+        selects = [query for query in queries if query.startswith('SELECT')]
+        self.assertEqual(2, len(inserts))
+        self.assertEqual(2, len(selects))
+
+        self.assertEqual(user_ids, [user_id for user_id, _ in pairs])
+        self.assertEqual(5, UserToken.query.count())
+        for user_id, token in pairs:
+            loaded = user_service.get_user_by_token(token)
+            self.assertEqual(user_id, loaded.id)
 
+    def test_get_tokens_replaces_device_tokens(self):
+        """ Bulk minting for a device replaces its previous tokens """
+        with user_events.disconnect_receivers():
+            user_id = self.create_user().id
+            old = dict(user_service.get_tokens([user_id], device='load'))
+            new = dict(user_service.get_tokens([user_id], device='load'))
+            self.assertEqual(1, UserToken.query.count())
+            with self.assertRaises(x.JwtTokenMismatch):
+                user_service.get_user_by_token(old[user_id])
+            loaded = user_service.get_user_by_token(new[user_id])
+            self.assertEqual(user_id, loaded.id)
 
+    # -------------------------------------------------------------------------
+    # Request user loader
+    # -------------------------------------------------------------------------
+
+    def create_user_with_role(self):
+        """ Create a user with a role, returns user id """
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            role = Role(handle='test_role', title='Testing')
+            role_service.save(role)
+            user_service.add_role_to_user(user, role)
+        role_hierarchy.refresh_if_stale() # loaded once per process
+        permission_registry.refresh_if_stale()
+        return user.id
+
+    def test_load_user_with_roles_in_one_query(self):
+        """ Loading user from session fetches roles in the same query """
+        user_id = self.create_user_with_role()
+        self.db.session.remove()
+        queries = self.count_queries()
+        with self.app.test_request_context():
+            user = user_service.load_user(str(user_id))
+            self.assertTrue(user.has_role('test_role'))
+        self.assertEqual(1, len(queries))
+
+    def test_load_user_is_memoized_per_request(self):
+        """ Repeated loads within a request reuse the user """
+        user_id = self.create_user_with_role()
+        self.db.session.remove()
+        with self.app.test_request_context():
+            queries = self.count_queries()
+            user = user_service.load_user(user_id)
+            self.assertIs(user, user_service.load_user(str(user_id)))
+            self.assertEqual(1, len(queries))
+
+        with self.app.app_context(), self.app.test_request_context():
+            user_service.load_user(user_id)
+            self.assertEqual(2, len(queries))
+
+    def test_one_query_per_authenticated_request(self):
+        """ Authenticated request with principal needs makes one query """
+        from flask import session
+        from flask_principal import Identity, Permission, RoleNeed
+        from shiftuser.services import principal
+        user_id = self.create_user_with_role()
+        self.db.session.remove()
+
+        queries = self.count_queries()
+        with self.app.test_request_context():
+            session['_user_id'] = str(user_id)
+            self.assertTrue(current_user.is_authenticated)
+            principal.set_identity(Identity(current_user.id))
+            self.assertTrue(Permission(RoleNeed('test_role')).can())
+            self.assertEqual(user_id, current_user.id)
+        self.assertEqual(1, len(queries))
+
+    # -------------------------------------------------------------------------
+    # Lightweight user
+    # -------------------------------------------------------------------------
+
+    def test_load_authenticated_user(self):
+        """ Loading authenticated user from session """
+        user_id = self.create_user_with_role()
+        self.db.session.remove()
+        with self.app.app_context(), self.app.test_request_context():
+            user = user_service.load_authenticated_user(str(user_id))
+            self.assertIsInstance(user, AuthenticatedUser)
+            self.assertTrue(user.has_role('test_role'))
+            self.assertIs(user, user_service.load_authenticated_user(user_id))
+            self.assertIsNone(user_service.load_authenticated_user('nope'))
+
+    def test_load_authenticated_user_from_cache_skips_entity(self):
+        """ Cached authenticated user loads without queries or entity """
+        user_service.user_cache = TTLCache(max_size=100, ttl=60)
+        user_id = self.create_user_with_role()
+        self.db.session.remove()
+        with self.app.app_context(), self.app.test_request_context():
+            user_service.load_authenticated_user(user_id)
+
+        self.db.session.remove()
+        queries = self.count_queries()
+        with self.app.app_context(), self.app.test_request_context():
+            user = user_service.load_authenticated_user(user_id)
+            self.assertTrue(user.has_role('test_role'))
+            self.assertEqual('test@test.com', user.email)
+            self.assertIsNone(user._entity)
+            self.assertEqual(0, len(queries))
+
+            self.assertTrue(user.email_confirmed)
+            self.assertIsInstance(user.entity, User)
+
+        user_service.invalidate_user_cache(user_id)
+        self.assertEqual(0, len(user_service.user_cache))
+
+    def test_session_loader_returns_authenticated_user(self):
+        """ Login manager loads authenticated user in lightweight mode """
+        from flask import session
+        from flask_principal import Identity, Permission, RoleNeed
+        from shiftuser.services import principal
+        user_id = self.create_user_with_role()
+        self.db.session.remove()
+        with mock.patch.object(user_service, 'lightweight_user', True):
+            with self.app.app_context(), self.app.test_request_context():
+                session['_user_id'] = str(user_id)
+                self.assertTrue(current_user.is_authenticated)
+                user = current_user._get_current_object()
+                self.assertIsInstance(user, AuthenticatedUser)
+                principal.set_identity(Identity(current_user.id))
+                self.assertTrue(Permission(RoleNeed('test_role')).can())
+
+    def test_identity_gets_permission_mask(self):
+        """ Loaded identity carries user permission mask """
+        from flask import session, g
+        from flask_principal import Identity
+        from shiftuser.services import principal
+        from shiftuser.util.principal import UserIdentity
+        with user_events.disconnect_receivers():
+            user = self.create_user()
+            role = role_service.create('editor')
+            role.grant('post.edit')
+            role_service.save(role)
+            user_service.add_role_to_user(user, role)
+        user_id = user.id
+        self.db.session.remove()
+        for identity_class in (Identity, UserIdentity):
+            with self.app.app_context(), self.app.test_request_context():
+                session['_user_id'] = str(user_id)
+                principal.set_identity(identity_class(current_user.id))
+                mask = g.identity.permission_mask
+                self.assertEqual(current_user.permission_mask, mask)
+                self.assertTrue(current_user.can('post.edit'))
+
+    def test_identity_needs_resolve_on_permission_check(self):
+        """ Requests that never check a permission do not resolve needs """
+        from flask import session, g
+        from flask_principal import Permission, RoleNeed
+        from shiftuser.services import principal
+        from shiftuser.util.principal import UserIdentity
+        user_id = self.create_user_with_role()
+        self.db.session.remove()
+        with self.app.app_context(), self.app.test_request_context():
+            session['_user_id'] = str(user_id)
+            principal.set_identity(UserIdentity(current_user.id))
+            self.assertFalse(g.identity.provides.resolved)
+
+            self.assertTrue(Permission(RoleNeed('test_role')).can())
+            self.assertTrue(g.identity.provides.resolved)
+
+    def test_identity_needs_follow_hierarchy_changed_elsewhere(self):
+        """ Needs pick up role hierarchy changed by another process """
+        from flask import session, g
+        from shiftuser.services import principal
+        from shiftuser.util.principal import UserIdentity
+        user_id = self.create_user_with_role()
+        with user_events.disconnect_receivers():
+            editor = Role(handle='editor', title='Editor')
+            role_service.save(editor)
+        editor_id = editor.id
+        role_hierarchy.refresh_if_stale()
+
+        def provided():
+            self.db.session.remove()
+            with self.app.app_context(), self.app.test_request_context():
+                session['_user_id'] = str(user_id)
+                principal.set_identity(UserIdentity(current_user.id))
+                handles = {need.value for need in g.identity.provides}
+                return handles, current_user.has_role('editor')
+
+        self.assertEqual(({'test_role', 'user'}, False), provided())
+
+        # reparent from a second session, no local invalidation
+        other = self.db.create_scoped_session()
+        other.execute(
+            'UPDATE role SET parent_id = :parent WHERE handle = :handle',
+            dict(parent=editor_id, handle='test_role')
+        )
+        other.commit()
+        other.remove()
+        role_hierarchy._refreshed_at -= role_hierarchy.refresh_interval
+
+        handles, has_editor = provided()
+        self.assertTrue(has_editor)
+        self.assertIn('editor', handles)
+
+    # -------------------------------------------------------------------------
+    # User snapshot cache
+    # -------------------------------------------------------------------------
+
+    def test_user_cache_disabled_by_default(self):
+        """ User cache is not enabled unless configured """
+        self.assertIsNone(user_service.user_cache)
+
+    def test_load_user_from_cache_skips_database(self):
+        """ Cached user with roles loads without queries """
+        user_service.user_cache = TTLCache(max_size=100, ttl=60)
+        user_id = self.create_user_with_role()
+        self.db.session.remove()
+        with self.app.app_context(), self.app.test_request_context():
+            user_service.load_user(user_id)
+
+        self.db.session.remove()
+        queries = self.count_queries()
+        with self.app.app_context(), self.app.test_request_context():
+            user = user_service.load_user(user_id)
+            self.assertEqual(user_id, user.id)
+            self.assertEqual('test@test.com', user.email)
+            self.assertTrue(user.email_confirmed)
+            self.assertFalse(user.is_locked())
+            self.assertTrue(user.has_role('test_role'))
+        self.assertEqual(0, len(queries))
+
+    def test_user_snapshot_leaves_out_secrets(self):
+        """ Password hash is not cached but loads when needed """
+        user_id = self.create_user_with_role()
+        user = user_service.get(user_id)
+        snapshot = user.snapshot(roles=True)
+        self.assertNotIn('_password', snapshot)
+        self.assertEqual(['test_role'], [r['_handle'] for r in snapshot['roles']])
+
+        self.db.session.remove()
+        restored = User.from_snapshot(snapshot)
+        self.assertTrue(restored.verify_password('123456'))
+
+    def test_user_cache_invalidated_by_events(self):
+        """ User events drop cached snapshots """
+        user_service.user_cache = TTLCache(max_size=100, ttl=60)
+        user_id = self.create_user_with_role()
+        key = user_service.user_cache_key(user_id)
+
+        def cached():
+            user_service.load_user(user_id)
+            self.assertIsNotNone(user_service.user_cache.get(key))
+            return user_service.get(user_id)
+
+        user = cached()
+        user_service.save(user)
+        self.assertIsNone(user_service.user_cache.get(key))
 
+        role = role_service.create(handle='another_role')
+        user = cached()
+        user_service.add_role_to_user(user, role)
+        self.assertIsNone(user_service.user_cache.get(key))
 
+        user = cached()
+        user_service.remove_role_from_user(user, role)
+        self.assertIsNone(user_service.user_cache.get(key))
 
+        user = cached()
+        role.title = 'Renamed'
+        role_service.save(role)
+        self.assertIsNone(user_service.user_cache.get(key))
 
+        user = cached()
+        user_service.delete(user)
+        self.assertIsNone(user_service.user_cache.get(key))
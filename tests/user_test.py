@@ -2,7 +2,7 @@ from nose.plugins.attrib import attr
 from tests.base_testcase import BaseTestCase
 
 from datetime import datetime, timedelta
-from flask_principal import Need
+from flask_principal import Need, RoleNeed
 from shiftuser.models import User, Role
 from shiftuser import events, exceptions as x
 from shiftuser.services import role_service
@@ -99,6 +99,36 @@ class UserTests(BaseTestCase):
         for need in needs:
             self.assertIsInstance(need, Need)
 
+    def test_principal_needs_are_precomputed(self):
+        """ Principal needs are computed once per roles version """
+        user = User()
+        user.id = 123
+        needs = user.provide_principal_needs()
+        self.assertIsInstance(needs, frozenset)
+        self.assertIs(needs, user.provide_principal_needs())
+
+        other = User()
+        other.id = 456
+        need, = needs
+        other_need, = other.provide_principal_needs()
+        self.assertIs(need, other_need)
+
+    def test_role_change_rebuilds_principal_needs(self):
+        """ Adding and removing roles bumps roles version """
+        role = Role(handle='demo', title='Demo role')
+        role_service.save(role)
+        user = User(**self.data)
+        user.id = 123
+        self.assertEqual(1, len(user.provide_principal_needs()))
+
+        user.add_role(role)
+        self.assertEqual(1, user.roles_version)
+        self.assertIn(RoleNeed('demo'), user.provide_principal_needs())
+
+        user.remove_role(role)
+        self.assertEqual(2, user.roles_version)
+        self.assertNotIn(RoleNeed('demo'), user.provide_principal_needs())
+
     # -------------------------------------------------------------------------
     # Login counter
     # -------------------------------------------------------------------------
@@ -312,6 +342,23 @@ class UserTests(BaseTestCase):
         self.assertFalse(u.verify_password(None))
         self.assertFalse(u.verify_password('not a password'))
 
+    def test_verify_password_upgrades_legacy_hash(self):
+        """ Replace legacy password hash on successful verification """
+        from passlib.hash import bcrypt
+        from shiftuser.util.passlib import passlib_context
+        legacy = bcrypt.using(rounds=4).hash('me-is-password')
+        self.assertTrue(passlib_context.needs_update(legacy))
+
+        u = User()
+        u._password = legacy
+        self.assertFalse(u.verify_password('not a password'))
+        self.assertEqual(legacy, u.password)
+
+        self.assertTrue(u.verify_password('me-is-password'))
+        self.assertNotEqual(legacy, u.password)
+        self.assertFalse(passlib_context.needs_update(u.password))
+        self.assertTrue(u.verify_password('me-is-password'))
+
     def test_passwords_converted_to_string(self):
         """ Convert passwords to string before encoding """
         password = 123456
@@ -349,6 +396,12 @@ class UserTests(BaseTestCase):
         self.assertIsInstance(roles, tuple)
         self.assertEquals(1, len(roles)) # default role
 
+    def test_default_role_is_shared(self):
+        """ Default role is not recreated on every access """
+        user = User(**self.data)
+        self.assertIs(user.roles[-1], User(**self.data).roles[-1])
+        self.assertEqual('user', user.roles[-1].handle)
+
     def test_adding_invalid_role_raises_exception(self):
         """ Raise exception in adding bad role to user """
         user = User(**self.data)
@@ -383,6 +436,39 @@ class UserTests(BaseTestCase):
         self.assertTrue(user.has_role(role1))
         self.assertFalse(user.has_role(role2))
 
+    def test_role_handles_are_cached_until_roles_change(self):
+        """ Role handles set is built once per roles change """
+        role = Role(handle='demo', title='Demo role')
+        role_service.save(role)
+        user = User(**self.data)
+        handles = user.role_handles
+        self.assertEqual(frozenset(['user']), handles)
+        self.assertIs(handles, user.role_handles)
+
+        user.add_role(role)
+        self.assertEqual(frozenset(['user', 'demo']), user.role_handles)
+
+        user.remove_role(role)
+        self.assertEqual(frozenset(['user']), user.role_handles)
+
+    def test_can_check_if_user_has_any_or_all_roles(self):
+        """ Checking if user has any or all of the roles """
+        user = User(**self.data)
+        role1 = Role(handle='testrole1', title='Test role 1')
+        role_service.save(role1)
+        user.add_role(role1)
+        role2 = Role(handle='testrole2', title='Test role 2')
+        role_service.save(role2)
+
+        self.assertTrue(user.has_any_role('testrole2', 'testrole1'))
+        self.assertTrue(user.has_any_role(role2, role1))
+        self.assertFalse(user.has_any_role('testrole2', 'admin'))
+        self.assertFalse(user.has_any_role())
+
+        self.assertTrue(user.has_all_roles('user', role1))
+        self.assertFalse(user.has_all_roles('testrole1', role2))
+        self.assertTrue(user.has_all_roles())
+
     def test_can_remove_role(self):
         """ Removing role from user """
         role = Role(handle='demo', title='Demo role')